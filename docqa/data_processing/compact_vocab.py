@@ -0,0 +1,163 @@
+from os import makedirs
+from os.path import join
+from typing import Dict, List, Iterable
+
+import numpy as np
+
+"""
+Compact word -> id table, intended for the large vocabularies used by pre-trained word vectors
+"""
+
+
+class CompactVocab(object):
+    """
+    Maps words to ids using an open-addressing hash table stored in numpy arrays. This uses much
+    less memory than a dictionary of python strings, and lists of words can be looked up with a
+    handful of vectorized operations.
+
+    Words are keyed by python's 64-bit string hash, which is cached on the string objects, so hashing
+    tokens we have already seen is cheap. We don't store the words themselves in the table, so an
+    unknown word with a hash that collides with a known word (~1e-14 chance per query for a
+    million word vocab) will get that word's id. Since hashes are randomized per-process the table
+    is rebuilt when unpickled. Tables saved with `save` can only be loaded by processes using the same
+    hash seed, such as workers forked from the same parent.
+    """
+
+    # Array files written by `save`, which `load` memory-maps
+    _ARRAYS = ["data", "offsets", "ids", "slot_hashes", "slot_ids"]
+
+    def __init__(self, word_to_ix: Dict[str, int]):
+        words = list(word_to_ix)
+        encoded = [w.encode("utf-8") for w in words]
+        self._data = b"".join(encoded)
+        self._offsets = np.cumsum([0] + [len(x) for x in encoded], dtype=np.int64)
+        self._ids = np.array([word_to_ix[w] for w in words], dtype=np.int32)
+        self._build_table(words)
+
+    def _build_table(self, words: List[str]):
+        hashes = np.fromiter(map(hash, words), dtype=np.int64, count=len(words))
+
+        # Words with colliding hashes go in a dictionary instead
+        unique_hashes, counts = np.unique(hashes, return_counts=True)
+        self._collisions = unique_hashes[counts > 1]
+        collision = np.isin(hashes, self._collisions)
+        self._other_words = {words[i]: int(self._ids[i]) for i in np.where(collision)[0]}
+
+        size = 1 << int(max(1, np.ceil(np.log2(max(len(words), 1) * 2))))
+        self._mask = size - 1
+        self._slot_hashes = np.zeros(size, dtype=np.int64)
+        self._slot_ids = np.full(size, -1, dtype=np.int32)
+
+        # Linear probing, each pass inserts the first word that probed each free slot
+        pending = np.where(~collision)[0]
+        pos = hashes & self._mask
+        while len(pending) > 0:
+            probe = pos[pending]
+            free = self._slot_ids[probe] == -1
+            slots, first = np.unique(probe[free], return_index=True)
+            inserted = pending[free][first]
+            self._slot_hashes[slots] = hashes[inserted]
+            self._slot_ids[slots] = self._ids[inserted]
+            pending = pending[~np.isin(pending, inserted)]
+            pos[pending] = (pos[pending] + 1) & self._mask
+
+    @staticmethod
+    def hash_key() -> int:
+        """ Identifies the hash seed of this process, tables can only be shared by processes with the same key """
+        return hash("docqa.CompactVocab")
+
+    def save(self, directory: str):
+        """ Save the table as raw arrays in `directory`, which can be memory-mapped by `load` """
+        makedirs(directory)
+        arrays = dict(data=np.frombuffer(self._data, dtype=np.uint8), offsets=self._offsets, ids=self._ids,
+                      slot_hashes=self._slot_hashes, slot_ids=self._slot_ids)
+        for name in self._ARRAYS:
+            np.save(join(directory, name + ".npy"), arrays[name])
+        other_ix = []
+        if len(self._other_words) > 0:
+            other_ix = [i for i in range(len(self._ids)) if self._word(i) in self._other_words]
+        np.save(join(directory, "other_ix.npy"), np.array(other_ix, dtype=np.int64))
+        np.save(join(directory, "collisions.npy"), self._collisions)
+        np.save(join(directory, "meta.npy"), np.array([self.hash_key(), self._mask], dtype=np.int64))
+
+    @staticmethod
+    def saved_hash_key(directory: str) -> int:
+        """ `hash_key` of the process that saved the table in `directory` """
+        return int(np.load(join(directory, "meta.npy"))[0])
+
+    @classmethod
+    def load(cls, directory: str) -> "CompactVocab":
+        """
+        Load a table saved by `save`. The arrays are memory-mapped read-only, so processes loading the
+        same file share their pages rather than each building its own copy
+        """
+        hash_key, mask = np.load(join(directory, "meta.npy"))
+        if hash_key != cls.hash_key():
+            raise ValueError("Vocab in %s was saved by a process with a different hash seed" % directory)
+        out = cls.__new__(cls)
+        arrays = {name: np.load(join(directory, name + ".npy"), mmap_mode="r").view(np.ndarray)
+                  for name in cls._ARRAYS}
+        out._data = arrays["data"]
+        out._offsets = arrays["offsets"]
+        out._ids = arrays["ids"]
+        out._slot_hashes = arrays["slot_hashes"]
+        out._slot_ids = arrays["slot_ids"]
+        out._mask = int(mask)
+        out._collisions = np.load(join(directory, "collisions.npy"))
+        out._other_words = {out._word(i): int(out._ids[i]) for i in np.load(join(directory, "other_ix.npy"))}
+        return out
+
+    def _word(self, i) -> str:
+        return bytes(self._data[self._offsets[i]:self._offsets[i + 1]]).decode("utf-8")
+
+    def __getstate__(self):
+        return dict(data=bytes(self._data), offsets=np.array(self._offsets), ids=np.array(self._ids))
+
+    def __setstate__(self, state):
+        self._data = state["data"]
+        self._offsets = state["offsets"]
+        self._ids = state["ids"]
+        self._build_table([self._word(i) for i in range(len(self._offsets) - 1)])
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def get(self, word, default=None):
+        ix = self._lookup([word], -1)[0]
+        return default if ix == -1 else int(ix)
+
+    def _lookup(self, words: List[str], default: int) -> np.ndarray:
+        """ Exact look up of `words`, words that are not found get `default` """
+        hashes = np.fromiter(map(hash, words), dtype=np.int64, count=len(words))
+        out = np.full(len(words), default, dtype=np.int32)
+        pos = hashes & self._mask
+        todo = np.arange(len(words))
+        while len(todo) > 0:
+            probe = pos[todo]
+            ids = self._slot_ids[probe]
+            found = (self._slot_hashes[probe] == hashes[todo]) & (ids != -1)
+            out[todo[found]] = ids[found]
+            # Keep probing until we find the word or reach an empty slot
+            todo = todo[(ids != -1) & ~found]
+            pos[todo] = (pos[todo] + 1) & self._mask
+
+        if len(self._collisions) > 0:
+            for i in np.where(np.isin(hashes, self._collisions))[0]:
+                out[i] = self._other_words.get(words[i], default)
+        return out
+
+    def words_to_ix(self, words: Iterable[str], default: int=1) -> np.ndarray:
+        """
+        Map `words` to ids, words that are not in the vocab fall back to their lower-cased form,
+        and then to `default` if that is not found either
+        """
+        if not isinstance(words, list):
+            words = list(words)
+        ids = self._lookup(words, -1)
+        missing = np.where(ids == -1)[0]
+        if len(missing) > 0:
+            ids[missing] = self._lookup([words[i].lower() for i in missing], default)
+        return ids
@@ -6,6 +6,7 @@ from sklearn.metrics import pairwise_distances
 from docqa.utils import flatten_iterable
 
 from docqa.data_processing.text_utils import NltkPlusStopWords, ParagraphWithInverse
+from docqa.data_processing.tfidf_index import load_tfidf_index
 from docqa.configurable import Configurable
 from docqa.triviaqa.evidence_corpus import TriviaQaEvidenceCorpusTxt
 
@@ -55,6 +56,15 @@ class ParagraphFilter(Configurable):
     def prune(self, question, paragraphs: List[ExtractedParagraph]) -> List[ExtractedParagraph]:
         raise NotImplementedError()
 
+    def prune_many(self, questions: List[List[str]], paragraphs: List[List[ExtractedParagraph]],
+                   doc_ids: Optional[List]=None) -> List[List[ExtractedParagraph]]:
+        """
+        Prune the paragraphs for many (question, document) pairs, returns the same result as calling `prune` on each
+        pair. If given, pairs with the same `doc_ids` must have paragraphs with the same text (the paragraphs
+        can still have different answers), which subclasses can use to avoid re-processing documents
+        """
+        return [self.prune(q, p) for q, p in zip(questions, paragraphs)]
+
 
 class FirstN(ParagraphFilter):
     def __init__(self, n):
@@ -92,27 +102,37 @@ class ContainsQuestionWord(ParagraphFilter):
 
 
 class TopTfIdf(ParagraphFilter):
-    def __init__(self, stop, n_to_select: int, filter_dist_one: bool=False, rank=True):
+    def __init__(self, stop, n_to_select: int, filter_dist_one: bool=False, rank=True,
+                 index: Optional[str]=None):
+        """
+        :param index: Optional, file of a `TfIdfIndex` to score paragraphs with, if not given a new
+                      tf-idf vectorizer is fit on the candidate paragraphs of each question
+        """
         self.stop = stop
         self.rank = rank
         self.n_to_select = n_to_select
         self.filter_dist_one = filter_dist_one
+        self.index = index
 
-    def prune(self, question, paragraphs: List[ExtractedParagraph]):
-        if not self.filter_dist_one and len(paragraphs) == 1:
-            return paragraphs
-
-        tfidf = TfidfVectorizer(strip_accents="unicode", stop_words=self.stop.words)
+    def _get_dists(self, questions: List[List[str]], paragraphs: List[ExtractedParagraph]) -> Optional[np.ndarray]:
+        """ Returns a (n_questions, n_paragraphs) array of cosine distances, or None if there are no valid words """
         text = []
         for para in paragraphs:
             text.append(" ".join(" ".join(s) for s in para.text))
+
+        if self.index is not None:
+            return load_tfidf_index(self.index).cosine_distances_many(questions, text)
+
+        tfidf = TfidfVectorizer(strip_accents="unicode", stop_words=self.stop.words)
         try:
             para_features = tfidf.fit_transform(text)
-            q_features = tfidf.transform([" ".join(question)])
+            q_features = tfidf.transform([" ".join(q) for q in questions])
         except ValueError:
-            return []
+            return None
 
-        dists = pairwise_distances(q_features, para_features, "cosine").ravel()
+        return pairwise_distances(q_features, para_features, "cosine")
+
+    def _select(self, paragraphs: List[ExtractedParagraph], dists: np.ndarray):
         sorted_ix = np.lexsort(([x.start for x in paragraphs], dists))  # in case of ties, use the earlier paragraph
 
         if self.filter_dist_one:
@@ -120,18 +140,47 @@ class TopTfIdf(ParagraphFilter):
         else:
             return [paragraphs[i] for i in sorted_ix[:self.n_to_select]]
 
-    def dists(self, question, paragraphs: List[ExtractedParagraph]):
-        tfidf = TfidfVectorizer(strip_accents="unicode", stop_words=self.stop.words)
-        text = []
-        for para in paragraphs:
-            text.append(" ".join(" ".join(s) for s in para.text))
-        try:
-            para_features = tfidf.fit_transform(text)
-            q_features = tfidf.transform([" ".join(question)])
-        except ValueError:
+    def prune(self, question, paragraphs: List[ExtractedParagraph]):
+        if not self.filter_dist_one and len(paragraphs) == 1:
+            return paragraphs
+
+        dists = self._get_dists([question], paragraphs)
+        if dists is None:
             return []
+        return self._select(paragraphs, dists[0])
 
-        dists = pairwise_distances(q_features, para_features, "cosine").ravel()
+    def prune_many(self, questions: List[List[str]], paragraphs: List[List[ExtractedParagraph]],
+                   doc_ids: Optional[List]=None) -> List[List[ExtractedParagraph]]:
+        """
+        Vectorizes the paragraphs of each distinct document once and scores all the questions
+        that use that document with a single matrix product
+        """
+        if doc_ids is None:
+            doc_ids = [id(x) for x in paragraphs]
+        by_doc = {}
+        for i, doc_id in enumerate(doc_ids):
+            if doc_id in by_doc:
+                by_doc[doc_id].append(i)
+            else:
+                by_doc[doc_id] = [i]
+
+        out = [None] * len(questions)
+        for ixs in by_doc.values():
+            doc_paragraphs = paragraphs[ixs[0]]
+            if not self.filter_dist_one and len(doc_paragraphs) == 1:
+                for i in ixs:
+                    out[i] = paragraphs[i]
+                continue
+            dists = self._get_dists([questions[i] for i in ixs], doc_paragraphs)
+            for row, i in enumerate(ixs):
+                out[i] = [] if dists is None else self._select(paragraphs[i], dists[row])
+        return out
+
+    def dists(self, question, paragraphs: List[ExtractedParagraph]):
+        dists = self._get_dists([question], paragraphs)
+        if dists is None:
+            return []
+        dists = dists[0]
         sorted_ix = np.lexsort(([x.start for x in paragraphs], dists))  # in case of ties, use the earlier paragraph
 
         if self.filter_dist_one:
@@ -139,6 +188,11 @@ class TopTfIdf(ParagraphFilter):
         else:
             return [(paragraphs[i], dists[i]) for i in sorted_ix[:self.n_to_select]]
 
+    def __setstate__(self, state):
+        if "index" not in state:
+            state["index"] = None
+        super().__setstate__(state)
+
 
 class ShallowOpenWebRanker(ParagraphFilter):
     # Hard coded weight learned from a logistic regression classifier
@@ -148,8 +202,13 @@ class ShallowOpenWebRanker(ParagraphFilter):
     LOWER_WORD_W = 0.0499123
     WORD_W = -0.15537181
 
-    def __init__(self, n_to_select):
+    def __init__(self, n_to_select, index: Optional[str]=None):
+        """
+        :param index: Optional, file of a `TfIdfIndex` to score paragraphs with, if not given a new
+                      tf-idf vectorizer is fit on the candidate paragraphs of each question
+        """
         self.n_to_select = n_to_select
+        self.index = index
         self._stop = NltkPlusStopWords(True).words
         self._tfidf = TfidfVectorizer(strip_accents="unicode", stop_words=self._stop)
 
@@ -162,15 +221,18 @@ class ShallowOpenWebRanker(ParagraphFilter):
         return ["Score"]
 
     def score_paragraphs(self, question, paragraphs: List[ExtractedParagraphWithAnswers]):
-        tfidf = self._tfidf
         text = []
         for para in paragraphs:
             text.append(" ".join(" ".join(s) for s in para.text))
-        try:
-            para_features = tfidf.fit_transform(text)
-            q_features = tfidf.transform([" ".join(question)])
-        except ValueError:
-            return []
+        if self.index is not None:
+            tfidf = load_tfidf_index(self.index).cosine_distances(question, text)
+        else:
+            try:
+                para_features = self._tfidf.fit_transform(text)
+                q_features = self._tfidf.transform([" ".join(question)])
+            except ValueError:
+                return []
+            tfidf = pairwise_distances(q_features, para_features, "cosine").ravel()
 
         q_words = {x for x in question if x.lower() not in self._stop}
         q_words_lower = {x.lower() for x in q_words}
@@ -187,7 +249,6 @@ class ShallowOpenWebRanker(ParagraphFilter):
             word_matches_features[para_ix, 0] = len(found)
             word_matches_features[para_ix, 1] = len(found_lower)
 
-        tfidf = pairwise_distances(q_features, para_features, "cosine").ravel()
         starts = np.array([p.start for p in paragraphs])
         log_word_start = np.log(starts/400.0 + 1)
         first = starts == 0
@@ -202,10 +263,19 @@ class ShallowOpenWebRanker(ParagraphFilter):
         return [paragraphs[i] for i in sorted_ix[:self.n_to_select]]
 
     def __getstate__(self):
-        return dict(n_to_select=self.n_to_select)
+        return dict(n_to_select=self.n_to_select, index=self.index)
 
     def __setstate__(self, state):
-        return self.__init__(state['n_to_select'])
+        return self.__init__(state['n_to_select'], state.get('index'))
+
+
+def annotate_paragraphs(paragraphs: List[ExtractedParagraph], spans: np.ndarray) -> List[ExtractedParagraphWithAnswers]:
+    """ Add the answer spans that are contained in each paragraph """
+    out = []
+    for para in paragraphs:
+        para_spans = spans[np.logical_and(spans[:, 0] >= para.start, spans[:, 1] < para.end)] - para.start
+        out.append(ExtractedParagraphWithAnswers(para.text, para.start, para.end, para_spans))
+    return out
 
 
 class DocumentSplitter(Configurable):
@@ -231,11 +301,28 @@ class DocumentSplitter(Configurable):
         """
         Split a document and additionally splits answer_span of each paragraph
         """
-        out = []
-        for para in self.split(doc):
-            para_spans = spans[np.logical_and(spans[:, 0] >= para.start, spans[:, 1] < para.end)] - para.start
-            out.append(ExtractedParagraphWithAnswers(para.text, para.start, para.end, para_spans))
-        return out
+        return annotate_paragraphs(self.split(doc), spans)
+
+    def load_split(self, evidence, doc_id) -> Optional[List[ExtractedParagraph]]:
+        """
+        Load and split document `doc_id` from `evidence` without any answers, returns None if the
+        document was not found. The result can be annotated with `annotate_paragraphs`
+        """
+        text = evidence.get_document(doc_id, n_tokens=self.reads_first_n)
+        if text is None:
+            return None
+        return self.split(text)
+
+    def split_document(self, evidence, doc_id, spans: Optional[np.ndarray]) -> Optional[List[ExtractedParagraphWithAnswers]]:
+        """
+        Load and split document `doc_id` from `evidence`, returns None if the document was not found
+        """
+        paragraphs = self.load_split(evidence, doc_id)
+        if paragraphs is None:
+            return None
+        if spans is None:
+            spans = np.zeros((0, 2), dtype=np.int32)
+        return annotate_paragraphs(paragraphs, spans)
 
     def split_inverse(self, paras: List[ParagraphWithInverse], delim="\n") -> List[ParagraphWithInverse]:
         """
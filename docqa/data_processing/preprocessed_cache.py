@@ -0,0 +1,314 @@
+import json
+import pickle
+from collections.abc import Sequence
+from os import makedirs
+from os.path import join, exists
+from typing import List, Dict, Optional, Iterable, Union
+
+import numpy as np
+
+from docqa.data_processing.multi_paragraph_qa import MultiParagraphQuestion, DocumentParagraph
+from docqa.data_processing.preprocessed_corpus import FilteredData
+from docqa.data_processing.span_data import TokenSpans
+from docqa.data_processing.token_ids import WordTable, TokenIds
+from docqa.triviaqa.training_data import DocumentParagraphQuestion
+
+"""
+Columnar on-disk format for preprocessed data, used by `PreprocessedData.cache_preprocess` as an
+alternative to pickling everything. Each split is stored in its own directory as flat arrays:
+
+questions.bin: int32 question token ids, question_offsets.bin: int64 start of each question in questions.bin
+question_paragraphs.bin: int64 start of each question's paragraphs
+tokens.bin: int32 paragraph token ids, token_offsets.bin: int64 start of each paragraph in tokens.bin
+paragraphs.bin: int32 (doc_ix, start, end, rank) of each paragraph
+spans.bin: int32 (start, end) answer spans, span_offsets.bin: int64 start of each paragraph's spans
+strings.json: question ids, answer texts, and document ids
+
+Each offset array ends with the total size so element i always spans [offsets[i], offsets[i+1]).
+Token ids index into a words.json table shared by all the splits. Splits can be loaded independently,
+and since the arrays are memory-mapped questions can be streamed or randomly accessed without
+reading the entire split.
+"""
+
+_OFFSET_COLUMNS = ["question_offsets", "question_paragraphs", "token_offsets", "span_offsets"]
+
+
+def _get_ids(tokens, table: WordTable) -> np.ndarray:
+    if isinstance(tokens, TokenIds) and tokens.table is table:
+        return tokens.ids
+    return table.add(tokens)
+
+
+class _SplitWriter(object):
+    """ Writes a split in chunks, so we don't need to build column-sized arrays in memory """
+
+    def __init__(self, output_dir: str, table: WordTable):
+        if not exists(output_dir):
+            makedirs(output_dir)
+        self.output_dir = output_dir
+        self.table = table
+        self.kind = None
+        self.true_len = 0
+        self.question_ids, self.answer_text, self.doc_ids = [], [], {}
+        self.n_question_tokens, self.n_paragraphs, self.n_tokens, self.n_spans = 0, 0, 0, 0
+        self.names = ["questions", "tokens", "paragraphs", "spans"] + _OFFSET_COLUMNS
+        self.files = {name: open(join(output_dir, name + ".bin"), "wb") for name in self.names}
+
+    def _get_kind(self, point):
+        if isinstance(point, MultiParagraphQuestion):
+            return "multi_paragraph"
+        elif isinstance(point, DocumentParagraphQuestion):
+            return "document_paragraph"
+        else:
+            raise ValueError("Can't store preprocessed elements of type %s" % type(point).__name__)
+
+    def add(self, data: FilteredData):
+        self.true_len += data.true_len
+        table = self.table
+        columns = {name: [] for name in self.names}
+        for point in data.data:
+            kind = self._get_kind(point)
+            if self.kind is None:
+                self.kind = kind
+            elif kind != self.kind:
+                raise ValueError("Can't mix elements of type %s and %s" % (kind, self.kind))
+            if kind == "multi_paragraph":
+                paragraphs = point.paragraphs
+                if any(type(p) != DocumentParagraph for p in paragraphs):
+                    raise ValueError("Can only store `DocumentParagraph` paragraphs")
+                paragraphs = [(p.doc_id, p.start, p.end, p.rank, p.answer_spans, p.text) for p in paragraphs]
+                answer = point.answer_text
+            else:
+                if not isinstance(point.answer, TokenSpans):
+                    raise ValueError("Can only store `DocumentParagraphQuestion`s with `TokenSpans` answers")
+                paragraphs = [(point.doc_id, point.para_range[0], point.para_range[1], point.rank,
+                               point.answer.answer_spans, point.context)]
+                answer = point.answer.answer_text
+
+            self.question_ids.append(point.question_id)
+            self.answer_text.append(None if answer is None else list(answer))
+            columns["question_offsets"].append(self.n_question_tokens)
+            question = _get_ids(point.question, table)
+            columns["questions"].append(question)
+            self.n_question_tokens += len(question)
+            columns["question_paragraphs"].append(self.n_paragraphs)
+            for doc_id, start, end, rank, spans, text in paragraphs:
+                columns["paragraphs"].append((self.doc_ids.setdefault(doc_id, len(self.doc_ids)),
+                                              start, end, -1 if rank is None else rank))
+                columns["token_offsets"].append(self.n_tokens)
+                text = _get_ids(text, table)
+                columns["tokens"].append(text)
+                self.n_tokens += len(text)
+                columns["span_offsets"].append(self.n_spans)
+                if spans is not None and len(spans) > 0:
+                    columns["spans"].append(np.asarray(spans).reshape(-1, 2))
+                    self.n_spans += len(columns["spans"][-1])
+                self.n_paragraphs += 1
+
+        files = self.files
+        for name, dtype in [("questions", np.int32), ("tokens", np.int32), ("spans", np.int32)]:
+            if len(columns[name]) > 0:
+                np.concatenate(columns[name]).astype(dtype).tofile(files[name])
+        np.array(columns["paragraphs"], dtype=np.int32).reshape(-1, 4).tofile(files["paragraphs"])
+        for name in _OFFSET_COLUMNS:
+            np.array(columns[name], dtype=np.int64).tofile(files[name])
+
+    def close(self) -> Dict:
+        try:
+            for name, end in zip(_OFFSET_COLUMNS, [self.n_question_tokens, self.n_paragraphs,
+                                                   self.n_tokens, self.n_spans]):
+                np.array([end], dtype=np.int64).tofile(self.files[name])
+        finally:
+            for f in self.files.values():
+                f.close()
+        with open(join(self.output_dir, "strings.json"), "w") as f:
+            json.dump(dict(question_ids=self.question_ids, answer_text=self.answer_text,
+                           doc_ids=list(self.doc_ids)), f)
+        return dict(kind="multi_paragraph" if self.kind is None else self.kind, true_len=self.true_len,
+                    n_questions=len(self.question_ids), n_question_tokens=self.n_question_tokens,
+                    n_paragraphs=self.n_paragraphs, n_tokens=self.n_tokens, n_spans=self.n_spans)
+
+
+def _write_split(output_dir: str, chunks: Iterable[FilteredData], table: WordTable) -> Dict:
+    writer = _SplitWriter(output_dir, table)
+    try:
+        for chunk in chunks:
+            writer.add(chunk)
+    finally:
+        meta = writer.close()
+    return meta
+
+
+def _chunk(data: FilteredData, chunk_size: int) -> Iterable[FilteredData]:
+    points = data.data
+    for start in range(0, max(len(points), 1), chunk_size):
+        yield FilteredData(points[start:start+chunk_size], data.true_len if start == 0 else 0)
+
+
+def write_preprocessed_cache(output_dir: str, preprocessor,
+                             splits: Dict[str, Union[None, FilteredData, Iterable[FilteredData]]],
+                             chunk_size: int=1000):
+    """
+    Save `splits` to `output_dir`. `splits` maps names to `FilteredData` of `MultiParagraphQuestion` or
+    `DocumentParagraphQuestion`, or to an iterable of such `FilteredData` chunks (such as the output of
+    `preprocess_par_iter`) which will be written as they are generated. If the text is
+    already `TokenIds` their `WordTable` will be re-used.
+    """
+    if not exists(output_dir):
+        makedirs(output_dir)
+    table = next((x.question.table for data in splits.values() if isinstance(data, FilteredData)
+                  for x in data.data[:1] if isinstance(x.question, TokenIds)), None)
+    if table is None:
+        table = WordTable()
+    meta = {}
+    for name, data in splits.items():
+        if data is not None:
+            if isinstance(data, FilteredData):
+                data = _chunk(data, chunk_size)
+            meta[name] = _write_split(join(output_dir, name), data, table)
+    with open(join(output_dir, "words.json"), "w") as f:
+        json.dump(table.words, f)
+    with open(join(output_dir, "preprocessor.pkl"), "wb") as f:
+        pickle.dump(preprocessor, f)
+    # Written last, so an incomplete cache won't be loaded
+    with open(join(output_dir, "metadata.json"), "w") as f:
+        json.dump(dict(splits=meta), f)
+
+
+class PreprocessedSplit(Sequence):
+    """
+    Lazily loaded split of a preprocessed cache, elements are built from the memory-mapped
+    arrays when accessed. Iterating reads the arrays in sequential chunks.
+    """
+
+    def __init__(self, directory: str, meta: Dict, words: List[str], table: Optional[WordTable]=None,
+                 chunk_size: int=1000):
+        self.directory = directory
+        self.kind = meta["kind"]
+        self.true_len = meta["true_len"]
+        self.table = table
+        self.chunk_size = chunk_size
+        self._words = words
+        self._n_questions = meta["n_questions"]
+        self._arrays = {}
+        for name, dtype, shape in [("questions", np.int32, (meta["n_question_tokens"], )),
+                                   ("tokens", np.int32, (meta["n_tokens"], )),
+                                   ("paragraphs", np.int32, (meta["n_paragraphs"], 4)),
+                                   ("spans", np.int32, (meta["n_spans"], 2)),
+                                   ("question_offsets", np.int64, (self._n_questions + 1, )),
+                                   ("question_paragraphs", np.int64, (self._n_questions + 1, )),
+                                   ("token_offsets", np.int64, (meta["n_paragraphs"] + 1, )),
+                                   ("span_offsets", np.int64, (meta["n_paragraphs"] + 1, ))]:
+            if shape[0] == 0:
+                self._arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                # Use plain ndarray views, slicing `np.memmap` objects is much slower
+                self._arrays[name] = np.memmap(join(directory, name + ".bin"), dtype=dtype, mode="r",
+                                               shape=shape).view(np.ndarray)
+        with open(join(directory, "strings.json"), "r") as f:
+            strings = json.load(f)
+        self._question_ids = strings["question_ids"]
+        self._answer_text = strings["answer_text"]
+        self._doc_ids = strings["doc_ids"]
+
+    def __len__(self):
+        return self._n_questions
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(self._n_questions))]
+        if item < 0:
+            item += self._n_questions
+        if item < 0 or item >= self._n_questions:
+            raise IndexError(item)
+        return next(self._build(item, item + 1))
+
+    def __iter__(self):
+        for start in range(0, self._n_questions, self.chunk_size):
+            yield from self._build(start, min(start + self.chunk_size, self._n_questions))
+
+    def _tokens(self, ids: np.ndarray):
+        words = self._words
+        text = [words[i] for i in ids.tolist()]
+        if self.table is not None:
+            return TokenIds(text, self.table, np.array(ids))
+        return text
+
+    def _build(self, start: int, end: int):
+        """ Build questions start to end, reading the rows they need into memory once per column """
+        arrays = self._arrays
+        question_offsets = arrays["question_offsets"][start:end+1].tolist()
+        question_paragraphs = arrays["question_paragraphs"][start:end+1].tolist()
+        para_start, para_end = question_paragraphs[0], question_paragraphs[-1]
+        token_offsets = arrays["token_offsets"][para_start:para_end+1].tolist()
+        span_offsets = arrays["span_offsets"][para_start:para_end+1].tolist()
+        questions = np.array(arrays["questions"][question_offsets[0]:question_offsets[-1]])
+        tokens = np.array(arrays["tokens"][token_offsets[0]:token_offsets[-1]])
+        spans = np.array(arrays["spans"][span_offsets[0]:span_offsets[-1]])
+        paragraphs = arrays["paragraphs"][para_start:para_end].tolist()
+
+        doc_ids = self._doc_ids
+        for i in range(end - start):
+            q_ix = start + i
+            q_base = question_offsets[0]
+            question = self._tokens(questions[question_offsets[i] - q_base:question_offsets[i+1] - q_base])
+            answer_text = self._answer_text[q_ix]
+            paras = []
+            for j in range(question_paragraphs[i] - para_start, question_paragraphs[i+1] - para_start):
+                doc_ix, para_start_token, para_end_token, rank = paragraphs[j]
+                text = self._tokens(tokens[token_offsets[j] - token_offsets[0]:token_offsets[j+1] - token_offsets[0]])
+                answer_spans = spans[span_offsets[j] - span_offsets[0]:span_offsets[j+1] - span_offsets[0]]
+                paras.append((doc_ids[doc_ix], para_start_token, para_end_token,
+                              None if rank == -1 else rank, answer_spans, text))
+
+            if self.kind == "multi_paragraph":
+                yield MultiParagraphQuestion(self._question_ids[q_ix], question, answer_text,
+                                             [DocumentParagraph(*p) for p in paras])
+            else:
+                doc_id, para_start_token, para_end_token, rank, answer_spans, text = paras[0]
+                yield DocumentParagraphQuestion(self._question_ids[q_ix], doc_id, (para_start_token, para_end_token),
+                                                question, text, TokenSpans(answer_text, answer_spans), rank)
+
+
+class PreprocessedCache(object):
+    """ Reads a cache written by `write_preprocessed_cache` """
+
+    def __init__(self, directory: str, token_ids: bool=False):
+        """
+        :param token_ids: Return text as `TokenIds` that share a `WordTable` built from the stored words
+        """
+        self.directory = directory
+        with open(join(directory, "metadata.json"), "r") as f:
+            self._meta = json.load(f)["splits"]
+        with open(join(directory, "words.json"), "r") as f:
+            self.words = json.load(f)
+        self.table = WordTable(self.words) if token_ids else None
+
+    @property
+    def split_names(self) -> List[str]:
+        return list(self._meta)
+
+    def get_preprocessor(self):
+        with open(join(self.directory, "preprocessor.pkl"), "rb") as f:
+            return pickle.load(f)
+
+    def get_split(self, name: str) -> Optional[PreprocessedSplit]:
+        """ Returns a lazily loaded split, or None if `name` was not stored """
+        if name not in self._meta:
+            return None
+        return PreprocessedSplit(join(self.directory, name), self._meta[name], self.words, self.table)
+
+    def load_split(self, name: str) -> Optional[FilteredData]:
+        """ Read an entire split into memory """
+        split = self.get_split(name)
+        if split is None:
+            return None
+        return FilteredData(list(split), split.true_len)
+
+
+def load_preprocessed_cache(directory: str, splits: Optional[Iterable[str]]=None,
+                            token_ids: bool=False) -> Dict[str, Optional[FilteredData]]:
+    cache = PreprocessedCache(directory, token_ids)
+    if splits is None:
+        splits = cache.split_names
+    return {name: cache.load_split(name) for name in splits}
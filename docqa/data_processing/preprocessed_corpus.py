@@ -1,12 +1,15 @@
 import gzip
 import pickle
-from collections import Counter
-from threading import Lock
+from collections import Counter, deque
+from itertools import islice
+from queue import Queue
+from os.path import isdir
 from typing import List, Dict, Iterable, Tuple, Optional
 
 import numpy as np
 from docqa.dataset import TrainingData, Dataset
 from tqdm import tqdm
+from docqa.data_processing.token_ids import WordTable, TokenIds, add_token_ids
 from docqa.utils import split, flatten_iterable, group, ResourceLoader
 
 from docqa.configurable import Configurable
@@ -62,12 +65,101 @@ def _preprocess_and_count(questions: List, evidence, preprocessor: Preprocessor)
     return output, count
 
 
-def preprocess_par(questions: List, evidence, preprocessor,
-                   n_processes=2, chunk_size=200, name=None):
+# Set in each worker process by `_init_worker`, so the questions, evidence and preprocessor
+# are sent to each worker once instead of being pickled into every chunk
+_worker_state = None
+
+
+def _init_worker(questions: List, evidence, preprocessor: Preprocessor):
+    global _worker_state
+    _worker_state = (questions, evidence, preprocessor)
+
+
+def _preprocess_range(chunk_range: Tuple[int, int]):
+    questions, evidence, preprocessor = _worker_state
+    start, end = chunk_range
+    return _preprocess_and_count(questions[start:end], evidence, preprocessor)
+
+
+def _check_par_args(chunk_size, n_processes):
     if chunk_size <= 0:
         raise ValueError("Chunk size must be >= 0, but got %s" % chunk_size)
     if n_processes is not None and n_processes <= 0:
         raise ValueError("n_processes must be >= 1 or None, but got %s" % n_processes)
+
+
+def _get_chunk_ranges(n_questions: int, n_processes, chunk_size) -> List[Tuple[int, int]]:
+    chunks = split(list(range(n_questions)), n_processes)
+    return [(c[0], c[-1] + 1) for c in flatten_iterable([group(c, chunk_size) for c in chunks])]
+
+
+def preprocess_par_iter(questions: List, evidence, preprocessor,
+                        n_processes=2, chunk_size=200, name=None, ordered=True) -> Iterable:
+    """
+    Streaming version of `preprocess_par`, yields the (finalized) output of each chunk as soon as it is
+    complete so it can be consumed, or written to disk, while the remaining chunks are processed. If `ordered`
+    chunks are yielded in order, otherwise they are yielded in the order they finish.
+
+    The questions, evidence and preprocessor are installed in each worker when the pool starts (which
+    does not require pickling them if processes are forked), and the tasks only contain the
+    index range of the questions to process.
+
+    At most `2 * n_processes` chunks are submitted to the pool at once, counting chunks that are
+    finished but not yet yielded, so if the consumer is slower than the workers at most that many
+    chunks of output are held in memory.
+    """
+    _check_par_args(chunk_size, n_processes)
+    n_processes = max(min(len(questions), n_processes), 1)
+    chunks = _get_chunk_ranges(len(questions), n_processes, chunk_size)
+    pbar = tqdm(total=len(questions), desc=name, ncols=80)
+    if n_processes == 1:
+        for start, end in chunks:
+            out = preprocessor.preprocess(questions[start:end], evidence)
+            preprocessor.finalize_chunk(out)
+            pbar.update(end - start)
+            yield out
+    else:
+        from multiprocessing import Pool
+        print("Processing %d chunks with %d processes" % (len(chunks), n_processes))
+        max_pending = n_processes * 2
+        chunk_iter = iter(chunks)
+        with Pool(n_processes, initializer=_init_worker, initargs=(questions, evidence, preprocessor)) as pool:
+            if ordered:
+                pending = deque(pool.apply_async(_preprocess_range, (c, )) for c in islice(chunk_iter, max_pending))
+                while len(pending) > 0:
+                    out, count = pending.popleft().get()
+                    # Submit the next chunk before yielding, so the workers stay busy while the consumer runs
+                    chunk = next(chunk_iter, None)
+                    if chunk is not None:
+                        pending.append(pool.apply_async(_preprocess_range, (chunk, )))
+                    preprocessor.finalize_chunk(out)
+                    pbar.update(count)
+                    yield out
+            else:
+                done = Queue()  # Results or errors, in the order the chunks finish
+                n_pending = 0
+                for chunk in islice(chunk_iter, max_pending):
+                    pool.apply_async(_preprocess_range, (chunk, ), callback=done.put, error_callback=done.put)
+                    n_pending += 1
+                while n_pending > 0:
+                    result = done.get()
+                    n_pending -= 1
+                    if isinstance(result, BaseException):
+                        raise result
+                    chunk = next(chunk_iter, None)
+                    if chunk is not None:
+                        pool.apply_async(_preprocess_range, (chunk, ), callback=done.put, error_callback=done.put)
+                        n_pending += 1
+                    out, count = result
+                    preprocessor.finalize_chunk(out)
+                    pbar.update(count)
+                    yield out
+    pbar.close()
+
+
+def preprocess_par(questions: List, evidence, preprocessor,
+                   n_processes=2, chunk_size=200, name=None):
+    _check_par_args(chunk_size, n_processes)
     n_processes = min(len(questions), n_processes)
 
     if n_processes == 1:
@@ -75,27 +167,16 @@ def preprocess_par(questions: List, evidence, preprocessor,
         preprocessor.finalize_chunk(out)
         return out
     else:
-        from multiprocessing import Pool
-        chunks = split(questions, n_processes)
-        chunks = flatten_iterable([group(c, chunk_size) for c in chunks])
-        print("Processing %d chunks with %d processes" % (len(chunks), n_processes))
-        pbar = tqdm(total=len(questions), desc=name, ncols=80)
-        lock = Lock()
-
-        def call_back(results):
-            preprocessor.finalize_chunk(results[0])
-            with lock:  # FIXME Even with the lock, the progress bar still is jumping around
-                pbar.update(results[1])
-
-        with Pool(n_processes) as pool:
-            results = [pool.apply_async(_preprocess_and_count, [c, evidence, preprocessor], callback=call_back)
-                       for c in chunks]
-            results = [r.get()[0] for r in results]
-
-        pbar.close()
-        output = results[0]
-        for r in results[1:]:
-            output += r
+        output = None
+        for out in preprocess_par_iter(questions, evidence, preprocessor, n_processes, chunk_size, name):
+            if output is None:
+                output = out
+            elif isinstance(output, FilteredData):
+                # Extend in-place, rather than using `+` and copying the data for each chunk
+                output.data += out.data
+                output.true_len += out.true_len
+            else:
+                output += out
         return output
 
 
@@ -114,8 +195,14 @@ class PreprocessedData(TrainingData):
                  eval_on_train: bool = True,
                  hold_out_train: Optional[Tuple[int, int]]= None,
                  sample=None, sample_dev=None,
-                 sample_preprocessed_train=None, sample_seed=None):
+                 sample_preprocessed_train=None, sample_seed=None,
+                 token_ids: bool=False):
+        """
+        :param token_ids: Store the preprocessed text as `TokenIds`, so the model's encoder only has to look up
+                          each distinct word once. These are also saved by `cache_preprocess`
+        """
         self.hold_out_train = hold_out_train
+        self.token_ids = token_ids
         self.eval_on_train = eval_on_train
         self.sample = sample
         self.eval_on_verified = eval_on_verified
@@ -135,9 +222,18 @@ class PreprocessedData(TrainingData):
     def name(self):
         return self.corpus.name
 
-    def cache_preprocess(self, filename):
+    def cache_preprocess(self, filename, columnar: bool=False):
+        """
+        Pickle the preprocessed data to `filename`, or if `columnar` is set or `filename` is an existing
+        directory, save it to that directory in the columnar format of `preprocessed_cache`
+        """
         if self.sample is not None or self.sample_dev is not None or self.hold_out_train is not None:
             raise ValueError()
+        if columnar or isdir(filename):
+            from docqa.data_processing.preprocessed_cache import write_preprocessed_cache
+            write_preprocessed_cache(filename, self.preprocesser, dict(
+                train=self._train, dev=self._dev, verified_dev=self._verified_dev))
+            return
         if filename.endswith("gz"):
             handle = lambda a,b: gzip.open(a, b, compresslevel=3)
         else:
@@ -145,26 +241,77 @@ class PreprocessedData(TrainingData):
         with handle(filename, "wb") as f:
             pickle.dump([self.preprocesser, self._train, self._dev, self._verified_dev], f)
 
-    def load_preprocess(self, filename):
+    def load_preprocess(self, filename, splits: Optional[List[str]]=None):
+        """
+        :param splits: Names of the splits to load ("train", "dev" or "verified_dev"), the others will be
+                       left as None. For columnar caches, only the data for these splits will be read
+        """
         print("Loading preprocessed data...")
-        if filename.endswith("gz"):
-            handle = gzip.open
+        if isdir(filename):  # Saved in the columnar format
+            from docqa.data_processing.preprocessed_cache import PreprocessedCache
+            cache = PreprocessedCache(filename, self.token_ids)
+            if cache.get_preprocessor().get_config() != self.preprocesser.get_config():
+                raise ValueError("Cached data was built with a different preprocessor")
+            if splits is None:
+                splits = ["train", "dev", "verified_dev"]
+            self._train, self._dev, self._verified_dev = [
+                cache.load_split(name) if name in splits else None for name in ["train", "dev", "verified_dev"]]
         else:
-            handle = open
-        with handle(filename, "rb") as f:
-            stored = pickle.load(f)
-            stored_preprocesser, self._train, self._dev, self._verified_dev = stored
-        if stored_preprocesser.get_config() != self.preprocesser.get_config():
-            # print("WARNING")
-            import code
-            code.interact(local=locals())
-            raise ValueError()
+            if filename.endswith("gz"):
+                handle = gzip.open
+            else:
+                handle = open
+            with handle(filename, "rb") as f:
+                stored = pickle.load(f)
+                stored_preprocesser, self._train, self._dev, self._verified_dev = stored
+            if stored_preprocesser.get_config() != self.preprocesser.get_config():
+                # print("WARNING")
+                import code
+                code.interact(local=locals())
+                raise ValueError()
+            if splits is not None:
+                self._train, self._dev, self._verified_dev = [
+                    data if name in splits else None for name, data in
+                    zip(["train", "dev", "verified_dev"], [self._train, self._dev, self._verified_dev])]
+        if self.token_ids:
+            self._add_token_ids()
 
         print("done")
 
-    def preprocess(self, n_processes=1, chunk_size=500):
-        if self._train is not None:
-            return
+    def preprocess_to_cache(self, directory, n_processes=1, chunk_size=500):
+        """
+        Preprocess the data and write it to `directory` in the columnar format of `preprocessed_cache`
+        as chunks are completed, so the preprocessed data is never all held in memory. The data can then be
+        loaded with `load_preprocess`
+        """
+        if self.sample is not None or self.sample_dev is not None or self.hold_out_train is not None \
+                or self.sample_preprocessed_train is not None or self.preprocesser is None:
+            raise ValueError()
+        from docqa.data_processing.preprocessed_cache import write_preprocessed_cache
+        train_questions, dev_questions, verified_questions = self._get_questions(None)
+        splits = {}
+        for name, questions in [("verified_dev", verified_questions), ("dev", dev_questions),
+                                ("train", train_questions)]:
+            if questions is not None:
+                # Generators, so each split is preprocessed as it is written
+                splits[name] = preprocess_par_iter(questions, self.corpus.evidence, self.preprocesser,
+                                                   n_processes, chunk_size, name)
+        write_preprocessed_cache(directory, self.preprocesser, splits)
+
+    def _add_token_ids(self):
+        datasets = [x.data if isinstance(x, FilteredData) else x
+                    for x in [self._train, self._dev, self._verified_dev] if x is not None]
+        # Re-use the table from the cached data, if there is one
+        table = next((x.question.table for data in datasets for x in data[:1]
+                      if isinstance(getattr(x, "question", None), TokenIds)), None)
+        if table is None:
+            table = WordTable()
+        for data in datasets:
+            add_token_ids(data, table)
+        print("Mapped the text to %d distinct words" % len(table))
+
+    def _get_questions(self, rng):
+        """ Returns the (possibly sampled) train, dev, and verified questions """
         print("Loading data...")
         train_questions = self.corpus.get_train()
         if self.hold_out_train is not None:
@@ -184,8 +331,6 @@ class PreprocessedData(TrainingData):
         else:
             verified_questions = None
 
-        rng = np.random.RandomState(self.sample_seed)
-
         if self.sample is not None:
             l = len(train_questions)
             train_questions = rng.choice(train_questions, self.sample, replace=False)
@@ -194,6 +339,13 @@ class PreprocessedData(TrainingData):
             l = len(dev_questions)
             dev_questions = np.random.RandomState(self.sample_seed).choice(dev_questions, self.sample_dev, replace=False)
             print("Sampled %d of %d (%.4f) dev questions" % (len(dev_questions), l, len(dev_questions) / l))
+        return train_questions, dev_questions, verified_questions
+
+    def preprocess(self, n_processes=1, chunk_size=500):
+        if self._train is not None:
+            return
+        rng = np.random.RandomState(self.sample_seed)
+        train_questions, dev_questions, verified_questions = self._get_questions(rng)
 
         if self.preprocesser:
             print("Preprocessing with %d processes..." % n_processes)
@@ -221,6 +373,8 @@ class PreprocessedData(TrainingData):
                 self._train = rng.choice(self._train, self.sample_preprocessed_train, False)
                 print("Sampled %d of %d q-c pairs" % (len(self._train), l))
 
+        if self.token_ids:
+            self._add_token_ids()
         print("Done")
 
     def get_train(self) -> Dataset:
@@ -246,6 +400,8 @@ class PreprocessedData(TrainingData):
             state["sample_seed"] = None
         if "sample_preprocessed_train" not in state:
             state["sample_preprocessed_train"] = None
+        if "token_ids" not in state:
+            state["token_ids"] = False
         self.__dict__ = state
 
     def __getstate__(self):
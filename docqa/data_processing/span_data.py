@@ -1,4 +1,5 @@
-from typing import List
+from bisect import bisect_left
+from typing import List, Optional
 
 import numpy as np
 
@@ -75,6 +76,64 @@ def get_best_span_bounded(word_start_probs, word_end_probs, bound):
     return best_word_span, max_val
 
 
+def _merge_windows(val, ix, offset):
+    """ Combine the max of windows ending at each token with those ending `offset` tokens earlier """
+    prev_val = np.full_like(val, -np.inf)
+    prev_val[:, offset:] = val[:, :-offset]
+    prev_ix = np.zeros_like(ix)
+    prev_ix[:, offset:] = ix[:, :-offset]
+    take_prev = prev_val >= val
+    return np.where(take_prev, prev_val, val), np.where(take_prev, prev_ix, ix)
+
+
+def get_best_span_batch(start_probs, end_probs, bound: Optional[int]=None, mask=None):
+    """
+    Batched version of `get_best_span` (if `bound` is None) or `get_best_span_bounded` for [batch, n_tokens]
+    arrays of start and end probabilities. `mask` is an optional [batch, n_tokens] boolean array of the tokens
+    that can be part of a span. Returns a [batch, 2] array of inclusive spans and a [batch] array of their scores,
+    rows without any valid tokens get the span (-1, -1) and a score of -1
+    """
+    start_probs = np.asarray(start_probs)
+    end_probs = np.asarray(end_probs)
+    batch_size, n_tokens = start_probs.shape
+    if mask is None:
+        mask = np.ones((batch_size, n_tokens), dtype=np.bool_)
+    masked_start = np.where(mask, start_probs, -np.inf)
+
+    if bound is None or bound >= n_tokens:
+        # Running max of the start probabilities, where the start index is updated only if the max increases
+        start_val = np.maximum.accumulate(masked_start, axis=1)
+        prev_val = np.full_like(start_val, -np.inf)
+        prev_val[:, 1:] = start_val[:, :-1]
+        is_new_max = masked_start > prev_val
+        start_ix = np.maximum.accumulate(np.where(is_new_max, np.arange(n_tokens), 0), axis=1)
+    else:
+        # Sliding window max over the last `bound` start probabilities, computed by doubling the window size.
+        # Ties go to the window on the left so we select the earliest start, like `get_best_span_bounded`
+        start_val = masked_start
+        start_ix = np.tile(np.arange(n_tokens), (batch_size, 1))
+        window = 1
+        while window * 2 <= bound:
+            start_val, start_ix = _merge_windows(start_val, start_ix, window)
+            window *= 2
+        if window < bound:
+            start_val, start_ix = _merge_windows(start_val, start_ix, bound - window)
+
+    valid = np.logical_and(mask, start_val > -np.inf)
+    with np.errstate(invalid="ignore"):
+        scores = np.where(valid, start_val * end_probs, -np.inf)
+
+    batch_ix = np.arange(batch_size)
+    best_end = np.argmax(scores, axis=1)
+    best_scores = scores[batch_ix, best_end]
+    best_spans = np.stack([start_ix[batch_ix, best_end], best_end], axis=1)
+
+    empty = best_scores == -np.inf
+    best_spans[empty] = -1
+    best_scores[empty] = -1
+    return best_spans, best_scores
+
+
 def get_best_in_sentence_span(start_probs, end_probs, sent_lens):
     max_val = -1
     best_word_span = None
@@ -132,34 +191,95 @@ def get_best_span_from_sent_predictions(per_sent_start_pred, per_sent_end_pred,
     return best_word_span, max_val
 
 
-def top_disjoint_spans(span_scores, bound: int, n_spans: int, spans):
+def _select_disjoint_spans(band_scores, candidates, width: int, n_spans: int, spans):
     """
-    Given a n_token x n_tokens matrix of spans scores, return the top-n non-overlapping spans
-    and their scores
+    Greedily select up to `n_spans` non-overlapping spans from `candidates`, indices into the flattened
+    [n_tokens, width] `band_scores` sorted by decreasing score
     """
+    # Starts and ends of the selected spans, sorted by start so overlaps can be found by bisection
+    starts, ends = [], []
+    out_spans, out_scores = [], []
+    for candidate in candidates:
+        score = band_scores[candidate]
+        if score == -np.inf:
+            break  # Only invalid spans remain
+        s = candidate // width
+        e = s + candidate % width
+        ix = bisect_left(starts, s)
+        # the span must either start after or end before each existing span
+        if (ix > 0 and ends[ix - 1] >= s) or (ix < len(starts) and starts[ix] <= e):
+            continue
+        if spans is not None and not spans[s][0] < spans[e][1]:
+            continue  # Don't select zero length spans
+        starts.insert(ix, s)
+        ends.insert(ix, e)
+        out_spans.append((s, e))
+        out_scores.append(score)
+        if len(out_spans) == n_spans:
+            break
+    return np.array(out_spans, dtype=np.int32).reshape((-1, 2)), np.array(out_scores, dtype=np.float32)
+
+
+def _sort_candidates(band_scores, candidates):
+    """
+    Sort `candidates` (in increasing order) by their score, highest first, with ties going to
+    the highest index like the reversed `np.argsort` `top_disjoint_spans` originally used
+    """
+    candidates = candidates[::-1]
+    return candidates[np.argsort(-band_scores[candidates], kind="mergesort")]
 
-    sorted_ux = np.argsort(span_scores.ravel())[::-1]
-    sorted_ux = np.stack([sorted_ux // len(span_scores), sorted_ux % len(span_scores)], axis=1)
-
-    lens = sorted_ux[:, 1] - sorted_ux[:, 0]
-    sorted_ux = sorted_ux[np.logical_and(lens >= 0, lens < bound)]
-
-    cur_scores = np.zeros(n_spans, dtype=np.float32)
-    cur_spans = np.zeros((n_spans, 2), dtype=np.int32)
-    spans_found = 0
-
-    for s, e in sorted_ux:
-        # the span must either start after or end before each existing spans
-        if np.all(np.logical_or(cur_spans[:spans_found, 0] > e, cur_spans[:spans_found, 1] < s)):
-            if spans[s][0] < spans[e][1]:  # Don't select zero length spans
-                cur_spans[spans_found, 0] = s
-                cur_spans[spans_found, 1] = e
-                cur_scores[spans_found] = span_scores[s, e]
-                spans_found += 1
-                if spans_found == n_spans:
-                    break
 
-    return cur_spans[:spans_found], cur_scores[:spans_found]
+def top_disjoint_spans_batch(span_scores, bound: int, n_spans: int, lens=None, spans=None):
+    """
+    Batched version of `top_disjoint_spans` for a [batch, n_tokens, n_tokens] array of span scores. `lens` is an
+    optional list of the number of tokens in each paragraph, and `spans` an optional list of the character spans
+    of the tokens in each paragraph. Returns lists of the selected spans and scores for each paragraph
+    """
+    span_scores = np.asarray(span_scores)
+    batch_size, n_tokens = span_scores.shape[:2]
+    if lens is None:
+        lens = np.full(batch_size, n_tokens)
+    lens = np.asarray(lens)
+    width = min(bound, n_tokens)
+
+    # [batch, n_tokens, width] band of scores for the spans of at most `bound` tokens
+    starts = np.arange(n_tokens)[:, None]
+    ends = starts + np.arange(width)[None, :]
+    band = span_scores[:, starts, np.minimum(ends, n_tokens - 1)]
+    valid = ends[None, :, :] < lens[:, None, None]
+    band = np.where(valid, band, -np.inf).reshape((batch_size, -1))
+    n_valid = valid.reshape((batch_size, -1)).sum(axis=1)
+
+    # We usually only need to look at the top few candidates, so avoid sorting all of them. We keep every
+    # candidate tied with the n-th best score, so ties are broken the same way as a full sort would
+    n_candidates = min(band.shape[1], n_spans * width * 2)
+    if n_candidates < band.shape[1]:
+        kth_best = np.partition(band, band.shape[1] - n_candidates, axis=1)[:, band.shape[1] - n_candidates]
+    else:
+        kth_best = np.full(batch_size, -np.inf)
+
+    out_spans, out_scores = [], []
+    for i in range(batch_size):
+        para_spans = None if spans is None else spans[i]
+        candidates = _sort_candidates(band[i], np.flatnonzero(band[i] >= kth_best[i]))
+        top_spans, top_scores = _select_disjoint_spans(band[i], candidates, width, n_spans, para_spans)
+        if len(top_spans) < n_spans and len(candidates) < n_valid[i]:
+            # Too many of the top candidates overlapped, fall back to checking all of them
+            all_candidates = _sort_candidates(band[i], np.arange(len(band[i])))
+            top_spans, top_scores = _select_disjoint_spans(band[i], all_candidates, width, n_spans, para_spans)
+        out_spans.append(top_spans)
+        out_scores.append(top_scores)
+    return out_spans, out_scores
+
+
+def top_disjoint_spans(span_scores, bound: int, n_spans: int, spans=None):
+    """
+    Given a n_token x n_tokens matrix of spans scores, return the top-n non-overlapping spans
+    and their scores
+    """
+    top_spans, top_scores = top_disjoint_spans_batch(np.asarray(span_scores)[None, :, :], bound, n_spans,
+                                                     None, None if spans is None else [spans])
+    return top_spans[0], top_scores[0]
 
 
 def compute_span_f1(true_span, pred_span):
@@ -0,0 +1,151 @@
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+from docqa.configurable import config_to_json
+from docqa.data_processing.document_splitter import DocumentSplitter, ExtractedParagraph
+from docqa.utils import flatten_iterable
+
+"""
+Cache how documents are split into paragraphs, since TriviaQA documents are often shared by many questions
+"""
+
+
+def encode_split(paragraphs: List[ExtractedParagraph], doc: List[List[List[str]]]) -> Optional[bytes]:
+    """
+    Encode the boundaries of `paragraphs` as an int32 array of [n_paragraphs, starts, ends, n_pieces, piece lengths],
+    where the pieces are the token lists in `ExtractedParagraph.text`. The ends are stored separately since
+    splitters can truncate a paragraph's text without changing its end (e.g., `MergeParagraphs` with `top_n`).
+    Returns None if the pieces of a paragraph are not a contiguous run of the tokens in `doc` starting at
+    the paragraph's start, since we can't rebuild those from their boundaries
+    """
+    tokens = flatten_iterable(flatten_iterable(doc))
+    starts, ends, n_pieces, lengths = [], [], [], []
+    for para in paragraphs:
+        on_token = para.start
+        for piece in para.text:
+            if tokens[on_token:on_token+len(piece)] != piece:
+                return None
+            on_token += len(piece)
+        starts.append(para.start)
+        ends.append(para.end)
+        n_pieces.append(len(para.text))
+        lengths += [len(x) for x in para.text]
+    return np.array([len(paragraphs)] + starts + ends + n_pieces + lengths, dtype=np.int32).tobytes()
+
+
+def decode_split(data: bytes, doc: List[List[List[str]]]) -> List[ExtractedParagraph]:
+    """ Rebuild the paragraphs encoded by `encode_split` from the text of the document """
+    arr = np.frombuffer(data, dtype=np.int32)
+    n = arr[0]
+    starts, ends, n_pieces = arr[1:n+1].tolist(), arr[n+1:2*n+1].tolist(), arr[2*n+1:3*n+1].tolist()
+    lengths = arr[3*n+1:].tolist()
+    tokens = flatten_iterable(flatten_iterable(doc))
+    out = []
+    on_piece = 0
+    for start, end, para_pieces in zip(starts, ends, n_pieces):
+        text = []
+        on_token = start
+        for length in lengths[on_piece:on_piece+para_pieces]:
+            text.append(tokens[on_token:on_token+length])
+            on_token += length
+        on_piece += para_pieces
+        out.append(ExtractedParagraph(text, start, end))
+    return out
+
+
+class CachedSplitter(DocumentSplitter):
+    """
+    Wraps a `DocumentSplitter` so `load_split` re-uses splits of previously seen documents. The
+    `n_in_memory` most recently used splits are kept in memory, and if `filename` is given the paragraph
+    boundaries of every split are saved in a sqlite file keyed by (splitter config, doc_id, n_tokens).
+    The file can be shared between pool workers and re-used in later runs, documents found in it still
+    need to be loaded, but don't need to be re-split.
+
+    This has the same config as the wrapped splitter, so it can be added without changing the config
+    of the preprocessor using it.
+    """
+
+    def __init__(self, splitter: DocumentSplitter, filename: Optional[str]=None, n_in_memory: int=1000):
+        self.splitter = splitter
+        self.filename = filename
+        self.n_in_memory = n_in_memory
+        self._splitter_key = hashlib.sha1(config_to_json(splitter.get_config()).encode("utf-8")).hexdigest()
+        self._memory = OrderedDict()  # doc_id -> List[ExtractedParagraph], least recently used first
+        self._conn = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def max_tokens(self):
+        return self.splitter.max_tokens
+
+    @property
+    def reads_first_n(self):
+        return self.splitter.reads_first_n
+
+    def get_config(self):
+        return self.splitter.get_config()
+
+    def split(self, doc: List[List[List[str]]]) -> List[ExtractedParagraph]:
+        return self.splitter.split(doc)
+
+    def _get_conn(self):
+        if self._conn is None:
+            # Allow a long timeout since other workers might be writing
+            self._conn = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=OFF")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS paragraph_splits (splitter TEXT, doc_id TEXT, "
+                               "n_tokens INTEGER, data BLOB, PRIMARY KEY (splitter, doc_id, n_tokens))")
+            self._conn.commit()
+        return self._conn
+
+    def load_split(self, evidence, doc_id) -> Optional[List[ExtractedParagraph]]:
+        paragraphs = self._memory.get(doc_id)
+        if paragraphs is not None:
+            self.hits += 1
+            self._memory.move_to_end(doc_id)
+            return paragraphs
+
+        n_tokens = self.splitter.reads_first_n
+        text = evidence.get_document(doc_id, n_tokens=n_tokens)
+        if text is None:
+            return None
+        n_tokens = -1 if n_tokens is None else n_tokens
+
+        stored = None
+        if self.filename is not None:
+            stored = self._get_conn().execute("SELECT data FROM paragraph_splits "
+                                              "WHERE splitter=? AND doc_id=? AND n_tokens=?",
+                                              (self._splitter_key, doc_id, n_tokens)).fetchone()
+        if stored is not None:
+            self.disk_hits += 1
+            paragraphs = decode_split(stored[0], text)
+        else:
+            self.misses += 1
+            paragraphs = self.splitter.split(text)
+            if self.filename is not None:
+                data = encode_split(paragraphs, text)
+                if data is not None:
+                    conn = self._get_conn()
+                    conn.execute("INSERT OR IGNORE INTO paragraph_splits VALUES (?, ?, ?, ?)",
+                                 (self._splitter_key, doc_id, n_tokens, data))
+                    conn.commit()
+
+        if self.n_in_memory > 0:
+            self._memory[doc_id] = paragraphs
+            if len(self._memory) > self.n_in_memory:
+                self._memory.popitem(last=False)
+        return paragraphs
+
+    def __getstate__(self):
+        # Workers get a fresh connection and in-memory cache
+        return dict(splitter=self.splitter, filename=self.filename, n_in_memory=self.n_in_memory)
+
+    def __setstate__(self, state):
+        self.__init__(state["splitter"], state["filename"], state["n_in_memory"])
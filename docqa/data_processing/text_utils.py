@@ -72,7 +72,7 @@ class ParagraphWithInverse(object):
         return ParagraphWithInverse(all_tokens, original_text, np.concatenate(full_inv))
 
     def __init__(self, text: List[List[str]], original_text: str, spans: np.ndarray):
-        if spans.shape != (sum(len(s) for s in text), 2):
+        if spans is not None and spans.shape != (sum(len(s) for s in text), 2):
             raise ValueError("Spans should be shape %s but got %s" % ((sum(len(s) for s in text), 2), spans.shape))
         self.text = text
         self.original_text = original_text
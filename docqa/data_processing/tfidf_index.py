@@ -0,0 +1,180 @@
+import argparse
+import pickle
+from collections import Counter
+from os.path import join
+from typing import List, Iterable, Dict
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfVectorizer
+from tqdm import tqdm
+
+from docqa.config import CORPUS_DIR
+from docqa.data_processing.text_utils import NltkPlusStopWords
+from docqa.triviaqa.evidence_corpus import TriviaQaEvidenceCorpusTxt
+from docqa.utils import split, group, flatten_iterable
+
+"""
+Precomputed tf-idf statistics, so paragraph filters can score candidate paragraphs
+without fitting a new `TfidfVectorizer` for each question
+"""
+
+
+def build_analyzer(stop_words):
+    # Use the same pre-processing and tokenization as the `TfidfVectorizer`s in `document_splitter`
+    return TfidfVectorizer(strip_accents="unicode", stop_words=stop_words).build_analyzer()
+
+
+class TfIdfIndex(object):
+    """
+    Vocabulary and global idf weights computed over a document collection. Texts are
+    mapped to l2 normalized tf-idf vectors so cosine similarities are sparse dot products. Words that
+    are not in the vocabulary are given the idf of a word that never occurred in the collection
+    and a column that is local to each `transform` call.
+    """
+
+    def __init__(self, vocab: Dict[str, int], doc_freq: np.ndarray, n_docs: int, stop_words):
+        self.vocab = vocab
+        self.doc_freq = doc_freq
+        self.n_docs = n_docs
+        self.stop_words = stop_words
+        # Same smoothed idf as sklearn
+        self.idf = np.log((1 + n_docs) / (1 + doc_freq)) + 1
+        self.unknown_idf = np.log(1 + n_docs) + 1
+        self._analyzer = build_analyzer(stop_words)
+
+    @staticmethod
+    def from_counts(doc_freq: Counter, n_docs: int, stop_words) -> "TfIdfIndex":
+        words = sorted(doc_freq)
+        return TfIdfIndex({w: i for i, w in enumerate(words)},
+                          np.array([doc_freq[w] for w in words], dtype=np.int64), n_docs, stop_words)
+
+    @staticmethod
+    def build(documents: Iterable[str], stop_words) -> "TfIdfIndex":
+        analyzer = build_analyzer(stop_words)
+        doc_freq = Counter()
+        n_docs = 0
+        for doc in documents:
+            doc_freq.update(set(analyzer(doc)))
+            n_docs += 1
+        return TfIdfIndex.from_counts(doc_freq, n_docs, stop_words)
+
+    def transform(self, texts: List[str]) -> csr_matrix:
+        """ Returns a (len(texts), n_words) sparse matrix of l2 normalized tf-idf vectors """
+        tokens = [self._analyzer(text) for text in texts]
+        words = flatten_iterable(tokens)
+        n_vocab = len(self.vocab)
+        get = self.vocab.get
+        ids = np.array([get(w, -1) for w in words], dtype=np.int64)
+
+        unknown = ids < 0
+        n_unknown = 0
+        if unknown.any():
+            local_vocab = {}
+            ids[unknown] = [n_vocab + local_vocab.setdefault(w, len(local_vocab))
+                            for w, u in zip(words, unknown) if u]
+            n_unknown = len(local_vocab)
+
+        rows = np.repeat(np.arange(len(texts)), [len(x) for x in tokens])
+        # Converting to csr sums the counts of repeated words
+        mat = csr_matrix((np.ones(len(ids)), (rows, ids)), shape=(len(texts), n_vocab + n_unknown))
+        known = mat.indices < n_vocab
+        mat.data[known] *= self.idf[mat.indices[known]]
+        mat.data[~known] *= self.unknown_idf
+
+        norms = np.sqrt(np.asarray(mat.multiply(mat).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        mat.data /= np.repeat(norms, np.diff(mat.indptr))
+        return mat
+
+    def cosine_distances(self, question: List[str], paragraph_text: List[str]) -> np.ndarray:
+        """ Cosine distance between the question and each paragraph text, 1 if either vector is zero """
+        return self.cosine_distances_many([question], paragraph_text)[0]
+
+    def cosine_distances_many(self, questions: List[List[str]], paragraph_text: List[str]) -> np.ndarray:
+        """ Returns a (n_questions, n_paragraphs) array of cosine distances """
+        features = self.transform(paragraph_text + [" ".join(q) for q in questions])
+        n = len(paragraph_text)
+        sims = (features[n:] @ features[:n].T).toarray()
+        return 1 - sims
+
+    def save(self, filename):
+        with open(filename, "wb") as f:
+            pickle.dump(dict(vocab=self.vocab, doc_freq=self.doc_freq, n_docs=self.n_docs,
+                             stop_words=self.stop_words), f)
+
+    @staticmethod
+    def load(filename) -> "TfIdfIndex":
+        with open(filename, "rb") as f:
+            return TfIdfIndex(**pickle.load(f))
+
+
+_loaded_indices = {}
+
+
+def load_tfidf_index(filename) -> TfIdfIndex:
+    """ Load the index in `filename`, indices are cached so filters using the same index share it """
+    index = _loaded_indices.get(filename)
+    if index is None:
+        index = TfIdfIndex.load(filename)
+        _loaded_indices[filename] = index
+    return index
+
+
+def _count_paragraph_freq(corpus, doc_ids, stop_words):
+    analyzer = build_analyzer(stop_words)
+    doc_freq = Counter()
+    n_paragraphs = 0
+    for doc_id in doc_ids:
+        doc = corpus.get_document(doc_id)
+        if doc is None:
+            continue
+        for para in doc:
+            doc_freq.update(set(analyzer(" ".join(" ".join(s) for s in para))))
+            n_paragraphs += 1
+    return doc_freq, n_paragraphs
+
+
+def _count_paragraph_freq_tuple(x):
+    return _count_paragraph_freq(*x)
+
+
+def build_evidence_index(corpus, stop_words, n_processes=1) -> TfIdfIndex:
+    """ Build an index from the paragraphs in the TriviaQA evidence corpus """
+    doc_ids = corpus.list_documents()
+    chunks = flatten_iterable(group(x, 10000) for x in split(doc_ids, n_processes))
+    doc_freq = Counter()
+    n_paragraphs = 0
+    pbar = tqdm(total=len(chunks), ncols=80)
+    if n_processes == 1:
+        for chunk in chunks:
+            c, n = _count_paragraph_freq(corpus, chunk, stop_words)
+            doc_freq += c
+            n_paragraphs += n
+            pbar.update(1)
+    else:
+        from multiprocessing import Pool
+        with Pool(n_processes) as pool:
+            for c, n in pool.imap_unordered(_count_paragraph_freq_tuple,
+                                            [[corpus, c, stop_words] for c in chunks]):
+                doc_freq += c
+                n_paragraphs += n
+                pbar.update(1)
+    pbar.close()
+    return TfIdfIndex.from_counts(doc_freq, n_paragraphs, stop_words)
+
+
+def main():
+    parser = argparse.ArgumentParser("Build a tf-idf index over the TriviaQA evidence corpus")
+    parser.add_argument("-o", "--output", type=str,
+                        default=join(CORPUS_DIR, "triviaqa", "evidence-tfidf.pkl"))
+    parser.add_argument("-n", "--n_processes", type=int, default=1, help="Number of processes to use")
+    args = parser.parse_args()
+    stop = NltkPlusStopWords(True).words
+    index = build_evidence_index(TriviaQaEvidenceCorpusTxt(), stop, args.n_processes)
+    print("Built index with %d words over %d paragraphs" % (len(index.vocab), index.n_docs))
+    index.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+from typing import List, Iterable
+
+import numpy as np
+
+"""
+Store token lists as indices into a table of the distinct words in a corpus, so encoders can
+look up word ids/char ids once per distinct word instead of re-mapping strings for every batch
+"""
+
+
+class WordTable(object):
+    """ The distinct words in a corpus """
+
+    def __init__(self, words: List[str]=None):
+        self.words = [] if words is None else words
+        self._word_to_ix = {w: i for i, w in enumerate(self.words)}
+
+    def add(self, tokens: Iterable[str]) -> np.ndarray:
+        word_to_ix = self._word_to_ix
+        words = self.words
+        ids = []
+        for token in tokens:
+            ix = word_to_ix.get(token)
+            if ix is None:
+                ix = len(words)
+                word_to_ix[token] = ix
+                words.append(token)
+            ids.append(ix)
+        return np.array(ids, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getstate__(self):
+        return dict(words=self.words)
+
+    def __setstate__(self, state):
+        self.__init__(state["words"])
+
+
+class TokenIds(list):
+    """
+    List of tokens that also has the index of each token in a `WordTable`, the list should
+    not be modified after construction
+    """
+
+    def __init__(self, tokens: List[str], table: WordTable, ids: np.ndarray):
+        super().__init__(tokens)
+        self.table = table
+        self.ids = ids
+
+
+def add_token_ids(data: Iterable, table: WordTable):
+    """
+    Replace the token lists in `data` with `TokenIds`, supports elements with a `question` and either a
+    `context` or a list of `paragraphs` that each have a `text`, as built by our `Preprocessor`s
+    """
+    # id(list) -> (list, TokenIds), so lists shared between elements stay shared. We keep a reference
+    # to the original list so its id can't be re-used while we are running
+    converted = {}
+
+    def convert(tokens):
+        if isinstance(tokens, TokenIds) and tokens.table is table:
+            return tokens
+        if id(tokens) in converted:
+            return converted[id(tokens)][1]
+        out = TokenIds(tokens, table, table.add(tokens))
+        converted[id(tokens)] = (tokens, out)
+        return out
+
+    for point in data:
+        if hasattr(point, "question"):
+            point.question = convert(point.question)
+        if hasattr(point, "context"):
+            point.context = convert(point.context)
+        if hasattr(point, "paragraphs"):
+            for para in point.paragraphs:
+                para.text = convert(para.text)
@@ -1,9 +1,12 @@
+import argparse
 import gzip
 import pickle
-from os.path import join, exists
-from typing import Iterable, Optional
+from collections.abc import Mapping
+from os.path import join, exists, getsize
+from typing import Iterable, Optional, List, Dict, Tuple, Union, Callable
 
 import numpy as np
+from tqdm import tqdm
 
 from docqa.config import VEC_DIR
 
@@ -11,11 +14,87 @@ from docqa.config import VEC_DIR
 """ Loading words vectors """
 
 
+class StoredWordVectors(Mapping):
+    """
+    Read-only word -> vector mapping where all the vectors are rows of one (possibly memory-mapped) matrix,
+    so we don't need to build a separate array for each word
+
+    If `shared` is set the matrix is shared with other processes, so users should read the rows they need
+    from `matrix` as needed rather than building their own copy of it. `word_to_row` can be a function
+    building the dictionary, in which case it is only built if it is used.
+    """
+
+    def __init__(self, matrix: np.ndarray, word_to_row: Union[Dict[str, int], Callable[[], Dict[str, int]]],
+                 shared: bool=False):
+        self.matrix = matrix
+        self._word_to_row = word_to_row
+        self.shared = shared
+
+    @property
+    def word_to_row(self) -> Dict[str, int]:
+        if callable(self._word_to_row):
+            self._word_to_row = self._word_to_row()
+        return self._word_to_row
+
+    def __getitem__(self, word):
+        return self.matrix[self.word_to_row[word]]
+
+    def __contains__(self, word):
+        return word in self.word_to_row
+
+    def __iter__(self):
+        return iter(self.word_to_row)
+
+    def __len__(self):
+        return len(self.word_to_row)
+
+    def get_matrix(self, words: List[str]) -> np.ndarray:
+        """ Returns an in-memory (len(words), dim) matrix of the vectors for `words` """
+        return np.array(self.matrix[[self.word_to_row[w] for w in words]])
+
+    def __reduce__(self):
+        # Pickle as a plain dictionary so we don't pickle the entire memory-mapped matrix
+        return dict, ({w: np.array(self.matrix[r]) for w, r in self.word_to_row.items()}, )
+
+
+def stack_word_vectors(word_to_vec, words: List[str]) -> np.ndarray:
+    """ Build a (len(words), dim) matrix of word vectors """
+    if isinstance(word_to_vec, StoredWordVectors):
+        return word_to_vec.get_matrix(words)
+    return np.vstack([word_to_vec[w] for w in words])
+
+
+def load_word_vector_store(prefix: str, vocab: Optional[Iterable[str]]=None,
+                           shared: bool=False) -> StoredWordVectors:
+    """
+    Load vectors saved by `convert_word_vectors`, vectors are memory-mapped so only the rows for the words
+    in `vocab` (case-insensitive) will be read from disk. See `StoredWordVectors` for `shared`.
+    """
+    if vocab is not None:
+        vocab = set(x.lower() for x in vocab)
+    matrix = np.load(prefix + ".npy", mmap_mode="r")
+
+    def build_word_to_row():
+        with open(prefix + ".words.txt", "r", encoding="utf-8", newline="") as f:
+            words = f.read().split("\n")
+        if len(words) != len(matrix):
+            raise ValueError("Vocab for %s has %d words, but there are %d vectors" % (prefix, len(words), len(matrix)))
+        if vocab is None:
+            return {w: i for i, w in enumerate(words)}
+        else:
+            return {w: i for i, w in enumerate(words) if w.lower() in vocab}
+
+    # Users of shared vectors might only need the matrix, so don't build the dictionary until it is used
+    return StoredWordVectors(matrix.view(np.ndarray), build_word_to_row if shared else build_word_to_row(), shared)
+
+
 def load_word_vectors(vec_name: str, vocab: Optional[Iterable[str]]=None, is_path=False):
     if not is_path:
         vec_path = join(VEC_DIR, vec_name)
     else:
         vec_path = vec_name
+    if exists(vec_path + ".npy") and exists(vec_path + ".words.txt"):
+        return load_word_vector_store(vec_path, vocab)
     if exists(vec_path + ".txt"):
         vec_path = vec_path + ".txt"
     elif exists(vec_path + ".txt.gz"):
@@ -27,7 +106,7 @@ def load_word_vectors(vec_name: str, vocab: Optional[Iterable[str]]=None, is_pat
     return load_word_vector_file(vec_path, vocab)
 
 
-def load_word_vector_file(vec_path: str, vocab: Optional[Iterable[str]] = None):
+def load_word_vector_file(vec_path: str, vocab: Optional[Iterable[str]] = None, n_processes: int=1):
     if vocab is not None:
         vocab = set(x.lower() for x in vocab)
 
@@ -35,8 +114,12 @@ def load_word_vector_file(vec_path: str, vocab: Optional[Iterable[str]] = None):
     if vec_path.endswith(".pkl"):
         with open(vec_path, "rb") as f:
             return pickle.load(f)
-    elif vec_path.endswith(".txt.gz"):
-        handle = lambda x: gzip.open(x, 'r', encoding='utf-8', errors='ignore')
+
+    if n_processes > 1:
+        return _load_word_vector_file_par(vec_path, vocab, n_processes)
+
+    if vec_path.endswith(".txt.gz"):
+        handle = lambda x: gzip.open(x, 'rt', encoding='utf-8', errors='ignore')
     else:
         handle = lambda x: open(x, 'r', encoding='utf-8', errors='ignore')
 
@@ -48,3 +131,140 @@ def load_word_vector_file(vec_path: str, vocab: Optional[Iterable[str]] = None):
             if (vocab is None) or (word.lower() in vocab):
                 pruned_dict[word] = np.array([float(x) for x in line[word_ix + 1:-1].split(" ")], dtype=np.float32)
     return pruned_dict
+
+
+def _parse_lines(lines: List[str], vocab) -> Tuple[List[str], Union[np.ndarray, List[np.ndarray]]]:
+    """
+    Parse lines of "word v1 v2 ... vn", keeping words in `vocab`. Returns the words and either a matrix
+    or, if the vectors have different lengths, a list of vectors
+    """
+    words, vectors = [], []
+    for line in lines:
+        word_ix = line.find(" ")
+        word = line[:word_ix]
+        if (vocab is None) or (word.lower() in vocab):
+            words.append(word)
+            vectors.append(line[word_ix + 1:])
+    if len(words) == 0:
+        return words, []
+    # Parse all the numbers in one call, we parse as float64 and then
+    # convert to match what `load_word_vector_file` produces
+    values = np.fromstring(" ".join(vectors), dtype=np.float64, sep=" ").astype(np.float32)
+    dim = len(values) // len(words)
+    # Check every line has `dim` values, otherwise a long line followed by a short line would pass
+    # the total count check and shift the vectors in between. Lines with runs of whitespace are
+    # miscounted here, but then just take the slower path below
+    if dim * len(words) == len(values) and all(v.strip().count(" ") + 1 == dim for v in vectors):
+        # Return one matrix so it is cheap to send back from a worker process
+        return words, values.reshape(len(words), dim)
+    # Vectors have inconsistent lengths, fall back to parsing line-by-line
+    return words, [np.array(v.split(), dtype=np.float64).astype(np.float32) for v in vectors]
+
+
+def _parse_byte_range(x):
+    vec_path, start, end, vocab = x
+    with open(vec_path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8", errors="ignore")
+    # Split lines the same way as reading the file in text mode (`str.splitlines` also splits on unicode
+    # line breaks, which can occur inside words)
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return _parse_lines([x for x in lines if len(x) > 0], vocab)
+
+
+def _parse_lines_tuple(x):
+    return _parse_lines(*x)
+
+
+def _byte_ranges(vec_path: str, n_chunks: int) -> List[Tuple[int, int]]:
+    """ Split `vec_path` into `n_chunks` byte ranges that start and end at line boundaries """
+    size = getsize(vec_path)
+    boundaries = [0]
+    with open(vec_path, "rb") as f:
+        for i in range(1, n_chunks):
+            f.seek(max(size * i // n_chunks, boundaries[-1]))
+            f.readline()
+            boundaries.append(min(f.tell(), size))
+    boundaries.append(size)
+    return [(s, e) for s, e in zip(boundaries[:-1], boundaries[1:]) if e > s]
+
+
+def _iter_line_chunks(vec_path: str, chunk_size: int):
+    with gzip.open(vec_path, 'rt', encoding='utf-8', errors='ignore') as fh:
+        chunk = []
+        for line in fh:
+            chunk.append(line.rstrip("\n"))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+
+def _load_word_vector_file_par(vec_path: str, vocab, n_processes: int,
+                               chunk_size_mb: int=32, gz_chunk_lines: int=20000):
+    """
+    Parse a word vector file using `n_processes` processes. Text files are split into byte ranges that
+    each process reads independently, gzipped files are decompressed in this process and the lines are
+    sent to the workers.
+    """
+    from multiprocessing import Pool
+    pruned_dict = {}
+    with Pool(n_processes) as pool:
+        if vec_path.endswith(".txt.gz"):
+            chunks = ([x, vocab] for x in _iter_line_chunks(vec_path, gz_chunk_lines))
+            pbar = tqdm(desc="parse", unit=" lines", ncols=80)
+            results = pool.imap(_parse_lines_tuple, chunks)
+            n_total = None
+        else:
+            n_chunks = max(n_processes, getsize(vec_path) // (chunk_size_mb * 1024 * 1024))
+            ranges = _byte_ranges(vec_path, n_chunks)
+            pbar = tqdm(desc="parse", total=ranges[-1][1] if ranges else 0, unit="B", unit_scale=True, ncols=80)
+            results = pool.imap(_parse_byte_range, [(vec_path, s, e, vocab) for s, e in ranges])
+            n_total = [e - s for s, e in ranges]
+
+        # imap returns results in order, so duplicate words are resolved the same way as the serial version
+        for i, (words, vectors) in enumerate(results):
+            pruned_dict.update(zip(words, vectors))
+            pbar.update(gz_chunk_lines if n_total is None else n_total[i])
+        pbar.close()
+    return pruned_dict
+
+
+def convert_word_vectors(vec_path: str, output_prefix: str, n_processes: int=1):
+    """
+    Convert a text file of word vectors into a `.npy` matrix and a `.words.txt` file with the
+    word for each row, which can be loaded much faster then the text file
+    """
+    save_word_vector_store(load_word_vector_file(vec_path, n_processes=n_processes), output_prefix)
+
+
+def save_word_vector_store(word_to_vec, output_prefix: str):
+    """ Save a word -> vector mapping in the format read by `load_word_vector_store` """
+    words = list(word_to_vec.keys())
+    np.save(output_prefix + ".npy", stack_word_vectors(word_to_vec, words).astype(np.float32))
+    with open(output_prefix + ".words.txt", "w", encoding="utf-8", newline="") as f:
+        f.write("\n".join(words))
+
+
+def main():
+    parser = argparse.ArgumentParser("Convert word vectors to the binary format used by `load_word_vector_store`")
+    parser.add_argument("vec_name", help="Vectors to convert, either a name in the vector directory or a path")
+    parser.add_argument("-o", "--output", help="Output prefix, defaults to the vector file without the extension")
+    parser.add_argument("-n", "--n_processes", type=int, default=1, help="Number of processes to parse with")
+    args = parser.parse_args()
+    vec_path = args.vec_name
+    if not exists(vec_path):
+        vec_path = join(VEC_DIR, vec_path)
+        for ext in [".txt", ".txt.gz"]:
+            if exists(vec_path + ext):
+                vec_path += ext
+                break
+    output = args.output
+    if output is None:
+        output = vec_path[:vec_path.rfind(".txt")]
+    convert_word_vectors(vec_path, output, args.n_processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+from collections import OrderedDict
+from threading import Lock
 from typing import List, Optional, Dict
 
 import numpy as np
@@ -7,6 +9,7 @@ from docqa.configurable import Configurable
 from docqa.data_processing.qa_training_data import ParagraphAndQuestionSpec, ContextAndQuestion
 from docqa.data_processing.span_data import ParagraphSpans, TokenSpans
 from docqa.data_processing.text_features import QaTextFeautrizer
+from docqa.data_processing.token_ids import TokenIds, WordTable
 from docqa.nn.embedder import WordEmbedder, CharEmbedder
 from docqa.nn.span_prediction_ops import to_packed_coordinates_np
 
@@ -184,6 +187,85 @@ class PackedMultiSpanAnswerEncoder(AnswerEncoder):
         return PackedMultiSpanAnswerEncoder(state["bound"])
 
 
+class WordCharIdCache(object):
+    """
+    Bounded LRU cache of word -> (padded char ids, clipped word length), used so the char ids of
+    frequent words do not have to be re-computed for every batch.
+    Rows are kept in a pre-allocated array so they can be gathered in bulk
+    """
+
+    def __init__(self, max_size: int, max_char_dim: int, char_to_ix):
+        if max_size <= 0:
+            raise ValueError("Cache size must be > 0, but got %d" % max_size)
+        self.max_size = max_size
+        self.max_char_dim = max_char_dim
+        self.char_to_ix = char_to_ix
+        self.char_ids = np.zeros((max_size, max_char_dim), dtype=np.int32)
+        self.word_lens = np.zeros(max_size, dtype=np.int32)
+        self._slots = OrderedDict()  # word -> row in `char_ids`, least recently used first
+        self._lock = Lock()  # so the encoder can be used from multiple threads
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return 0 if total == 0 else self.hits / total
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, words: List[str]):
+        """ Returns a (len(words), max_char_dim) array of char ids and a (len(words),) array of word lengths """
+        with self._lock:
+            return self._lookup(words)
+
+    def _lookup(self, words: List[str]):
+        char_ids = np.zeros((len(words), self.max_char_dim), dtype=np.int32)
+        word_lens = np.zeros(len(words), dtype=np.int32)
+
+        slots = self._slots
+        hit_ix, hit_slots, miss_ix = [], [], []
+        for i, word in enumerate(words):
+            slot = slots.get(word)
+            if slot is None:
+                miss_ix.append(i)
+            else:
+                slots.move_to_end(word)
+                hit_ix.append(i)
+                hit_slots.append(slot)
+        self.hits += len(hit_ix)
+        self.misses += len(miss_ix)
+
+        # Copy out the hits before any evictions can overwrite their rows
+        if len(hit_ix) > 0:
+            char_ids[hit_ix] = self.char_ids[hit_slots]
+            word_lens[hit_ix] = self.word_lens[hit_slots]
+
+        char_to_ix = self.char_to_ix
+        for i in miss_ix:
+            word = words[i][:self.max_char_dim]
+            word_lens[i] = len(word)
+            char_ids[i, :len(word)] = [char_to_ix(c) for c in word]
+
+        # Only the last `max_size` misses can fit in the cache
+        for i in miss_ix[-self.max_size:]:
+            if words[i] in slots:
+                continue  # `words` contained duplicates
+            if len(slots) < self.max_size:
+                slot = len(slots)
+            else:
+                _, slot = slots.popitem(last=False)
+            slots[words[i]] = slot
+            self.char_ids[slot] = char_ids[i]
+            self.word_lens[slot] = word_lens[i]
+
+        return char_ids, word_lens
+
+
 class DocumentAndQuestionEncoder(Configurable):
     """
     Uses a WordEmbedder/CharEmbedder (passed in by the client in `init`) to encode text into padded batches of arrays.
@@ -193,10 +275,14 @@ class DocumentAndQuestionEncoder(Configurable):
     def __init__(self,
                  answer_encoder: AnswerEncoder,
                  doc_size_th: Optional[int]=None,
-                 word_featurizer: Optional[QaTextFeautrizer]=None):
+                 word_featurizer: Optional[QaTextFeautrizer]=None,
+                 vectorize: bool=True,
+                 char_cache_size: Optional[int]=50000):
         # Parameters
         self.answer_encoder = answer_encoder
         self.doc_size_th = doc_size_th
+        self.vectorize = vectorize
+        self.char_cache_size = char_cache_size
 
         self.word_featurizer = word_featurizer
 
@@ -209,6 +295,8 @@ class DocumentAndQuestionEncoder(Configurable):
         self.max_context_word_dim = None
         self.max_ques_word_dim = None
         self.max_char_dim = None
+        self.char_cache = None
+        self._table_word_ids = None
 
         self.context_features = None
         self.context_words = None
@@ -242,6 +330,12 @@ class DocumentAndQuestionEncoder(Configurable):
         else:
             self.max_char_dim = 1
 
+        if self._char_emb is not None and self.char_cache_size is not None:
+            self.char_cache = WordCharIdCache(self.char_cache_size, self.max_char_dim, self._char_emb.char_to_ix)
+        else:
+            self.char_cache = None
+        self._table_word_ids = {}  # id(WordTable) -> (WordTable, word id of each table word or -1)
+
         if not self.len_opt:
             self.max_ques_word_dim = input_spec.max_num_quesiton_words
             self.max_context_word_dim = input_spec.max_num_context_words
@@ -350,7 +444,35 @@ class DocumentAndQuestionEncoder(Configurable):
         else:
             context_chars, question_chars, question_word_len, context_word_len = None, None, None, None
 
-        query_once = self._word_embedder.query_once()
+        if self.vectorize:
+            self._fill_text_arrays(batch, is_train, context_len, context_word_dim, question_len, ques_word_dim,
+                                   context_words, question_words, context_chars, question_chars,
+                                   context_word_len, question_word_len)
+        else:
+            self._fill_text_arrays_loop(batch, is_train, context_words, question_words,
+                                        context_chars, question_chars, context_word_len, question_word_len)
+
+        # Answer placeholders
+        feed_dict.update(self.answer_encoder.encode(batch_size, context_len, context_word_dim, batch))
+
+        # Features placeholders
+        if self.word_featurizer is not None:
+            question_word_features = np.zeros((batch_size, ques_word_dim, self.word_featurizer.n_question_features()))
+            context_word_features = np.zeros((batch_size, context_word_dim, self.word_featurizer.n_context_features()))
+            for doc_ix, doc in enumerate(batch):
+                q_f, c_f = self.word_featurizer.get_features(doc.question, doc.get_context())
+                question_word_features[doc_ix, :q_f.shape[0]] = q_f
+                context_word_features[doc_ix, :c_f.shape[0]] = c_f
+            feed_dict[self.context_features] = context_word_features
+            feed_dict[self.question_features] = question_word_features
+
+        return feed_dict
+
+    def _fill_text_arrays_loop(self, batch: List[ContextAndQuestion], is_train: bool,
+                               context_words, question_words, context_chars, question_chars,
+                               context_word_len, question_word_len):
+        """ Reference implementation of `_fill_text_arrays` that fills in one token/char at a time """
+        query_once = self._word_embedder is not None and self._word_embedder.query_once()
 
         # Now fill in the place holders by iterating through the data
         for doc_ix, doc in enumerate(batch):
@@ -391,21 +513,118 @@ class DocumentAndQuestionEncoder(Configurable):
                             break
                         context_chars[doc_ix, word_ix, char_ix] = self._char_emb.char_to_ix(char)
 
-        # Answer placeholders
-        feed_dict.update(self.answer_encoder.encode(batch_size, context_len, context_word_dim, batch))
+    def _fill_text_arrays(self, batch: List[ContextAndQuestion], is_train: bool,
+                          context_len, context_word_dim, question_len, ques_word_dim,
+                          context_words, question_words, context_chars, question_chars,
+                          context_word_len, question_word_len):
+        """
+        Fill the word/char arrays using bulk numpy operations. Each distinct word in the batch gets a row
+        in a table of word ids/char ids/word lengths, the arrays are then built by gathering rows from that table.
+        Produces exactly the same output as `_fill_text_arrays_loop`
+        """
+        n = len(batch)
+        table = self._get_word_table(batch)
+        if table is not None:
+            # Tokens are already mapped to rows in a `WordTable`, re-index them by the distinct rows in this batch
+            question_rows = np.concatenate([doc.question.ids for doc in batch])
+            context_rows = np.concatenate([doc.get_context().ids[:doc_len]
+                                           for doc, doc_len in zip(batch, context_len)])
+            table_rows, inverse = np.unique(np.concatenate([question_rows, context_rows]), return_inverse=True)
+            question_rows, context_rows = inverse[:len(question_rows)], inverse[len(question_rows):]
+            words = [table.words[i] for i in table_rows]
+        else:
+            rows = {}  # word -> row in the tables
+            question_rows = np.array([rows.setdefault(w, len(rows)) for doc in batch for w in doc.question],
+                                     dtype=np.int64)
+            context_rows = np.array([rows.setdefault(w, len(rows)) for doc, doc_len in zip(batch, context_len)
+                                     for w in doc.get_context()[:doc_len]], dtype=np.int64)
+            words = list(rows)
+
+        # Boolean masks of the non-padding entries, numpy fills these in row-major order which
+        # matches the order of the flattened `*_rows` arrays
+        question_mask = np.arange(ques_word_dim) < question_len[:, None]
+        context_mask = np.arange(context_word_dim) < context_len[:, None]
 
-        # Features placeholders
-        if self.word_featurizer is not None:
-            question_word_features = np.zeros((batch_size, ques_word_dim, self.word_featurizer.n_question_features()))
-            context_word_features = np.zeros((batch_size, context_word_dim, self.word_featurizer.n_context_features()))
-            for doc_ix, doc in enumerate(batch):
-                q_f, c_f = self.word_featurizer.get_features(doc.question, doc.get_context())
-                question_word_features[doc_ix, :q_f.shape[0]] = q_f
-                context_word_features[doc_ix, :c_f.shape[0]] = c_f
-            feed_dict[self.context_features] = context_word_features
-            feed_dict[self.question_features] = question_word_features
+        if self._word_embedder is not None:
+            if self._word_embedder.query_once():
+                # Ids can depend on the order words are seen within each document, so we have to
+                # query each document's words in order
+                question_ids, context_ids = self._query_once_word_ids(batch, is_train, context_len)
+            else:
+                # Otherwise ids only depend on the word, so we can query each distinct word once
+                if table is not None:
+                    word_ids = self._get_table_word_ids(table, table_rows, is_train)
+                else:
+                    word_ids = self._word_embedder.words_to_ix(words, is_train)
+                question_ids, context_ids = word_ids[question_rows], word_ids[context_rows]
+            question_words[:n][question_mask] = question_ids
+            context_words[:n][context_mask] = context_ids
 
-        return feed_dict
+        if self._char_emb is not None:
+            if self.char_cache is not None:
+                char_ids, word_lens = self.char_cache.lookup(words)
+            else:
+                char_ids, word_lens = self._char_table(words)
+            question_chars[:n][question_mask] = char_ids[question_rows]
+            context_chars[:n][context_mask] = char_ids[context_rows]
+            question_word_len[:n][question_mask] = word_lens[question_rows]
+            context_word_len[:n][context_mask] = word_lens[context_rows]
+
+    @staticmethod
+    def _get_word_table(batch: List[ContextAndQuestion]) -> Optional[WordTable]:
+        """ Returns the `WordTable` all the questions and contexts in `batch` use, if there is one """
+        table = None
+        for doc in batch:
+            question, context = doc.question, doc.get_context()
+            if not isinstance(question, TokenIds) or not isinstance(context, TokenIds):
+                return None
+            if table is None:
+                table = question.table
+            if question.table is not table or context.table is not table:
+                return None
+        return table
+
+    def _get_table_word_ids(self, table: WordTable, rows: np.ndarray, is_train: bool) -> np.ndarray:
+        """ Word ids for the given rows of `table`, ids are computed the first time a row is used and then re-used """
+        key = (id(table), is_train)
+        entry = self._table_word_ids.get(key)
+        if entry is None or entry[0] is not table or len(entry[1]) < len(table):
+            ids = np.full(len(table), -1, dtype=np.int32)
+            if entry is not None and entry[0] is table:
+                ids[:len(entry[1])] = entry[1]  # Words were added to the table
+            entry = (table, ids)
+            self._table_word_ids[key] = entry
+        ids = entry[1]
+        missing = rows[ids[rows] == -1]
+        if len(missing) > 0:
+            ids[missing] = self._word_embedder.words_to_ix([table.words[i] for i in missing], is_train)
+        return ids[rows]
+
+    def _query_once_word_ids(self, batch: List[ContextAndQuestion], is_train: bool, context_len):
+        question_ids = []
+        context_ids = []
+        for doc, doc_len in zip(batch, context_len):
+            doc_mapping = {}
+            for words, out in [(doc.question, question_ids), (doc.get_context()[:doc_len], context_ids)]:
+                for word in words:
+                    ix = doc_mapping.get(word)
+                    if ix is None:
+                        ix = self._word_embedder.context_word_to_ix(word, is_train)
+                        doc_mapping[word] = ix
+                    out.append(ix)
+        return np.array(question_ids, dtype=np.int32), np.array(context_ids, dtype=np.int32)
+
+    def _char_table(self, words: List[str]):
+        """ Build a (n_words, max_char_dim) array of char ids and a (n_words,) array of clipped word lengths """
+        max_char_dim = self.max_char_dim
+        char_ids = np.zeros((len(words), max_char_dim), dtype=np.int32)
+        word_lens = np.zeros(len(words), dtype=np.int32)
+        char_to_ix = self._char_emb.char_to_ix
+        for i, word in enumerate(words):
+            word = word[:max_char_dim]
+            word_lens[i] = len(word)
+            char_ids[i, :len(word)] = [char_to_ix(c) for c in word]
+        return char_ids, word_lens
 
     def __getstate__(self):
         # The placeholders are considered transient, the model
@@ -414,6 +633,8 @@ class DocumentAndQuestionEncoder(Configurable):
             answer_encoder=self.answer_encoder,
             doc_size_th=self.doc_size_th,
             word_featurizer=self.word_featurizer,
+            vectorize=self.vectorize,
+            char_cache_size=self.char_cache_size,
             version=self.version
         )
         return state
@@ -428,6 +649,8 @@ class DocumentAndQuestionEncoder(Configurable):
                 raise ValueError()
             state["state"]["answer_encoder"] = SingleSpanAnswerEncoder()
         elif state["version"] <= 2:
+            state["state"]["vectorize"] = True
+            state["state"]["char_cache_size"] = 50000
             super().__setstate__(state)
         else:
             del state["version"]
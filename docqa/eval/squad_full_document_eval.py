@@ -11,7 +11,7 @@ from docqa.data_processing.span_data import TokenSpans
 from docqa.data_processing.text_utils import NltkPlusStopWords, ParagraphWithInverse
 from docqa.dataset import FixedOrderBatcher
 from docqa.eval.ranked_scores import compute_ranked_scores
-from docqa.evaluator import Evaluation, Evaluator
+from docqa.evaluator import Evaluator, PerSampleReducer
 from docqa.model_dir import ModelDir
 from docqa.squad.document_rd_corpus import get_doc_rd_doc
 from docqa.squad.squad_data import SquadCorpus
@@ -58,15 +58,14 @@ class RecordParagraphSpanPrediction(Evaluator):
         needed = dict(spans=span, model_scores=score)
         return needed
 
-    def evaluate(self, data: List[RankedParagraphQuestion], true_len, **kargs):
-        spans, model_scores = np.array(kargs["spans"]), np.array(kargs["model_scores"])
+    def process_batch(self, data: List[RankedParagraphQuestion], **kargs):
+        spans = np.array(kargs["spans"])
 
         pred_f1s = np.zeros(len(data))
         pred_em = np.zeros(len(data))
         text_answers = []
 
-        for i in tqdm(range(len(data)), total=len(data), ncols=80, desc="scoring"):
-            point = data[i]
+        for i, point in enumerate(data):
             if point.answer is None and not self.record_text_ans:
                 continue
             pred_span = spans[i]
@@ -90,14 +89,18 @@ class RecordParagraphSpanPrediction(Evaluator):
         results["n_answers"] = [0 if x.answer is None else len(x.answer.answer_spans) for x in data]
         if self.record_text_ans:
             results["text_answer"] = text_answers
-        results["predicted_score"] = model_scores
+        results["predicted_score"] = kargs["model_scores"]
         results["predicted_start"] = spans[:, 0]
         results["predicted_end"] = spans[:, 1]
         results["text_f1"] = pred_f1s
         results["rank"] = [x.rank for x in data]
         results["text_em"] = pred_em
         results["question_id"] = [x.question_id for x in data]
-        return Evaluation({}, results)
+        return results
+
+    def begin(self):
+        # Only keep the per-paragraph results, not the data or predicted tensors
+        return PerSampleReducer()
 
 
 def main():
@@ -5,18 +5,18 @@ from typing import List
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
 from docqa import trainer
 from docqa.config import TRIVIA_QA
 from docqa.data_processing.document_splitter import MergeParagraphs, TopTfIdf, ShallowOpenWebRanker, FirstN
 from docqa.data_processing.preprocessed_corpus import preprocess_par
+from docqa.data_processing.split_cache import CachedSplitter
 from docqa.data_processing.qa_training_data import ParagraphAndQuestionDataset
 from docqa.data_processing.span_data import TokenSpans
 from docqa.data_processing.text_utils import NltkPlusStopWords
 from docqa.dataset import FixedOrderBatcher
 from docqa.eval.ranked_scores import compute_ranked_scores
-from docqa.evaluator import Evaluator, Evaluation
+from docqa.evaluator import Evaluator, PerSampleReducer
 from docqa.model_dir import ModelDir
 from docqa.triviaqa.build_span_corpus import TriviaQaWebDataset, TriviaQaOpenDataset, TriviaQaWikiDataset
 from docqa.triviaqa.read_data import normalize_wiki_filename
@@ -42,15 +42,14 @@ class RecordParagraphSpanPrediction(Evaluator):
         needed = dict(spans=span, model_scores=score)
         return needed
 
-    def evaluate(self, data: List[DocumentParagraphQuestion], true_len, **kargs):
-        spans, model_scores = np.array(kargs["spans"]), np.array(kargs["model_scores"])
+    def process_batch(self, data: List[DocumentParagraphQuestion], **kargs):
+        spans = np.array(kargs["spans"])
 
         pred_f1s = np.zeros(len(data))
         pred_em = np.zeros(len(data))
         text_answers = []
 
-        for i in tqdm(range(len(data)), total=len(data), ncols=80, desc="scoring"):
-            point = data[i]
+        for i, point in enumerate(data):
             if point.answer is None and not self.record_text_ans:
                 continue
             text = point.get_context()
@@ -75,7 +74,7 @@ class RecordParagraphSpanPrediction(Evaluator):
         results["n_answers"] = [0 if x.answer is None else len(x.answer.answer_spans) for x in data]
         if self.record_text_ans:
             results["text_answer"] = text_answers
-        results["predicted_score"] = model_scores
+        results["predicted_score"] = kargs["model_scores"]
         results["predicted_start"] = spans[:, 0]
         results["predicted_end"] = spans[:, 1]
         results["text_f1"] = pred_f1s
@@ -85,7 +84,11 @@ class RecordParagraphSpanPrediction(Evaluator):
         results["para_end"] = [x.para_range[1] for x in data]
         results["question_id"] = [x.question_id for x in data]
         results["doc_id"] = [x.doc_id for x in data]
-        return Evaluation({}, results)
+        return results
+
+    def begin(self):
+        # Only keep the per-paragraph results, not the data or predicted tensors
+        return PerSampleReducer()
 
 
 def main():
@@ -101,12 +104,23 @@ def main():
     parser.add_argument('-i', '--step', type=int, default=None, help="checkpoint to load, default to latest")
     parser.add_argument('-n', '--n_sample', type=int, default=None, help="Number of questions to evaluate on")
     parser.add_argument('-a', '--async', type=int, default=10)
+    parser.add_argument('--n_encoding_workers', type=int, default=1,
+                        help="Number of threads to encode batches with")
+    parser.add_argument('--n_postprocess_workers', type=int, default=0,
+                        help="Number of threads to score the predicted answers with while the model runs, "
+                             "0 scores them after each model run")
     parser.add_argument('-t', '--tokens', type=int, default=400,
                         help="Max tokens per a paragraph")
     parser.add_argument('-g', '--n_paragraphs', type=int, default=15,
                         help="Number of paragraphs to run the model on")
     parser.add_argument('-f', '--filter', type=str, default=None, choices=["tfidf", "truncate", "linear"],
                         help="How to select paragraphs")
+    parser.add_argument('--tfidf_index', type=str, default=None,
+                        help="Score paragraphs using this tf-idf index (see data_processing/tfidf_index.py) "
+                             "instead of fitting tf-idf weights for each question")
+    parser.add_argument('--split_cache', type=str, default=None,
+                        help="sqlite file to cache how documents are split into paragraphs in, can be re-used "
+                             "between runs that use the same number of tokens per a paragraph")
     parser.add_argument('-b', '--batch_size', type=int, default=200,
                         help="Batch size, larger sizes might be faster but wll take more memory")
     parser.add_argument('--max_answer_len', type=int, default=8,
@@ -151,6 +165,8 @@ def main():
 
     corpus = dataset.evidence
     splitter = MergeParagraphs(args.tokens)
+    if args.split_cache is not None:
+        splitter = CachedSplitter(splitter, args.split_cache)
 
     per_document = args.corpus.startswith("web")  # wiki and web are both multi-document
 
@@ -166,11 +182,11 @@ def main():
         args.n_paragraphs, filter_name, ("question-document pair" if per_document else "question")))
 
     if filter_name == "tfidf":
-        para_filter = TopTfIdf(NltkPlusStopWords(punctuation=True), args.n_paragraphs)
+        para_filter = TopTfIdf(NltkPlusStopWords(punctuation=True), args.n_paragraphs, index=args.tfidf_index)
     elif filter_name == "truncate":
         para_filter = FirstN(args.n_paragraphs)
     elif filter_name == "linear":
-        para_filter = ShallowOpenWebRanker(args.n_paragraphs)
+        para_filter = ShallowOpenWebRanker(args.n_paragraphs, index=args.tfidf_index)
     else:
         raise ValueError()
 
@@ -221,7 +237,9 @@ def main():
 
     evaluation = trainer.test(model,
                              [RecordParagraphSpanPrediction(args.max_answer_len, True)],
-                              {args.corpus:test_questions}, ResourceLoader(), checkpoint, not args.no_ema, args.async)[args.corpus]
+                              {args.corpus:test_questions}, ResourceLoader(), checkpoint, not args.no_ema, args.async,
+                              n_encoding_workers=args.n_encoding_workers,
+                              n_postprocess_workers=args.n_postprocess_workers)[args.corpus]
 
     if not all(len(x) == len(data) for x in evaluation.per_sample.values()):
         raise RuntimeError()
@@ -1,5 +1,9 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 from threading import Thread
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 import numpy as np
 import tensorflow as tf
@@ -49,6 +53,75 @@ class Evaluation(object):
         return [tf.Summary(value=[tf.Summary.Value(tag=prefix + k, simple_value=v)]) for k,v in self.scalars.items()]
 
 
+class EvaluationReducer(object):
+    """ Builds an `Evaluation` incrementally from the batches of a dataset """
+
+    def update(self, data: List, outputs: Dict[str, Any]):
+        """ Add a batch of examples, `outputs` are the results of `Evaluator.process_batch` for that batch """
+        raise NotImplementedError()
+
+    def finalize(self, true_len) -> Evaluation:
+        raise NotImplementedError()
+
+
+class ConcatReducer(EvaluationReducer):
+    """ Stores every batch so they can be concatenated and passed into `evaluator.evaluate` """
+
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.data = []
+        self.outputs = []
+
+    def update(self, data: List, outputs: Dict[str, Any]):
+        self.data += data
+        self.outputs.append(outputs)
+
+    def finalize(self, true_len) -> Evaluation:
+        if len(self.outputs) == 0:
+            args = {}
+        else:
+            args = {k: _concat_batches([x[k] for x in self.outputs]) for k in self.outputs[0]}
+        return self.evaluator.evaluate(self.data, true_len, **args)
+
+
+class SumReducer(EvaluationReducer):
+    """
+    Keeps running sums of the outputs along the batch dimension, and builds the evaluation with
+    `summarize(sums, n_examples, true_len)`
+    """
+
+    def __init__(self, summarize):
+        self.summarize = summarize
+        self.sums = None
+        self.n_examples = 0
+
+    def update(self, data: List, outputs: Dict[str, Any]):
+        self.n_examples += len(data)
+        if self.sums is None:
+            self.sums = {k: np.sum(v, axis=0) for k, v in outputs.items()}
+        else:
+            for k, v in outputs.items():
+                self.sums[k] += np.sum(v, axis=0)
+
+    def finalize(self, true_len) -> Evaluation:
+        return self.summarize(self.sums, self.n_examples, true_len)
+
+
+class PerSampleReducer(EvaluationReducer):
+    """ Concatenates per-example outputs into the `per_sample` field of an `Evaluation` """
+
+    def __init__(self):
+        self.outputs = []
+
+    def update(self, data: List, outputs: Dict[str, Any]):
+        self.outputs.append(outputs)
+
+    def finalize(self, true_len) -> Evaluation:
+        if len(self.outputs) == 0:
+            return Evaluation({}, {})
+        return Evaluation({}, {k: _concat_batches([x[k] for x in self.outputs]) for k in self.outputs[0]})
+
+
 class Evaluator(Configurable):
     """ Class to generate statistics on a model's output for some data"""
 
@@ -57,10 +130,27 @@ class Evaluator(Configurable):
         be passed into `build_summary` as numpy arrays """
         raise NotImplementedError()
 
+    def process_batch(self, data: List, **kwargs) -> Dict[str, Any]:
+        """
+        Work to do on the variables requested from `tensors_needed` for a single batch of `data`, such as
+        scoring the predicted text. Runners can run this in worker threads while the model runs on the next batch.
+        The outputs for each batch are concatenated along the batch dimension and passed into `evaluate`,
+        by default the variables are passed on unchanged
+        """
+        return kwargs
+
+    def begin(self) -> EvaluationReducer:
+        """
+        Start evaluating a dataset, returns a reducer that receives the output of `process_batch` for each batch
+        as they are computed. By default the outputs are all stored and passed to `evaluate`, evaluators can
+        instead return reducers that only keep summary statistics so the memory used is bounded
+        """
+        return ConcatReducer(self)
+
     def evaluate(self, input: List, true_len,  **kwargs) -> Evaluation:
         """
         Build a summary given the input data `input` and the result of the variables requested
-        from `tensors_needed`. `true_len` is the total number of examples seen (or an approximation)
+        from `tensors_needed`, after they have been passed through `process_batch`. `true_len` is the total number of examples seen (or an approximation)
         excluding any pre-filtering that was done, its used for the case where some examples could not be
         processed by the model (e.g. too large) and were removed, but we still want to report
         accurate percentages on the entire dataset.
@@ -99,7 +189,7 @@ class SpanProbability(Evaluator):
     def tensors_needed(self, prediction):
         return dict(p1=prediction.start_probs, p2=prediction.end_probs)
 
-    def evaluate(self, data: List[ContextAndQuestion], true_len, p1, p2):
+    def process_batch(self, data: List[ContextAndQuestion], p1, p2):
         start_probs = []
         end_probs = []
         for ix, point in enumerate(data):
@@ -117,10 +207,17 @@ class SpanProbability(Evaluator):
             end_probs.append(end_prob)
         start_probs = np.array(start_probs)
         end_probs = np.array(end_probs)
+        return dict(start=start_probs, end=end_probs, span=start_probs*end_probs)
+
+    def _summarize(self, sums, n_examples, true_len):
         prefix = "span-prob/"
-        return Evaluation({prefix + "start": np.mean(start_probs),
-                           prefix + "span": np.mean(start_probs*end_probs),
-                           prefix + "end": np.mean(end_probs)})
+        return Evaluation({prefix + k: sums[k] / n_examples for k in ["start", "span", "end"]})
+
+    def begin(self):
+        return SumReducer(self._summarize)
+
+    def evaluate(self, data: List[ContextAndQuestion], true_len, **kwargs):
+        return self._summarize({k: v.sum(axis=0) for k, v in kwargs.items()}, len(data), true_len)
 
 
 def span_scores(data: List[ContextAndQuestion], prediction):
@@ -221,20 +318,24 @@ class SpanEvaluator(Evaluator):
     def tensors_needed(self, prediction):
         return {str(b): prediction.get_best_span(b)[0] for b in self.bound}
 
-    def evaluate(self, data: List[ContextAndQuestion], true_len, **kwargs):
-        ev = Evaluation({})
+    def process_batch(self, data: List[ContextAndQuestion], **kwargs):
+        out = {}
         for b in self.bound:
             best_spans = kwargs[str(b)]
             if self.text_eval is None:
-                scores = span_scores(data, best_spans)
+                out[str(b)] = span_scores(data, best_spans)
             elif self.text_eval == "triviaqa":
-                scores = trivia_span_scores(data, best_spans)
+                out[str(b)] = trivia_span_scores(data, best_spans)
             elif self.text_eval == "squad":
-                scores = squad_span_scores(data, best_spans)
+                out[str(b)] = squad_span_scores(data, best_spans)
             else:
                 raise RuntimeError()
+        return out
 
-            scores = scores.sum(axis=0) / true_len
+    def _summarize(self, sums, n_examples, true_len):
+        ev = Evaluation({})
+        for b in self.bound:
+            scores = sums[str(b)] / true_len
 
             prefix = "b%d/"%b
             out = {
@@ -248,6 +349,12 @@ class SpanEvaluator(Evaluator):
             ev.add(Evaluation(out))
         return ev
 
+    def begin(self):
+        return SumReducer(self._summarize)
+
+    def evaluate(self, data: List[ContextAndQuestion], true_len, **kwargs):
+        return self._summarize({k: v.sum(axis=0) for k, v in kwargs.items()}, len(data), true_len)
+
 
 class MultiParagraphSpanEvaluator(Evaluator):
     """
@@ -281,15 +388,18 @@ class MultiParagraphSpanEvaluator(Evaluator):
         span, score = prediction.get_best_span(self.bound)
         return dict(span=span, score=score)
 
-    def evaluate(self, data: List[ContextAndQuestion], true_len, **kwargs):
-        best_spans = kwargs["span"]
-        span_logits = kwargs["score"]
+    def process_batch(self, data: List[ContextAndQuestion], **kwargs):
         if self.eval == "triviaqa":
-            scores = trivia_span_scores(data, best_spans)
+            scores = trivia_span_scores(data, kwargs["span"])
         elif self.eval == "squad":
-            scores = squad_span_scores(data, best_spans)
+            scores = squad_span_scores(data, kwargs["span"])
         else:
             raise RuntimeError()
+        return dict(text_scores=scores, score=kwargs["score"])
+
+    def evaluate(self, data: List[ContextAndQuestion], true_len, **kwargs):
+        scores = kwargs["text_scores"]
+        span_logits = kwargs["score"]
 
         has_answer = np.array([len(x.answer.answer_spans) > 0 for x in data])
 
@@ -346,13 +456,20 @@ class ConfidenceSpanEvaluator(Evaluator):
             needed["none_prob"] = prediction.none_prob
         return needed
 
-    def evaluate(self, data: List[ContextAndQuestion], true_len, **kargs):
+    def process_batch(self, data: List[ContextAndQuestion], **kargs):
         if self.text_eval == "triviaqa":
             scores = trivia_span_scores(data, kargs["spans"])
         elif self.text_eval == "squad":
             scores = squad_span_scores(data, kargs["spans"])
         else:
             raise RuntimeError()
+        out = dict(text_scores=scores, conf=kargs["conf"])
+        if "none_prob" in kargs:
+            out["none_prob"] = kargs["none_prob"]
+        return out
+
+    def evaluate(self, data: List[ContextAndQuestion], true_len, **kargs):
+        scores = kargs["text_scores"]
 
         has_answer = [len(x.answer.answer_spans) > 0 for x in data]
         aggregated_scores = scores[has_answer].mean(axis=0)
@@ -382,13 +499,67 @@ class ConfidenceSpanEvaluator(Evaluator):
         return Evaluation(scalars)
 
 
+def encode_in_order(model: Model, batches, is_train: bool, n_workers: int, prefetch: int,
+                    stats: Optional[Dict[str, float]]=None):
+    """
+    Yields (batch, `model.encode(batch, is_train)`) pairs in the same order as `batches`. If `prefetch` > 0
+    batches are encoded by `n_workers` threads while the caller is busy with the previous ones, keeping up
+    to max(`prefetch`, `n_workers`) batches in flight. If `stats` is given, time spent waiting
+    for an encoded batch is added to `stats["encode_wait"]`
+    """
+    if prefetch <= 0:
+        for batch in batches:
+            t0 = time.perf_counter()
+            encoded = model.encode(batch, is_train)
+            if stats is not None:
+                stats["encode_wait"] += time.perf_counter() - t0
+            yield batch, encoded
+        return
+
+    def get_result(future):
+        t0 = time.perf_counter()
+        result = future.result()
+        if stats is not None:
+            stats["encode_wait"] += time.perf_counter() - t0
+        return result
+
+    with ThreadPoolExecutor(n_workers) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, pool.submit(model.encode, batch, is_train)))
+            if len(pending) > max(prefetch, n_workers):
+                batch, encoded = pending.popleft()
+                yield batch, get_result(encoded)
+        while len(pending) > 0:
+            batch, encoded = pending.popleft()
+            yield batch, get_result(encoded)
+
+
+def _concat_batches(values: List):
+    """ Concatenate the per-batch outputs of a tensor or `Evaluator.process_batch` along the batch dim """
+    if all(np.isscalar(x) or (isinstance(x, np.ndarray) and x.ndim == 0) for x in values):
+        return np.array(values)  # List of scalars -> array
+    if all(isinstance(x, np.ndarray) for x in values) and len(set(x.shape[1:] for x in values)) == 1:
+        return np.concatenate(values, axis=0)
+    # Variable sized outputs, so convert to flat python-list
+    return flatten_iterable(values)
+
+
 class EvaluatorRunner(object):
-    """ Knows how to run a list of evaluators """
+    """
+    Knows how to run a list of evaluators. If `prefetch` > 0, up to `prefetch` batches are encoded ahead of the
+    model using `n_encoding_workers` threads, and if `n_postprocess_workers` > 0 `Evaluator.process_batch`
+    is run in that many threads while the model runs on the next batch
+    """
 
-    def __init__(self, evaluators: List[Evaluator], model: Model):
+    def __init__(self, evaluators: List[Evaluator], model: Model,
+                 n_encoding_workers: int=1, prefetch: int=0, n_postprocess_workers: int=0):
         self.evaluators = evaluators
         self.tensors_needed = None
         self.model = model
+        self.n_encoding_workers = n_encoding_workers
+        self.prefetch = prefetch
+        self.n_postprocess_workers = n_postprocess_workers
 
     def set_input(self, prediction: Prediction):
         tensors_needed = []
@@ -396,47 +567,44 @@ class EvaluatorRunner(object):
             tensors_needed.append(ev.tensors_needed(prediction))
         self.tensors_needed = tensors_needed
 
-    def run_evaluators(self, sess: tf.Session, dataset: Dataset, name, n_sample=None, feed_dict=None) -> Evaluation:
-        all_tensors_needed = list(set(flatten_iterable(x.values() for x in self.tensors_needed)))
-
-        tensors = {x: [] for x in all_tensors_needed}
-
-        if n_sample is None:
-            batches, n_batches = dataset.get_epoch(), len(dataset)
-        else:
-            batches, n_batches = dataset.get_samples(n_sample)
-
-        data_used = []
-
-        for batch in tqdm(batches, total=n_batches, desc=name, ncols=80):
-            feed_dict = self.model.encode(batch, is_train=False)
-            output = sess.run(all_tensors_needed, feed_dict=feed_dict)
-            data_used += batch
-            for i in range(len(all_tensors_needed)):
-                tensors[all_tensors_needed[i]].append(output[i])
-
-        # flatten the input
-        for k in all_tensors_needed:
-            v = tensors[k]
-            if len(k.shape) == 0:
-                v = np.array(v)  # List of scalars
-            elif any(x is None for x in k.shape.as_list()):
-                # Variable sized tensors, so convert to flat python-list
-                v = flatten_iterable(v)
-            else:
-                v = np.concatenate(v, axis=0)  # concat along the batch dim
-            tensors[k] = v
+    def _process_batch(self, data: List, fetched: Dict) -> List[Dict[str, Any]]:
+        return [ev.process_batch(data, **{k: fetched[v] for k, v in needed.items()})
+                for ev, needed in zip(self.evaluators, self.tensors_needed)]
+
+    def _reduce(self, fetched_batches, dataset) -> Evaluation:
+        """ Process and reduce (batch, fetched tensors) pairs from `fetched_batches` in order """
+        reducers = [ev.begin() for ev in self.evaluators]
+        n_examples = 0
+
+        def update(data, processed):
+            for reducer, out in zip(reducers, processed):
+                reducer.update(data, out)
+
+        with ThreadPoolExecutor(max(self.n_postprocess_workers, 1)) as post_pool:
+            pending = deque()
+            for data, fetched in fetched_batches:
+                n_examples += len(data)
+                if self.n_postprocess_workers > 0:
+                    pending.append((data, post_pool.submit(self._process_batch, data, fetched)))
+                    # Only let a few batches wait to be reduced, so we don't hold onto their tensors
+                    while len(pending) > self.n_postprocess_workers:
+                        data, processed = pending.popleft()
+                        update(data, processed.result())
+                else:
+                    update(data, self._process_batch(data, fetched))
+            while len(pending) > 0:
+                data, processed = pending.popleft()
+                update(data, processed.result())
 
         percent_filtered = dataset.percent_filtered()
         if percent_filtered is None:
-            true_len = len(data_used)
+            true_len = n_examples
         else:
-            true_len = len(data_used) * 1 / (1 - percent_filtered)
+            true_len = n_examples * 1 / (1 - percent_filtered)
 
         combined = None
-        for ev, needed in zip(self.evaluators, self.tensors_needed):
-            args = {k: tensors[v] for k, v in needed.items()}
-            evaluation = ev.evaluate(data_used, true_len, **args)
+        for ev, reducer in zip(self.evaluators, reducers):
+            evaluation = reducer.finalize(true_len)
             if evaluation is None:
                 raise ValueError(ev)
             if combined is None:
@@ -446,11 +614,32 @@ class EvaluatorRunner(object):
 
         return combined
 
+    def run_evaluators(self, sess: tf.Session, dataset: Dataset, name, n_sample=None, feed_dict=None) -> Evaluation:
+        all_tensors_needed = list(set(flatten_iterable(x.values() for x in self.tensors_needed)))
+
+        if n_sample is None:
+            batches, n_batches = dataset.get_epoch(), len(dataset)
+        else:
+            batches, n_batches = dataset.get_samples(n_sample)
+
+        def fetch_batches():
+            encoded_batches = encode_in_order(self.model, batches, False, self.n_encoding_workers, self.prefetch)
+            for batch, feed_dict in tqdm(encoded_batches, total=n_batches, desc=name, ncols=80):
+                output = sess.run(all_tensors_needed, feed_dict=feed_dict)
+                yield batch, dict(zip(all_tensors_needed, output))
+
+        return self._reduce(fetch_batches(), dataset)
+
 
-class AysncEvaluatorRunner(object):
-    """ Knows how to run a list of evaluators use a tf.Queue to feed in the data """
+class AysncEvaluatorRunner(EvaluatorRunner):
+    """
+    Knows how to run a list of evaluators use a tf.Queue to feed in the data, batches are encoded
+    by `n_encoding_workers` threads and post-processed as in `EvaluatorRunner`
+    """
 
-    def __init__(self, evaluators: List[Evaluator], model: Model, queue_size: int):
+    def __init__(self, evaluators: List[Evaluator], model: Model, queue_size: int,
+                 n_encoding_workers: int=1, n_postprocess_workers: int=0):
+        super().__init__(evaluators, model, n_encoding_workers, 0, n_postprocess_workers)
         placeholders = model.get_placeholders()
         self.eval_queue = tf.FIFOQueue(queue_size, [x.dtype for x in placeholders],
                                   name="eval_queue")
@@ -461,80 +650,45 @@ class AysncEvaluatorRunner(object):
         # Queue in this form has not shape info, so we have to add it in back here
         for x, p in zip(placeholders, self.dequeue_op):
             p.set_shape(x.shape)
-        self.evaluators = evaluators
         self.queue_size = self.eval_queue.size()
-        self.model = model
-        self.tensors_needed = None
-
-    def set_input(self, prediction: Prediction):
-        tensors_needed = []
-        for ev in self.evaluators:
-            tensors_needed.append(ev.tensors_needed(prediction))
-        self.tensors_needed = tensors_needed
 
     def run_evaluators(self, sess: tf.Session, dataset, name, n_sample, feed_dict) -> Evaluation:
         all_tensors_needed = list(set(flatten_iterable(x.values() for x in self.tensors_needed)))
 
-        tensors = {x: [] for x in all_tensors_needed}
-
-        data_used = []
+        # batches that have been enqueued, in order
+        data_queue = Queue()
         if n_sample is None:
             batches, n_batches = dataset.get_epoch(), len(dataset)
         else:
             batches, n_batches = dataset.get_samples(n_sample)
 
+        # With one worker we still encode in the enqueue thread, otherwise keep each worker busy
+        prefetch = 0 if self.n_encoding_workers <= 1 else self.n_encoding_workers
+
         def enqueue_eval():
             try:
-                for data in batches:
-                    encoded = self.model.encode(data, False)
-                    data_used.append(data)
+                for data, encoded in encode_in_order(self.model, batches, False, self.n_encoding_workers, prefetch):
+                    # Added before enqueuing, so the batch is always available once its been dequeued
+                    data_queue.put(data)
                     sess.run(self.enqueue_op, encoded)
             except Exception as e:
                 sess.run(self.close_queue)  # Crash the main thread
                 raise e
             # we should run out of batches and exit gracefully
 
+        def fetch_batches():
+            for _ in tqdm(range(n_batches), total=n_batches, desc=name, ncols=80):
+                output = sess.run(all_tensors_needed, feed_dict=feed_dict)
+                yield data_queue.get(), dict(zip(all_tensors_needed, output))
+
         th = Thread(target=enqueue_eval)
 
         th.daemon = True
         th.start()
-        for _ in tqdm(range(n_batches), total=n_batches, desc=name, ncols=80):
-            output = sess.run(all_tensors_needed, feed_dict=feed_dict)
-            for i in range(len(all_tensors_needed)):
-                tensors[all_tensors_needed[i]].append(output[i])
+        evaluation = self._reduce(fetch_batches(), dataset)
         th.join()
 
         if sess.run(self.queue_size) != 0:
             raise RuntimeError("All batches should be been consumed")
 
-        # flatten the input
-        for k in all_tensors_needed:
-            v = tensors[k]
-            if len(k.shape) == 0:
-                v = np.array(v)  # List of scalars -> array
-            elif any(x is None for x in k.shape.as_list()[1:]):
-                # Variable sized tensors, so convert to flat python-list
-                v = flatten_iterable(v)
-            else:
-                v = np.concatenate(v, axis=0)  # concat along the batch dim
-            tensors[k] = v
-
-        # flatten the data if it consists of batches
-        if isinstance(data_used[0], List):
-            data_used = flatten_iterable(data_used)
-
-        if dataset.percent_filtered() is None:
-            true_len = len(data_used)
-        else:
-            true_len = len(data_used) * 1 / (1 - dataset.percent_filtered())
-
-        combined = None
-        for ev, needed in zip(self.evaluators, self.tensors_needed):
-            args = {k: tensors[v] for k, v in needed.items()}
-            evaluation = ev.evaluate(data_used, true_len, **args)
-            if combined is None:
-                combined = evaluation
-            else:
-                combined.add(evaluation)
-
-        return combined
+        return evaluation
@@ -5,6 +5,8 @@ import numpy as np
 import tensorflow as tf
 
 from docqa.configurable import Configurable
+from docqa.data_processing.compact_vocab import CompactVocab
+from docqa.data_processing.word_vectors import stack_word_vectors, StoredWordVectors
 from docqa.nn.layers import Encoder
 from docqa.utils import ResourceLoader
 
@@ -31,6 +33,10 @@ class WordEmbedder(Configurable):
     def context_word_to_ix(self, word, is_train) -> int:
         raise NotImplementedError()
 
+    def words_to_ix(self, words: List[str], is_train) -> np.ndarray:
+        """ Map a list of context words to ids, only used if `query_once` is False """
+        return np.array([self.context_word_to_ix(w, is_train) for w in words], dtype=np.int32)
+
     def query_once(self) -> bool:
         """
         Should the embedder be queried once for each unique word in the input, or once for each word.
@@ -194,6 +200,7 @@ class FixedWordEmbedder(WordEmbedder):
         # Built in `init`
         self._word_to_ix = None
         self._word_emb_mat = None
+        self._shared_matrix = None
         self._special_tokens = None
 
     def set_vocab(self, _, loader: ResourceLoader, special_tokens: List[str]):
@@ -218,6 +225,12 @@ class FixedWordEmbedder(WordEmbedder):
         else:
             return ix
 
+    def words_to_ix(self, words: List[str], is_train) -> np.ndarray:
+        if not isinstance(self._word_to_ix, CompactVocab):
+            # Loaded from an older pickle, or set directly
+            self._word_to_ix = CompactVocab(self._word_to_ix)
+        return self._word_to_ix.words_to_ix(words, 1)
+
     @property
     def version(self):
         # added `cpu`
@@ -236,11 +249,15 @@ class FixedWordEmbedder(WordEmbedder):
             word_to_vec = loader.load_word_vec(self.vec_name, voc)
         else:
             word_to_vec = loader.load_word_vec(self.vec_name)
-            voc = set(word_to_vec.keys())
+        shared = isinstance(word_to_vec, StoredWordVectors) and word_to_vec.shared
 
         self._word_to_ix = {}
+        self._shared_matrix = None
 
-        dim = next(iter(word_to_vec.values())).shape[0]
+        if shared:
+            dim = word_to_vec.matrix.shape[1]
+        else:
+            dim = next(iter(word_to_vec.values())).shape[0]
 
         null_embed = tf.zeros((1, dim), dtype=tf.float32)
         unk_embed = tf.get_variable(shape=(1, dim), name="unk_embed",
@@ -261,26 +278,69 @@ class FixedWordEmbedder(WordEmbedder):
                 self._word_to_ix[token] = ix
                 ix += 1
 
-        mat = []
+        if shared:
+            # Pre-trained words get the id of their row in the shared matrix (offset by the learned
+            # embeddings), so `embed` can read the vectors from it directly. Other workers will
+            # memory-map the vocab built by the first worker if the loader supports it
+            n_learned = ix
+
+            def build_word_to_ix():
+                word_to_ix = dict(self._word_to_ix)
+                words = self._get_pretrained_words(word_to_vec, word_to_ix, voc, ix)
+                word_to_row = word_to_vec.word_to_row
+                for word in words:
+                    word_to_ix[word] = n_learned + word_to_row[word]
+                return word_to_ix
+
+            load_vocab = getattr(loader, "load_vocab", None)
+            if load_vocab is None:
+                self._word_to_ix = CompactVocab(build_word_to_ix())
+            else:
+                self._word_to_ix = load_vocab(self.vec_name, voc, "\n".join(self._word_to_ix), build_word_to_ix)
+            self._shared_matrix = word_to_vec.matrix
+        else:
+            mat = self._get_pretrained_words(word_to_vec, self._word_to_ix, voc, ix)
+            matrix_list.append(tf.constant(value=stack_word_vectors(word_to_vec, mat)))
+            self._word_to_ix = CompactVocab(self._word_to_ix)
+
+        self._word_emb_mat = tf.concat(matrix_list, axis=0)
+
+    @staticmethod
+    def _get_pretrained_words(word_to_vec, word_to_ix, voc, ix) -> List[str]:
+        """ Adds the words in `voc` we have vectors for to `word_to_ix`, starting at `ix` """
+        if voc is None:
+            voc = set(word_to_vec.keys())
+        mat = []  # words to get vectors for
         for word in voc:
-            if word in self._word_to_ix:
+            if word in word_to_ix:
                 continue  # in case we already added due after seeing a capitalized version of `word`
             if word in word_to_vec:
-                mat.append(word_to_vec[word])
-                self._word_to_ix[word] = ix
+                mat.append(word)
+                word_to_ix[word] = ix
                 ix += 1
             else:
                 lower = word.lower()  # Full back to the lower-case version
-                if lower in word_to_vec and lower not in self._word_to_ix:
-                    mat.append(word_to_vec[lower])
-                    self._word_to_ix[lower] = ix
+                if lower in word_to_vec and lower not in word_to_ix:
+                    mat.append(lower)
+                    word_to_ix[lower] = ix
                     ix += 1
 
         print("Had pre-trained word embeddings for %d of %d words" % (len(mat), len(voc)))
-
-        matrix_list.append(tf.constant(value=np.vstack(mat)))
-
-        self._word_emb_mat = tf.concat(matrix_list, axis=0)
+        return mat
+
+    def _lookup(self, word_ix):
+        if self._shared_matrix is None:
+            return tf.nn.embedding_lookup(self._word_emb_mat, word_ix)
+        # Ids past the learned embeddings are rows of the shared matrix, which we read with numpy
+        # so the matrix is never copied into the graph
+        matrix = self._shared_matrix
+        n_learned = tf.shape(self._word_emb_mat)[0]
+        is_learned = word_ix < n_learned
+        learned = tf.nn.embedding_lookup(self._word_emb_mat, tf.where(is_learned, word_ix, tf.zeros_like(word_ix)))
+        fixed = tf.py_func(lambda x: matrix[x], [tf.maximum(word_ix - n_learned, 0)], tf.float32, stateful=False)
+        fixed.set_shape(word_ix.shape.concatenate([matrix.shape[1]]))
+        is_learned = tf.expand_dims(tf.cast(is_learned, tf.float32), -1)
+        return learned * is_learned + fixed * (1 - is_learned)
 
     def embed(self, is_train, *word_ix):
         if any(len(x) != 2 for x in word_ix):
@@ -297,14 +357,15 @@ class FixedWordEmbedder(WordEmbedder):
                           lambda: mat)
         if self.cpu:
             with tf.device("/cpu:0"):
-                return [tf.nn.embedding_lookup(self._word_emb_mat, x[0]) for x in word_ix]
+                return [self._lookup(x[0]) for x in word_ix]
         else:
-            return [tf.nn.embedding_lookup(self._word_emb_mat, x[0]) for x in word_ix]
+            return [self._lookup(x[0]) for x in word_ix]
 
     def __getstate__(self):
         state = dict(self.__dict__)
         state["_word_emb_mat"] = None  # we will rebuild these anyway
         state["_word_to_ix"] = None
+        state["_shared_matrix"] = None
         return dict(version=self.version, state=state)
 
     def __setstate__(self, state):
@@ -317,6 +378,8 @@ class FixedWordEmbedder(WordEmbedder):
                 state["state"]["keep_word"] = 1.0
             if "_special_tokens" not in state["state"]:
                 state["state"]["_special_tokens"] = []
+            if "_shared_matrix" not in state["state"]:
+                state["state"]["_shared_matrix"] = None
         super().__setstate__(state)
 
 
@@ -345,6 +408,7 @@ class FixedWordEmbedderPlaceholders(WordEmbedder):
         # Built in `init`
         self._word_to_ix = None
         self._word_emb_mat = None
+        self._shared_matrix = None
         self._special_tokens = None
 
     def set_vocab(self, _, loader: ResourceLoader, special_tokens: List[str]):
@@ -411,24 +475,24 @@ class FixedWordEmbedderPlaceholders(WordEmbedder):
                 self._word_to_ix[token] = ix
                 ix += 1
 
-        mat = []
+        mat = []  # words to get vectors for
         for word in voc:
             if word in self._word_to_ix:
                 continue  # in case we already added due after seeing a capitalized version of `word`
             if word in word_to_vec:
-                mat.append(word_to_vec[word])
+                mat.append(word)
                 self._word_to_ix[word] = ix
                 ix += 1
             else:
                 lower = word.lower()  # Full back to the lower-case version
                 if lower in word_to_vec and lower not in self._word_to_ix:
-                    mat.append(word_to_vec[lower])
+                    mat.append(lower)
                     self._word_to_ix[lower] = ix
                     ix += 1
 
         print("Had pre-trained word embeddings for %d of %d words" % (len(mat), len(voc)))
 
-        mat = np.vstack(mat)
+        mat = stack_word_vectors(word_to_vec, mat)
         if self.placeholder_flag:
             mat = np.concatenate([mat, np.zeros((len(mat), 1), dtype=np.float32)], axis=1)
         matrix_list.append(tf.constant(value=mat))
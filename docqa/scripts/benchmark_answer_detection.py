@@ -0,0 +1,53 @@
+import argparse
+import string
+import time
+
+import numpy as np
+
+from docqa.triviaqa.answer_detection import FastNormalizedAnswerDetector, MultiPatternAnswerDetector
+
+"""
+Measure paragraphs/sec when detecting answer aliases with `FastNormalizedAnswerDetector` and
+`MultiPatternAnswerDetector` on synthetic questions and documents
+"""
+
+
+def build_synthetic_data(n_questions, n_aliases, n_paragraphs, n_tokens):
+    rng = np.random.RandomState(0)
+    chars = np.array(list(string.ascii_lowercase))
+    # Use a small vocab with plenty of articles so partial matches are common
+    voc = ["".join(rng.choice(chars, rng.randint(1, 6))) for _ in range(500)] + ["the", "a", "an"] * 20
+    questions = []
+    for _ in range(n_questions):
+        aliases = [[voc[j] for j in rng.randint(0, len(voc), rng.randint(1, 5))] for _ in range(n_aliases)]
+        paragraphs = [[[voc[j] for j in rng.randint(0, len(voc), n_tokens)]] for _ in range(n_paragraphs)]
+        questions.append((aliases, paragraphs))
+    return questions
+
+
+def run(detector, questions):
+    n_found = 0
+    t0 = time.perf_counter()
+    for aliases, paragraphs in questions:
+        detector.set_question(aliases)
+        for para in paragraphs:
+            n_found += len(detector.any_found(para))
+    return sum(len(x[1]) for x in questions) / (time.perf_counter() - t0), n_found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark answer alias detection")
+    parser.add_argument("-q", "--n_questions", type=int, default=100)
+    parser.add_argument("-a", "--n_aliases", type=int, default=30, help="Aliases per a question")
+    parser.add_argument("-p", "--n_paragraphs", type=int, default=50, help="Paragraphs per a question")
+    parser.add_argument("-t", "--n_tokens", type=int, default=100, help="Tokens per a paragraph")
+    args = parser.parse_args()
+
+    questions = build_synthetic_data(args.n_questions, args.n_aliases, args.n_paragraphs, args.n_tokens)
+    for name, detector in [("fast", FastNormalizedAnswerDetector()), ("multi-pattern", MultiPatternAnswerDetector())]:
+        speed, n_found = run(detector, questions)
+        print("%s: %.1f paragraphs/sec (%d spans found)" % (name, speed, n_found))
+
+
+if __name__ == "__main__":
+    main()
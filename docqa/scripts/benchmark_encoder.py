@@ -0,0 +1,86 @@
+import argparse
+import string
+import time
+
+import numpy as np
+
+from docqa.data_processing.qa_training_data import ParagraphAndQuestion, ParagraphAndQuestionSpec
+from docqa.encoder import DocumentAndQuestionEncoder, SingleSpanAnswerEncoder
+from docqa.nn.embedder import FixedWordEmbedder, LearnedCharEmbedder
+
+"""
+Micro-benchmark for `DocumentAndQuestionEncoder.encode`, compares the per-token loop
+with the vectorized encoding path on synthetic TriviaQA-sized batches
+"""
+
+
+def build_vocab(rng, n_words):
+    chars = np.array(list(string.ascii_letters))
+    return ["".join(rng.choice(chars, rng.randint(1, 15))) for _ in range(n_words)]
+
+
+def build_batches(rng, voc, n_batches, batch_size, n_context_words, n_question_words):
+    # Zipf-ish word frequencies so common words repeat as they would in real text
+    p = 1.0 / np.arange(1, len(voc) + 1)
+    p /= p.sum()
+    batches = []
+    for _ in range(n_batches):
+        batch = []
+        for i in range(batch_size):
+            context = [voc[j] for j in rng.choice(len(voc), n_context_words, p=p)]
+            question = [voc[j] for j in rng.choice(len(voc), n_question_words, p=p)]
+            batch.append(ParagraphAndQuestion(context, question, None, str(i)))
+        batches.append(batch)
+    return batches
+
+
+def build_encoder(voc, vectorize, word_size_th):
+    word_emb = FixedWordEmbedder("bench")
+    # Bypass `init` so we don't need real word vectors, drop some words so the lower-case fall-back is exercised
+    word_emb._word_to_ix = {w: i + 2 for i, w in enumerate(voc[::2])}
+    char_emb = LearnedCharEmbedder(word_size_th, 1, 20)
+    char_emb._char_to_ix = {c: i + 2 for i, c in enumerate(string.ascii_letters)}
+    encoder = DocumentAndQuestionEncoder(SingleSpanAnswerEncoder(), vectorize=vectorize)
+    encoder.init(ParagraphAndQuestionSpec(None), True, word_emb, char_emb)
+    return encoder
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the loop vs. vectorized encoder")
+    parser.add_argument("--batch_size", type=int, default=200)
+    parser.add_argument("--n_context_words", type=int, default=400)
+    parser.add_argument("--n_question_words", type=int, default=15)
+    parser.add_argument("--n_batches", type=int, default=5)
+    parser.add_argument("--voc_size", type=int, default=50000)
+    parser.add_argument("--word_size_th", type=int, default=14)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    voc = build_vocab(rng, args.voc_size)
+    batches = build_batches(rng, voc, args.n_batches, args.batch_size, args.n_context_words, args.n_question_words)
+
+    print("Encoding %d batches of %d x %d tokens" % (args.n_batches, args.batch_size, args.n_context_words))
+    outputs = []
+    for vectorize in [False, True]:
+        encoder = build_encoder(voc, vectorize, args.word_size_th)
+        encoded = []
+        t0 = time.perf_counter()
+        for batch in batches:
+            encoded.append(encoder.encode(batch, False))
+        elapsed = time.perf_counter() - t0
+        print("%s: %.4f seconds per batch" % ("vectorized" if vectorize else "loop", elapsed / len(batches)))
+        if vectorize and encoder.char_cache is not None:
+            cache = encoder.char_cache
+            print("char cache: %d words, %d hits, %d misses (%.4f hit rate)" %
+                  (len(cache), cache.hits, cache.misses, cache.hit_rate()))
+        outputs.append([[feed[pl] for pl in encoder.get_placeholders()] for feed in encoded])
+
+    for loop_arrays, vec_arrays in zip(*outputs):
+        for a, b in zip(loop_arrays, vec_arrays):
+            if a.dtype != b.dtype or not np.array_equal(a, b):
+                raise RuntimeError("Encodings did not match")
+    print("Encodings are identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import string
+import tempfile
+import time
+from os import makedirs
+from os.path import join
+
+import numpy as np
+
+from docqa.triviaqa.build_packed_evidence import build_packed_corpus
+from docqa.triviaqa.evidence_corpus import TriviaQaEvidenceCorpusTxt, TriviaQaEvidenceCorpusPacked
+
+"""
+Measure documents/sec when loading evidence documents from the text corpus and from the packed corpus
+"""
+
+
+def build_synthetic_corpus(directory, n_docs, n_tokens):
+    rng = np.random.RandomState(0)
+    chars = np.array(list(string.ascii_letters))
+    voc = ["".join(rng.choice(chars, rng.randint(1, 12))) for _ in range(20000)]
+    makedirs(join(directory, "web"))
+    for i in range(n_docs):
+        words = [voc[j] for j in rng.randint(0, len(voc), n_tokens)]
+        sents = [" ".join(words[j:j+25]) for j in range(0, n_tokens, 25)]
+        paras = ["\n".join(sents[j:j+5]) for j in range(0, len(sents), 5)]
+        with open(join(directory, "web", "doc%d.txt" % i), "w") as f:
+            f.write("\n\n".join(paras))
+
+
+def run(corpus, doc_ids, n_tokens, flat):
+    t0 = time.perf_counter()
+    for doc_id in doc_ids:
+        corpus.get_document(doc_id, n_tokens, flat)
+    return len(doc_ids) / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading evidence documents")
+    parser.add_argument("--packed_dir", help="Packed corpus to use, default to the one in the corpus directory")
+    parser.add_argument("--synthetic", type=int, default=None,
+                        help="Build and use a synthetic corpus with this many documents")
+    parser.add_argument("--doc_tokens", type=int, default=5000, help="Tokens per synthetic document")
+    parser.add_argument("-n", "--n_docs", type=int, default=1000, help="Number of documents to load")
+    parser.add_argument("--n_tokens", type=int, default=800, help="Tokens to read for the first-n benchmark")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.synthetic is not None:
+            txt = TriviaQaEvidenceCorpusTxt()
+            txt.directory = join(tmp, "txt")
+            print("Building synthetic corpus...")
+            build_synthetic_corpus(txt.directory, args.synthetic, args.doc_tokens)
+            build_packed_corpus(txt, join(tmp, "packed"))
+            packed = TriviaQaEvidenceCorpusPacked(directory=join(tmp, "packed"))
+        else:
+            txt = TriviaQaEvidenceCorpusTxt()
+            packed = TriviaQaEvidenceCorpusPacked(directory=args.packed_dir)
+
+        doc_ids = txt.list_documents()
+        doc_ids = [doc_ids[i] for i in np.random.RandomState(0).permutation(len(doc_ids))[:args.n_docs]]
+        for doc_id in doc_ids[:50]:
+            if txt.get_document(doc_id) != packed.get_document(doc_id):
+                raise ValueError("Corpora do not match for " + doc_id)
+
+        for name, n_tokens, flat in [("full", None, False), ("first-%d" % args.n_tokens, args.n_tokens, False),
+                                     ("flat", None, True)]:
+            print("%s: txt %.1f docs/sec, packed %.1f docs/sec" % (
+                name, run(txt, doc_ids, n_tokens, flat), run(packed, doc_ids, n_tokens, flat)))
+
+
+if __name__ == "__main__":
+    main()
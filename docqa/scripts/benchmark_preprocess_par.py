@@ -0,0 +1,71 @@
+import argparse
+import pickle
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from docqa.data_processing.preprocessed_corpus import Preprocessor, FilteredData, preprocess_par_iter, \
+    _get_chunk_ranges, _preprocess_and_count
+from docqa.triviaqa.evidence_corpus import TriviaQaEvidenceCorpusTxt
+
+"""
+Measure the bytes sent to worker processes and the run time of `preprocess_par_iter`, compared to
+sending the evidence and preprocessor with every chunk (how `preprocess_par` used to work)
+"""
+
+
+class SyntheticPreprocessor(Preprocessor):
+    """ Does a small amount of work per question, but has a lot of state like our paragraph rankers """
+
+    def __init__(self, state_size):
+        self.weights = np.random.RandomState(0).uniform(size=state_size)
+        self.stop = set("stop%d" % i for i in range(state_size // 10))
+
+    def preprocess(self, questions, evidence):
+        return FilteredData([(q, sum(w in self.stop for w in q)) for q in questions], len(questions))
+
+
+def _preprocess_chunk(args):
+    # Old approach, each task includes the evidence and preprocessor
+    return _preprocess_and_count(*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the IPC overhead of preprocess_par_iter")
+    parser.add_argument("-q", "--n_questions", type=int, default=20000)
+    parser.add_argument("-d", "--n_documents", type=int, default=200000,
+                        help="Number of documents in the evidence file map")
+    parser.add_argument("-s", "--state_size", type=int, default=200000, help="Size of the preprocessor's state")
+    parser.add_argument("-n", "--n_processes", type=int, default=4)
+    parser.add_argument("-c", "--chunk_size", type=int, default=500)
+    args = parser.parse_args()
+
+    questions = [["word%d" % i, "stop%d" % (i % 1000), "q"] for i in range(args.n_questions)]
+    evidence = TriviaQaEvidenceCorpusTxt({"doc%d" % i: "dir/doc%d" % i for i in range(args.n_documents)})
+    preprocessor = SyntheticPreprocessor(args.state_size)
+    chunks = _get_chunk_ranges(len(questions), args.n_processes, args.chunk_size)
+
+    static_bytes = len(pickle.dumps((evidence, preprocessor)))
+    old_bytes = sum(len(pickle.dumps((questions[s:e], evidence, preprocessor))) for s, e in chunks)
+    new_bytes = sum(len(pickle.dumps((s, e))) for s, e in chunks)
+    init_bytes = len(pickle.dumps((questions, evidence, preprocessor))) * args.n_processes
+    print("%d chunks, evidence + preprocessor are %.1f MB pickled" % (len(chunks), static_bytes / 1e6))
+    print("Task bytes per chunk: %.1f MB total" % (old_bytes / 1e6))
+    print("Task bytes with an initializer: %.3f MB total (+%.1f MB of initializer "
+          "arguments if workers are spawned rather than forked)" % (new_bytes / 1e6, init_bytes / 1e6))
+
+    t0 = time.perf_counter()
+    with Pool(args.n_processes) as pool:
+        n = sum(len(out.data) for out, _ in pool.imap(
+            _preprocess_chunk, [(questions[s:e], evidence, preprocessor) for s, e in chunks]))
+    print("Per-chunk arguments: %d questions in %.2f seconds" % (n, time.perf_counter() - t0))
+
+    t0 = time.perf_counter()
+    n = sum(len(out.data) for out in preprocess_par_iter(
+        questions, evidence, preprocessor, args.n_processes, args.chunk_size))
+    print("Initializer: %d questions in %.2f seconds" % (n, time.perf_counter() - t0))
+
+
+if __name__ == "__main__":
+    main()
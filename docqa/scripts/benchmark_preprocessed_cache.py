@@ -0,0 +1,120 @@
+import argparse
+import gzip
+import pickle
+import string
+import tempfile
+import time
+from multiprocessing import get_context
+from os.path import join
+
+import numpy as np
+
+from docqa.data_processing.preprocessed_cache import write_preprocessed_cache, PreprocessedCache
+from docqa.data_processing.multi_paragraph_qa import MultiParagraphQuestion, DocumentParagraph
+from docqa.data_processing.preprocessed_corpus import FilteredData
+
+"""
+Compare the load time and peak memory use of the pickled and columnar preprocessed data caches.
+Each load is run in a fresh process so the peak RSS of the loads can be compared.
+"""
+
+
+def build_synthetic_questions(rng, n_questions, n_paragraphs, paragraph_len, vocab_size=50000):
+    chars = np.array(list(string.ascii_lowercase))
+    voc = ["".join(rng.choice(chars, rng.randint(1, 10))) for _ in range(vocab_size)]
+    questions = []
+    for i in range(n_questions):
+        paragraphs = []
+        for j in range(n_paragraphs):
+            text = [voc[k] for k in rng.randint(0, vocab_size, paragraph_len)]
+            spans = rng.randint(0, paragraph_len, (rng.randint(0, 3), 2)).astype(np.int32)
+            paragraphs.append(DocumentParagraph("doc%d" % rng.randint(0, n_questions), j * paragraph_len,
+                                                (j + 1) * paragraph_len, j, spans, text))
+        question = [voc[k] for k in rng.randint(0, vocab_size, 12)]
+        questions.append(MultiParagraphQuestion("q%d" % i, question, ["answer"], paragraphs))
+    return questions
+
+
+def _peak_rss():
+    """ Peak RSS of this process in kB, `getrusage` is not used since it is preserved across exec """
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+
+
+def _load(args):
+    mode, filename, splits = args
+    import docqa.data_processing.preprocessed_cache  # Count imports in the baseline memory use
+    baseline = _peak_rss()
+    t0 = time.perf_counter()
+    n_questions = 0
+    if mode == "pickle":
+        handle = gzip.open if filename.endswith("gz") else open
+        with handle(filename, "rb") as f:
+            _, train, dev, verified = pickle.load(f)
+        n_questions = sum(len(x.data) for name, x in [("train", train), ("dev", dev), ("verified_dev", verified)]
+                          if x is not None and name in splits)
+    else:
+        cache = PreprocessedCache(filename)
+        for name in splits:
+            if mode == "stream":
+                split = cache.get_split(name)
+                if split is not None:
+                    n_questions += sum(1 for _ in split)
+            else:
+                data = cache.load_split(name)
+                if data is not None:
+                    n_questions += len(data.data)
+    elapsed = time.perf_counter() - t0
+    return n_questions, elapsed, baseline, _peak_rss()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading preprocessed data caches")
+    parser.add_argument("cache", nargs="?", help="Existing pickled cache, if not given synthetic data is used")
+    parser.add_argument("--synthetic", type=int, default=5000, help="Number of synthetic train questions")
+    parser.add_argument("--paragraphs", type=int, default=4, help="Paragraphs per synthetic question")
+    parser.add_argument("--paragraph_len", type=int, default=400, help="Tokens per synthetic paragraph")
+    parser.add_argument("--gz", action="store_true", help="gzip the synthetic pickle")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.cache is None:
+            print("Building synthetic data...")
+            rng = np.random.RandomState(0)
+            train = build_synthetic_questions(rng, args.synthetic, args.paragraphs, args.paragraph_len)
+            dev = build_synthetic_questions(rng, args.synthetic // 10, args.paragraphs, args.paragraph_len)
+            stored = [None, FilteredData(train, len(train)), FilteredData(dev, len(dev)), None]
+            pickle_file = join(tmp, "data.pkl" + (".gz" if args.gz else ""))
+            handle = (lambda a, b: gzip.open(a, b, compresslevel=3)) if args.gz else open
+            with handle(pickle_file, "wb") as f:
+                pickle.dump(stored, f)
+        else:
+            pickle_file = args.cache
+            handle = gzip.open if pickle_file.endswith("gz") else open
+            with handle(pickle_file, "rb") as f:
+                stored = pickle.load(f)
+
+        print("Writing columnar cache...")
+        t0 = time.perf_counter()
+        columnar = join(tmp, "columnar")
+        write_preprocessed_cache(columnar, stored[0], dict(train=stored[1], dev=stored[2], verified_dev=stored[3]))
+        print("Wrote in %.2f seconds" % (time.perf_counter() - t0))
+        del stored
+
+        all_splits = ["train", "dev", "verified_dev"]
+        ctx = get_context("spawn")
+        for name, mode, filename, splits in [("pickle", "pickle", pickle_file, all_splits),
+                                             ("columnar", "load", columnar, all_splits),
+                                             ("columnar (stream)", "stream", columnar, all_splits),
+                                             ("pickle (dev only)", "pickle", pickle_file, ["dev"]),
+                                             ("columnar (dev only)", "load", columnar, ["dev"])]:
+            with ctx.Pool(1) as pool:
+                n, elapsed, baseline, peak = pool.apply(_load, [(mode, filename, splits)])
+            print("%s: %d questions in %.2f seconds, peak RSS %.1f MB (+%.1f MB)" % (
+                name, n, elapsed, peak / 1024, (peak - baseline) / 1024))
+
+
+if __name__ == "__main__":
+    main()
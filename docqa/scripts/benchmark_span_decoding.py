@@ -0,0 +1,53 @@
+import argparse
+import time
+
+import numpy as np
+
+from docqa.data_processing.span_data import get_best_span, get_best_span_bounded, get_best_span_batch
+
+"""
+Measure examples/sec when finding the best spans with the per-example loops and `get_best_span_batch`
+"""
+
+
+def run_loop(p1, p2, lens, bound):
+    t0 = time.perf_counter()
+    for i, n in enumerate(lens):
+        if bound is None:
+            get_best_span(p1[i, :n], p2[i, :n])
+        else:
+            get_best_span_bounded(p1[i, :n], p2[i, :n], bound)
+    return len(lens) / (time.perf_counter() - t0)
+
+
+def run_batch(p1, p2, lens, bound):
+    t0 = time.perf_counter()
+    mask = np.arange(p1.shape[1])[None, :] < lens[:, None]
+    get_best_span_batch(p1, p2, bound, mask)
+    return len(lens) / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark best span decoding")
+    parser.add_argument("-b", "--batch_size", type=int, default=200)
+    parser.add_argument("-t", "--n_tokens", type=int, default=400, help="Max tokens per an example")
+    parser.add_argument("-n", "--n_batches", type=int, default=20)
+    parser.add_argument("--bounds", type=int, nargs="+", default=[8, 17])
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    batches = []
+    for _ in range(args.n_batches):
+        p1 = rng.uniform(0, 1, (args.batch_size, args.n_tokens)).astype(np.float32)
+        p2 = rng.uniform(0, 1, (args.batch_size, args.n_tokens)).astype(np.float32)
+        lens = rng.randint(args.n_tokens // 2, args.n_tokens + 1, args.batch_size)
+        batches.append((p1, p2, lens))
+
+    for bound in [None] + args.bounds:
+        loop = np.mean([run_loop(p1, p2, lens, bound) for p1, p2, lens in batches])
+        batch = np.mean([run_batch(p1, p2, lens, bound) for p1, p2, lens in batches])
+        print("bound=%s: loop %.1f examples/sec, batched %.1f examples/sec" % (bound, loop, batch))
+
+
+if __name__ == "__main__":
+    main()
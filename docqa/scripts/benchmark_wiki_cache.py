@@ -0,0 +1,72 @@
+import argparse
+import string
+import tempfile
+import time
+import ujson
+from os.path import join
+
+import numpy as np
+
+from docqa.server.wiki import WikiParagraph, WikiArticle, WikiArticleCache
+
+"""
+Micro-benchmark for wiki article cache hits, compares loading the per-title json files the
+`WikiCorpus` used to write with the sqlite-backed `WikiArticleCache`
+"""
+
+
+def build_article(rng, title, n_paragraphs, n_words):
+    chars = np.array(list(string.ascii_letters))
+    voc = ["".join(rng.choice(chars, rng.randint(1, 12))) for _ in range(2000)]
+    paragraphs = []
+    for i in range(n_paragraphs):
+        words = [voc[j] for j in rng.randint(0, len(voc), n_words)]
+        text = [words[j:j+20] for j in range(0, n_words, 20)]
+        original_text = " ".join(words)
+        ends = np.cumsum([len(w) + 1 for w in words]) - 1
+        spans = np.stack([ends - np.array([len(w) for w in words]), ends], 1).astype(np.int32)
+        paragraphs.append(WikiParagraph(i, "paragraph", text, original_text, spans))
+    return WikiArticle(title, i, paragraphs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark wiki article cache hits")
+    parser.add_argument("-n", "--n_articles", type=int, default=20)
+    parser.add_argument("-p", "--n_paragraphs", type=int, default=80)
+    parser.add_argument("-w", "--n_words", type=int, default=100)
+    parser.add_argument("-r", "--n_reads", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    articles = [build_article(rng, "Article %d" % i, args.n_paragraphs, args.n_words)
+                for i in range(args.n_articles)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for article in articles:
+            with open(join(tmp, article.title + ".json"), "w") as f:
+                ujson.dump(dict(title=article.title, url=article.url,
+                                paragraphs=[x.to_json() for x in article.paragraphs]), f)
+        t0 = time.perf_counter()
+        for _ in range(args.n_reads):
+            for article in articles:
+                with open(join(tmp, article.title + ".json"), "r") as f:
+                    data = ujson.load(f)
+                WikiArticle(data["title"], data["url"], [WikiParagraph.from_json(x) for x in data["paragraphs"]])
+        n = args.n_reads * len(articles)
+        print("json: %.3f ms per article" % ((time.perf_counter() - t0) * 1000 / n))
+
+        for n_hot, name in [(0, "sqlite"), (len(articles), "sqlite+memory")]:
+            cache = WikiArticleCache(join(tmp, "articles-%d.sqlite" % n_hot), n_hot=n_hot)
+            for article in articles:
+                cache.put(article.title, article)
+            t0 = time.perf_counter()
+            for _ in range(args.n_reads):
+                for article in articles:
+                    cache.get(article.title)
+            print("%s: %.3f ms per article" % (name, (time.perf_counter() - t0) * 1000 / n))
+            print("%s: %.1f kb per article" % (name, cache.size / 1024 / len(articles)))
+            cache.close()
+
+
+if __name__ == "__main__":
+    main()
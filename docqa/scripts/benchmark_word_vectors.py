@@ -0,0 +1,70 @@
+import argparse
+import string
+import tempfile
+import time
+from os.path import join
+
+import numpy as np
+
+from docqa.data_processing.word_vectors import load_word_vector_file
+
+"""
+Measure lines/sec when parsing a word vector text file with the serial and multi-process parsers
+"""
+
+
+def build_synthetic_vectors(filename, n_words, dim):
+    rng = np.random.RandomState(0)
+    chars = np.array(list(string.ascii_letters))
+    with open(filename, "w", encoding="utf-8") as f:
+        for i in range(n_words):
+            word = "".join(rng.choice(chars, rng.randint(1, 12))) + str(i)
+            f.write(word + " " + " ".join("%.5f" % x for x in rng.uniform(-1, 1, dim)) + "\n")
+
+
+def count_lines(filename):
+    with open(filename, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def run(vec_path, vocab, n_processes):
+    t0 = time.perf_counter()
+    vecs = load_word_vector_file(vec_path, vocab, n_processes)
+    return vecs, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsing word vector files")
+    parser.add_argument("vec_file", nargs="?", help="Text file of vectors, if not given a synthetic file is used")
+    parser.add_argument("--synthetic", type=int, default=200000, help="Number of words in the synthetic file")
+    parser.add_argument("--dim", type=int, default=300, help="Dimension of the synthetic vectors")
+    parser.add_argument("-v", "--voc", help="Only keep words in this file (one word per line)")
+    parser.add_argument("-n", "--n_processes", type=int, nargs="+", default=[2, 4, 8])
+    args = parser.parse_args()
+
+    vocab = None
+    if args.voc is not None:
+        with open(args.voc, "r", encoding="utf-8") as f:
+            vocab = [x.rstrip() for x in f]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        vec_path = args.vec_file
+        if vec_path is None:
+            vec_path = join(tmp, "vecs.txt")
+            print("Building synthetic vectors...")
+            build_synthetic_vectors(vec_path, args.synthetic, args.dim)
+
+        n_lines = count_lines(vec_path)
+        expected, elapsed = run(vec_path, vocab, 1)
+        print("serial: %d lines in %.2f seconds, %.0f lines/sec" % (n_lines, elapsed, n_lines / elapsed))
+        for n_processes in args.n_processes:
+            actual, elapsed = run(vec_path, vocab, n_processes)
+            if list(actual.keys()) != list(expected.keys()) or \
+                    any(not np.array_equal(v, expected[k]) for k, v in actual.items()):
+                raise ValueError("Parallel parse did not match the serial parse")
+            print("%d processes: %d lines in %.2f seconds, %.0f lines/sec" % (
+                n_processes, n_lines, elapsed, n_lines / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+import numpy as np
+
+"""
+Run blocking work (tokenization, `model.encode`, `sess.run`) off the event loop, so it does not stall
+other in-flight requests
+"""
+
+
+class InferenceQueueFull(Exception):
+    """ Raised when too many tasks are already waiting for the inference threads """
+    pass
+
+
+class InferenceExecutor(object):
+    """
+    Thread pool with a bounded queue. Coroutines `await run(fn, *args)`, and get an `InferenceQueueFull`
+    error instead of waiting indefinitely if `max_queue_size` tasks are already waiting for a thread.
+    Also tracks the queue depth and how long tasks waited before starting.
+    """
+
+    def __init__(self, n_threads: int=1, max_queue_size: int=32, n_wait_samples: int=1000, loop=None):
+        """
+        :param n_threads: Number of threads to run tasks with
+        :param max_queue_size: Max number of tasks that can be waiting for a thread
+        :param n_wait_samples: Number of recent wait times to keep for the percentile metrics
+        """
+        if n_threads <= 0:
+            raise ValueError("n_threads must be > 0, but got %d" % n_threads)
+        if max_queue_size < 0:
+            raise ValueError("max_queue_size must be >= 0, but got %d" % max_queue_size)
+        self.n_threads = n_threads
+        self.max_queue_size = max_queue_size
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self._pool = ThreadPoolExecutor(n_threads)
+        # Tasks wait here for a free thread, so the pool's own (unbounded) queue stays empty
+        self._free_threads = asyncio.Semaphore(n_threads)
+
+        self.queue_depth = 0
+        self.n_running = 0
+        self.n_completed = 0
+        self.n_rejected = 0
+        self._waits = deque(maxlen=n_wait_samples)
+
+    async def run(self, fn, *args):
+        if self.queue_depth >= self.max_queue_size and self._free_threads.locked():
+            self.n_rejected += 1
+            raise InferenceQueueFull("%d tasks are already waiting" % self.queue_depth)
+
+        t0 = time.perf_counter()
+        self.queue_depth += 1
+        try:
+            await self._free_threads.acquire()
+        finally:
+            self.queue_depth -= 1
+        self._waits.append(time.perf_counter() - t0)
+
+        self.n_running += 1
+        try:
+            return await self.loop.run_in_executor(self._pool, fn, *args)
+        finally:
+            self.n_running -= 1
+            self.n_completed += 1
+            self._free_threads.release()
+
+    def get_metrics(self) -> Dict:
+        out = dict(queue_depth=self.queue_depth, running=self.n_running,
+                   completed=self.n_completed, rejected=self.n_rejected)
+        if len(self._waits) > 0:
+            waits = np.array(self._waits) * 1000
+            out["wait_ms_mean"] = float(waits.mean())
+            out["wait_ms_p50"] = float(np.percentile(waits, 50))
+            out["wait_ms_p99"] = float(np.percentile(waits, 99))
+        return out
+
+    def close(self):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import logging
+import time
+
+import numpy as np
+
+from docqa.data_processing.document_splitter import MergeParagraphs, ShallowOpenWebRanker
+from docqa.model_dir import ModelDir
+from docqa.server.qa_system import QaSystem
+from docqa.server.server import RandomPredictor
+from docqa.text_preprocessor import WithIndicators
+from docqa.utils import ResourceLoader, LoadFromPath
+
+"""
+Load test for the `QaSystem` model runs, sends many concurrent `answer_with_doc` requests
+and reports throughput and latency percentiles, with and without micro-batching
+"""
+
+QUESTIONS = [
+    "Who wrote this document?",
+    "When was it written?",
+    "Where did the events take place?",
+    "What is the main topic of the text?",
+    "Which country is mentioned the most?",
+    "How many people were involved?",
+]
+
+
+async def run_load(qa: QaSystem, questions, doc, n_requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def answer(question):
+        async with semaphore:
+            t0 = time.perf_counter()
+            await qa.answer_with_doc(question, doc)
+            latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[answer(questions[i % len(questions)]) for i in range(n_requests)])
+    return time.perf_counter() - t0, np.array(latencies)
+
+
+def report(name, elapsed, latencies):
+    print("%s: %d requests in %.3f seconds, %.2f requests/sec, p50=%.1fms p99=%.1fms" % (
+        name, len(latencies), elapsed, len(latencies) / elapsed,
+        np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test QaSystem model runs")
+    parser.add_argument("model", help="Model to use, or \"random\" to use a random predictor")
+    parser.add_argument("document", help="Text file to use as the document for each question")
+    parser.add_argument("--questions", help="File with one question per line")
+    parser.add_argument("-v", "--voc", help="vocab to use, only words from this file will be used")
+    parser.add_argument("--vec_dir", help="Location to find word vectors")
+    parser.add_argument("-n", "--n_requests", type=int, default=200)
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-t", "--tokens", type=int, default=400,
+                        help="Number of tokens to use per paragraph")
+    parser.add_argument("--n_paragraphs", type=int, default=15,
+                        help="Number of paragraphs to run the model on")
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--max_batch_wait_ms", type=float, default=5)
+    parser.add_argument("--n_inference_threads", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    with open(args.document, "r") as f:
+        doc = f.read()
+    if args.questions is not None:
+        with open(args.questions, "r") as f:
+            questions = [x.strip() for x in f if len(x.strip()) > 0]
+    else:
+        questions = QUESTIONS
+
+    if args.model == "random":
+        model = RandomPredictor(5, WithIndicators())
+    else:
+        model = ModelDir(args.model)
+    loader = ResourceLoader() if args.vec_dir is None else LoadFromPath(args.vec_dir)
+
+    loop = asyncio.get_event_loop()
+
+    async def build():
+        return QaSystem(None, MergeParagraphs(args.tokens), ShallowOpenWebRanker(args.n_paragraphs),
+                        args.voc, model, loader, tagme_threshold=None, n_web_docs=0,
+                        max_batch_size=args.max_batch_size, max_batch_wait_ms=args.max_batch_wait_ms,
+                        n_inference_threads=args.n_inference_threads,
+                        max_inference_queue=args.n_requests, loop=loop)
+    qa = loop.run_until_complete(build())
+
+    # Warm up, so we don't include tensorflow's first-run overhead
+    loop.run_until_complete(run_load(qa, questions, doc, args.concurrency, args.concurrency))
+
+    scheduler = qa.scheduler
+    qa.scheduler = None
+    elapsed, latencies = loop.run_until_complete(run_load(qa, questions, doc, args.n_requests, args.concurrency))
+    report("unbatched", elapsed, latencies)
+
+    qa.scheduler = scheduler
+    n_runs, n_requests = scheduler.n_runs, scheduler.n_requests
+    elapsed, latencies = loop.run_until_complete(run_load(qa, questions, doc, args.n_requests, args.concurrency))
+    report("batched", elapsed, latencies)
+    n_runs, n_requests = scheduler.n_runs - n_runs, scheduler.n_requests - n_requests
+    print("Batched run used %d model runs for %d requests (%.2f requests per run)" % (
+        n_runs, n_requests, n_requests / n_runs))
+    print("Inference executor: " + ", ".join("%s=%s" % (k, v) for k, v in sorted(qa.executor.get_metrics().items())))
+    qa.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from typing import List, Callable, Awaitable
+
+import numpy as np
+
+from docqa.data_processing.qa_training_data import ContextAndQuestion
+
+"""
+Coalesce model runs from concurrent questions, so the server can make a few large `sess.run` calls
+instead of many small ones while under load
+"""
+
+
+class SpanScoreScheduler(object):
+    """
+    Collects span-score requests from concurrent questions and runs them together. Requests are held
+    for at most `max_wait_ms`, or until `max_batch_size` paragraphs are pending, then all pending paragraphs are
+    sorted by length, split into batches of at most `max_batch_size` paragraphs, and run through `run_fn`.
+    The (n_paragraphs, n_tokens, n_tokens) span scores are then scattered back to each caller.
+    """
+
+    def __init__(self, run_fn: Callable[[List[ContextAndQuestion]], Awaitable[np.ndarray]],
+                 max_batch_size: int, max_wait_ms: float, loop=None):
+        """
+        :param run_fn: Coroutine function that maps a batch of question/paragraph pairs to a
+                       (batch, n_tokens, n_tokens) array of span scores, where padding tokens have a score of zero
+        :param max_batch_size: Max number of paragraphs to pass to `run_fn` at once
+        :param max_wait_ms: Max time to wait for more requests before running the pending requests
+        """
+        if max_batch_size <= 0:
+            raise ValueError("max_batch_size must be > 0, but got %d" % max_batch_size)
+        if max_wait_ms < 0:
+            raise ValueError("max_wait_ms must be >= 0, but got %s" % max_wait_ms)
+        self.log = logging.getLogger('qa_system')
+        self.run_fn = run_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+
+        self._pending = []  # List of (qa_pairs, future) tuples
+        self._n_pending = 0  # Number of pending paragraphs
+        self._flush_handle = None
+
+        # Statistics, mainly so we can see how much batching we are getting
+        self.n_requests = 0
+        self.n_runs = 0
+        self.n_paragraphs = 0
+
+    async def get_span_scores(self, qa_pairs: List[ContextAndQuestion]) -> np.ndarray:
+        if len(qa_pairs) == 0:
+            raise ValueError("No paragraphs given")
+        future = self.loop.create_future()
+        self._pending.append((qa_pairs, future))
+        self._n_pending += len(qa_pairs)
+        self.n_requests += 1
+        if self._n_pending >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.max_wait_ms / 1000.0, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending = self._pending
+        self._pending = []
+        self._n_pending = 0
+        if len(pending) > 0:
+            asyncio.ensure_future(self._run(pending), loop=self.loop)
+
+    async def _run(self, pending):
+        # Bucket by length so paragraphs in the same batch need a similar amount of padding
+        flat = [(req_ix, para_ix, pair) for req_ix, (pairs, _) in enumerate(pending)
+                for para_ix, pair in enumerate(pairs)]
+        flat.sort(key=lambda x: x[2].n_context_words)
+        results = [[None] * len(pairs) for pairs, _ in pending]
+
+        try:
+            for start in range(0, len(flat), self.max_batch_size):
+                batch = flat[start:start + self.max_batch_size]
+                scores = await self.run_fn([x[2] for x in batch])
+                self.n_runs += 1
+                self.n_paragraphs += len(batch)
+                for (req_ix, para_ix, pair), para_scores in zip(batch, scores):
+                    n_tokens = pair.n_context_words
+                    results[req_ix][para_ix] = para_scores[:n_tokens, :n_tokens]
+        except Exception as e:
+            self.log.info("Error computing span scores: " + str(e))
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.log.info("Computed span scores for %d questions and %d paragraphs" % (len(pending), len(flat)))
+        for (_, future), para_scores in zip(pending, results):
+            if future.done():  # caller was cancelled
+                continue
+            # Re-pad to this request's longest paragraph, as if it had been run alone
+            n_tokens = max(x.shape[0] for x in para_scores)
+            out = np.zeros((len(para_scores), n_tokens, n_tokens), dtype=para_scores[0].dtype)
+            for i, x in enumerate(para_scores):
+                out[i, :x.shape[0], :x.shape[1]] = x
+            future.set_result(out)
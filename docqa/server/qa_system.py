@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import re
 import time
@@ -12,7 +13,10 @@ from docqa.data_processing.qa_training_data import ParagraphAndQuestionSpec, Par
 from docqa.data_processing.text_utils import NltkAndPunctTokenizer, ParagraphWithInverse
 from docqa.doc_qa_models import ParagraphQuestionModel
 from docqa.model_dir import ModelDir
-from docqa.server.web_searcher import AsyncWebSearcher, AsyncBoilerpipeCliExtractor
+from docqa.server.inference_executor import InferenceExecutor
+from docqa.server.micro_batching import SpanScoreScheduler
+from docqa.server.web_searcher import AsyncWebSearcher, AsyncBoilerpipeCliExtractor, ExtractedWebDoc, \
+    AsyncPooledExtractor, AiohttpFetcher
 from docqa.server.wiki import WikiCorpus
 from docqa.utils import ResourceLoader
 
@@ -56,11 +60,22 @@ class QaSystem(object):
                  span_bound: int=8,
                  tagme_threshold: Optional[float]=0.2,
                  download_timeout: int=None,
+                 text_extractor: str="boilerpipe",
+                 n_extraction_processes: int=2,
                  n_web_docs=10,
+                 wiki_cache_size_mb: Optional[float]=None,
+                 wiki_timeout: Optional[float]=None,
+                 web_timeout: Optional[float]=None,
+                 max_batch_size: Optional[int]=None,
+                 max_batch_wait_ms: float=5,
+                 n_inference_threads: int=1,
+                 max_inference_queue: int=32,
                  loop=None):
         self.log = logging.getLogger('qa_system')
         self.tagme_threshold = tagme_threshold
         self.n_web_docs = n_web_docs
+        self.wiki_timeout = wiki_timeout
+        self.web_timeout = web_timeout
         self.blacklist_trivia_sites = blacklist_trivia_sites
         self.tagme_api_key = tagme_api_key
 
@@ -70,13 +85,20 @@ class QaSystem(object):
             if bing_version is None:
                 raise ValueError("Must specify a Bing version if using a bing_api key")
             self.searcher = AsyncWebSearcher(bing_api_key, bing_version, loop=loop)
-            self.text_extractor = AsyncBoilerpipeCliExtractor(n_dl_threads, download_timeout)
+            if text_extractor == "boilerpipe":
+                self.text_extractor = AsyncBoilerpipeCliExtractor(n_dl_threads, download_timeout)
+            elif text_extractor == "pooled":
+                self.text_extractor = AsyncPooledExtractor(AiohttpFetcher(n_dl_threads, loop=loop),
+                                                           n_extraction_processes, download_timeout, loop=loop)
+            else:
+                raise ValueError("Unknown text extractor: " + text_extractor)
         else:
             self.text_extractor = None
             self.searcher = None
 
         if self.tagme_threshold is not None:
-            self.wiki_corpus = WikiCorpus(wiki_cache, keep_inverse_mapping=True, loop=loop)
+            self.wiki_corpus = WikiCorpus(wiki_cache, keep_inverse_mapping=True,
+                                          cache_size_mb=wiki_cache_size_mb, loop=loop)
         else:
             self.wiki_corpus = None
 
@@ -115,6 +137,16 @@ class QaSystem(object):
         self.tokenizer = NltkAndPunctTokenizer()
         self.sess.graph.finalize()
 
+        # CPU-bound work is run on these threads so it does not block the event loop
+        self.executor = InferenceExecutor(n_inference_threads, max_inference_queue, loop=loop)
+
+        if max_batch_size is not None:
+            # Merge the paragraphs from concurrent questions into shared model runs
+            self.scheduler = SpanScoreScheduler(self._run_span_scores_async, max_batch_size,
+                                                max_batch_wait_ms, loop)
+        else:
+            self.scheduler = None
+
     def _preprocess(self, paragraphs: List[WebParagraph]) -> List[WebParagraph]:
         if self.model.preprocessor is not None:
             prepped = []
@@ -145,8 +177,7 @@ class QaSystem(object):
         paragraphs = self._preprocess(paragraphs)
         t0 = time.perf_counter()
         qa_pairs = [ParagraphAndQuestion(c.get_context(), question, None, "") for c in paragraphs]
-        encoded = self.model.encode(qa_pairs, False)
-        spans, scores = self.sess.run([self.span, self.score], encoded)
+        spans, scores = await self.executor.run(self._run_best_spans, qa_pairs)
         self.log.info("Computing answer spans took %.5f seconds" % (time.perf_counter() - t0))
         return spans, scores, paragraphs
 
@@ -160,14 +191,25 @@ class QaSystem(object):
         context = await self.get_question_context(question)
         question = self.tokenizer.tokenize_paragraph_flat(question)
         t0 = time.perf_counter()
-        out = self._get_span_scores(question, context)
+        out = await self._get_span_scores(question, context)
         self.log.info("Computing answer spans took %.5f seconds" % (time.perf_counter() - t0))
         return out
 
-    def answer_with_doc(self, question: str, doc: str) -> Tuple[np.ndarray, List[WebParagraph]]:
+    async def answer_with_doc(self, question: str, doc: str) -> Tuple[np.ndarray, List[WebParagraph]]:
         """ Answer a question using the given text as a document """
 
         self.log.info("Answering question \"%s\" with a given document" % question)
+        question, context = await self.executor.run(self._select_paragraphs, question, doc)
+        if len(context) == 0:
+            raise ValueError("Unable to process documents")
+
+        # Select the top answer span
+        t0 = time.perf_counter()
+        span_scores = await self._get_span_scores(question, context)
+        self.log.info("Computing answer spans took %.5f seconds" % (time.perf_counter() - t0))
+        return span_scores
+
+    def _select_paragraphs(self, question: str, doc: str) -> Tuple[List[str], List[WebParagraph]]:
         # Tokenize
         question = self.tokenizer.tokenize_paragraph_flat(question)
         context = [self.tokenizer.tokenize_with_inverse(x, False) for x in self._split_regex.split(doc)]
@@ -176,21 +218,26 @@ class QaSystem(object):
         context = self._split_document(context, "User", None)
 
         # Select top paragraphs
-        context = self.paragraph_selector.prune(question, context)
-        if len(context) == 0:
-            raise ValueError("Unable to process documents")
-
-        # Select the top answer span
-        t0 = time.perf_counter()
-        span_scores = self._get_span_scores(question, context)
-        self.log.info("Computing answer spans took %.5f seconds" % (time.perf_counter() - t0))
-        return span_scores
+        return question, self.paragraph_selector.prune(question, context)
 
-    def _get_span_scores(self, question: List[str], paragraphs: List[WebParagraph]):
+    async def _get_span_scores(self, question: List[str], paragraphs: List[WebParagraph]):
         paragraphs = self._preprocess(paragraphs)
         qa_pairs = [ParagraphAndQuestion(c.get_context(), question, None, "") for c in paragraphs]
+        if self.scheduler is None:
+            return await self._run_span_scores_async(qa_pairs), paragraphs
+        else:
+            return await self.scheduler.get_span_scores(qa_pairs), paragraphs
+
+    async def _run_span_scores_async(self, qa_pairs: List[ParagraphAndQuestion]) -> np.ndarray:
+        return await self.executor.run(self._run_span_scores, qa_pairs)
+
+    def _run_span_scores(self, qa_pairs: List[ParagraphAndQuestion]) -> np.ndarray:
+        encoded = self.model.encode(qa_pairs, False)
+        return self.sess.run(self.span_scores, encoded)
+
+    def _run_best_spans(self, qa_pairs: List[ParagraphAndQuestion]):
         encoded = self.model.encode(qa_pairs, False)
-        return self.sess.run(self.span_scores, encoded), paragraphs
+        return self.sess.run([self.span, self.score], encoded)
 
     def _split_document(self, para: List[ParagraphWithInverse], source_name: str,
                         source_url: Optional[str]):
@@ -215,69 +262,118 @@ class QaSystem(object):
             data = await resp.json()
         return [ann_json for ann_json in data["annotations"] if "title" in ann_json]
 
-    async def get_question_context(self, question: str) -> List[WebParagraph]:
-        """
-        Find a set of paragraphs from the web that are relevant to the given question
-        """
+    async def _get_wiki_paragraphs(self, question: str) -> List[WebParagraph]:
+        t0 = time.perf_counter()
+        self.log.info("Query tagme for %s", question)
+        tags = await asyncio.wait_for(self._tagme(question), self.wiki_timeout)
+        titles = []
+        for tag in tags:
+            if tag["rho"] >= self.tagme_threshold and tag["title"] not in titles:
+                titles.append(tag["title"])
+        if len(titles) == 0:
+            return []
+
+        # Fetch all the articles at once, and keep whatever we have once the deadline is reached
+        tasks = [asyncio.ensure_future(self.wiki_corpus.get_wiki_article(title)) for title in titles]
+        timeout = None if self.wiki_timeout is None else max(self.wiki_timeout - (time.perf_counter() - t0), 0)
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if len(pending) > 0:
+            self.log.warning("Timed out fetching %d of %d wiki articles", len(pending), len(tasks))
 
         tokenized_paragraphs = []
-        if self.tagme_threshold is not None:
-            self.log.info("Query tagme for %s", question)
-            tags = await self._tagme(question)
-            t0 = time.perf_counter()
-            found = set()
-            for tag in tags:
-                if tag["rho"] >= self.tagme_threshold:
-                    title = tag["title"]
-                    if title in found:
-                        continue
-                    found.add(title)
-                    doc = await self.wiki_corpus.get_wiki_article(title)
-                    tokenized_paragraphs += self._split_document(doc.paragraphs,
-                                                                 "Wikipedia: " + doc.title, doc.url)
-            if len(tokenized_paragraphs) > 0:
-                self.log.info("Getting wiki docs took %.5f seconds" % (time.perf_counter() - t0))
+        for title, task in zip(titles, tasks):
+            if task in pending:
+                continue
+            if task.exception() is not None:
+                self.log.warning("Error fetching wiki article \"%s\": %s", title, task.exception())
+                continue
+            doc = task.result()
+            tokenized_paragraphs += self._split_document(doc.paragraphs, "Wikipedia: " + doc.title, doc.url)
+        self.log.info("Getting wiki docs took %.5f seconds" % (time.perf_counter() - t0))
+        return tokenized_paragraphs
 
-        if self.n_web_docs > 0:
-            t0 = time.perf_counter()
-            self.log.info("Running bing search for %s", question)
-            search_results = await self.searcher.run_search(question, self.n_web_docs)
-            t1 = time.perf_counter()
-            self.log.info("Completed bing search, took %.5f seconds" % (t1 - t0))
-            t0 = t1
-            url_to_result = {x["url"]: x for x in search_results}
-            self.log.info("Extracting text for %d results", len(search_results))
-            text_docs = await self.text_extractor.get_text([x["url"] for x in search_results])
-
-            for doc in text_docs:
-                if len(doc.text) == 0:
+    async def _get_web_paragraphs(self, question: str) -> List[WebParagraph]:
+        t0 = time.perf_counter()
+        self.log.info("Running bing search for %s", question)
+        search_results = await self.searcher.run_search(question, self.n_web_docs)
+        t1 = time.perf_counter()
+        self.log.info("Completed bing search, took %.5f seconds" % (t1 - t0))
+        t0 = t1
+        url_to_result = {x["url"]: x for x in search_results}
+        self.log.info("Extracting text for %d results", len(search_results))
+        text_docs = await self.text_extractor.get_text([x["url"] for x in search_results])
+        tokenized_paragraphs = await self.executor.run(self._split_web_docs, text_docs, url_to_result)
+        self.log.info("Completed extracting text, took %.5f seconds." % (time.perf_counter() - t0))
+        return tokenized_paragraphs
+
+    def _split_web_docs(self, text_docs: List[ExtractedWebDoc], url_to_result) -> List[WebParagraph]:
+        tokenized_paragraphs = []
+        for doc in text_docs:
+            if len(doc.text) == 0:
+                continue
+            search_r = url_to_result[doc.url]
+            if self.blacklist_trivia_sites:
+                lower = search_r["displayUrl"].lower()
+                if 'quiz' in lower or 'trivia' in lower or 'answer' in lower:
+                    # heuristic to ignore trivia sites, recommend by Mandar
+                    self.log.debug("Skipping trivia site: " + lower)
                     continue
-                search_r = url_to_result[doc.url]
-                if self.blacklist_trivia_sites:
-                    lower = search_r["displayUrl"].lower()
-                    if 'quiz' in lower or 'trivia' in lower or 'answer' in lower:
-                        # heuristic to ignore trivia sites, recommend by Mandar
-                        self.log.debug("Skipping trivia site: " + lower)
-                        continue
 
-                paras_text = self._split_regex.split(doc.text.strip())
+            paras_text = self._split_regex.split(doc.text.strip())
 
-                paras_tokenized = [self.tokenizer.tokenize_with_inverse(x) for x in paras_text]
+            paras_tokenized = [self.tokenizer.tokenize_with_inverse(x) for x in paras_text]
 
-                tokenized_paragraphs += self._split_document(paras_tokenized, search_r["displayUrl"], doc.url)
+            tokenized_paragraphs += self._split_document(paras_tokenized, search_r["displayUrl"], doc.url)
+        return tokenized_paragraphs
+
+    async def get_question_context(self, question: str) -> List[WebParagraph]:
+        """
+        Find a set of paragraphs from the web that are relevant to the given question. Wikipedia and
+        web search are queried concurrently, if one source fails or times out we use the paragraphs
+        from the other sources
+        """
+
+        sources = []
+        if self.tagme_threshold is not None:
+            sources.append(("wiki", self._get_wiki_paragraphs(question), None))
+        if self.n_web_docs > 0:
+            sources.append(("web", self._get_web_paragraphs(question), self.web_timeout))
+
+        results = await asyncio.gather(*[asyncio.wait_for(coro, timeout) for _, coro, timeout in sources],
+                                       return_exceptions=True)
 
-            self.log.info("Completed extracting text, took %.5f seconds." % (time.perf_counter() - t0))
+        tokenized_paragraphs = []
+        errors = []
+        for (name, _, _), result in zip(sources, results):
+            if isinstance(result, asyncio.TimeoutError):
+                self.log.warning("Timed out getting paragraphs from %s", name)
+                errors.append(result)
+            elif isinstance(result, Exception):
+                self.log.warning("Error getting paragraphs from %s: %s", name, result)
+                errors.append(result)
+            else:
+                tokenized_paragraphs += result
+        if len(errors) == len(sources) and len(errors) > 0:
+            raise errors[0]
 
         self.log.info("Have %d paragraphs", len(tokenized_paragraphs))
         if len(tokenized_paragraphs) == 0:
             return []
+        return await self.executor.run(self._prune, question, tokenized_paragraphs)
+
+    def _prune(self, question: str, paragraphs: List[WebParagraph]) -> List[WebParagraph]:
         question = self.tokenizer.tokenize_sentence(question)
-        return self.paragraph_selector.prune(question, tokenized_paragraphs)
+        return self.paragraph_selector.prune(question, paragraphs)
 
     def close(self):
+        self.executor.close()
         if self.wiki_corpus is not None:
             self.wiki_corpus.close()
         if self.searcher is not None:
             self.searcher.close()
+        if isinstance(self.text_extractor, AsyncPooledExtractor):
+            self.text_extractor.close()
         self.sess.close()
         self.client_sess.close()
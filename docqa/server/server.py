@@ -14,12 +14,14 @@ from sanic.exceptions import ServerError
 from sanic.response import json
 
 from docqa.data_processing.document_splitter import MergeParagraphs, ShallowOpenWebRanker
-from docqa.data_processing.span_data import top_disjoint_spans
+from docqa.data_processing.span_data import top_disjoint_spans_batch
 from docqa.data_processing.text_utils import NltkAndPunctTokenizer
 from docqa.model import Model, Prediction
 from docqa.model_dir import ModelDir
 from docqa.nn.span_prediction import BoundaryPrediction
+from docqa.server.inference_executor import InferenceQueueFull
 from docqa.server.qa_system import WebParagraph, QaSystem
+from docqa.server.shared_vectors import SharedWordVectorLoader, get_memory_usage
 from docqa.text_preprocessor import WithIndicators
 from docqa.utils import ResourceLoader, LoadFromPath
 
@@ -59,12 +61,11 @@ def select_answers(paras: List[WebParagraph], span_scores, bound, n_spans) -> Li
     returns the resulting paragraphs sorted by most confidence answer
     """
     out = []
-    for para, score in zip(paras, span_scores):
-        n_tokens = len(para.spans)
-        # Score can contain other stuff due to padding
-        score = score[:n_tokens, :n_tokens]
-
-        top_n, top_n_scores = top_disjoint_spans(score, bound, n_spans, para.spans)
+    # Score can contain other stuff due to padding, so pass in the paragraph lengths
+    top_spans, top_scores = top_disjoint_spans_batch(span_scores, bound, n_spans,
+                                                     [len(para.spans) for para in paras],
+                                                     [para.spans for para in paras])
+    for para, top_n, top_n_scores in zip(paras, top_spans, top_scores):
         answers = []
         for score, (s, e) in zip(top_n_scores, top_n):
             s = para.spans[s][0]
@@ -95,7 +96,7 @@ class DummyQa():
         span_scores = np.random.normal(size=(2, len(para.spans), len(para.spans))) * 5
         return span_scores, [para1, para2]
 
-    def answer_with_doc(self, question: str, doc: str):
+    async def answer_with_doc(self, question: str, doc: str):
         return self.get_random_answer()
 
 
@@ -154,14 +155,38 @@ def main():
     parser.add_argument('--blacklist_trivia_sites', action="store_true",
                         help="Don't use trivia websites")
     parser.add_argument('-c', '--wiki_cache', help="Cache wiki articles in this directory")
+    parser.add_argument('--wiki_timeout', type=float, default=None,
+                        help="Max seconds to spend getting wiki articles, use the articles we have after that")
+    parser.add_argument('--web_timeout', type=float, default=None,
+                        help="Max seconds to spend on web search and text extraction")
+    parser.add_argument('--wiki_cache_size_mb', type=float, default=None,
+                        help="Evict the least recently used wiki articles once the cache is larger than this")
 
     parser.add_argument('--n_dl_threads', type=int, default=5,
                         help="Number of threads to download documents with")
+    parser.add_argument('--text_extractor', choices=["boilerpipe", "pooled"], default="boilerpipe",
+                        help="Extract text from web pages with the boilerpipe jar, or with a pool "
+                             "of python processes that are shared across requests")
+    parser.add_argument('--n_extraction_processes', type=int, default=2,
+                        help="Number of processes to use for the pooled text extractor")
     parser.add_argument('--request_timeout', type=int, default=60)
     parser.add_argument('--download_timeout', type=int, default=25,
                         help="Who long to wait before timing out downloads")
     parser.add_argument('--workers', type=int, default=1,
                         help="Number of server workers")
+    parser.add_argument('--shared_vectors_dir', default=None,
+                        help="Store the word vectors in this directory (e.g., /dev/shm) as a memory-mapped "
+                             "file so all the workers share one copy of them")
+    parser.add_argument('--max_batch_size', type=int, default=None,
+                        help="Merge paragraphs from concurrent questions into model runs of up to this many "
+                             "paragraphs, if not set each question is run separately")
+    parser.add_argument('--max_batch_wait_ms', type=float, default=5,
+                        help="Max time to wait for other questions to batch with")
+    parser.add_argument('--n_inference_threads', type=int, default=1,
+                        help="Number of threads to run tokenization and the model with")
+    parser.add_argument('--max_inference_queue', type=int, default=32,
+                        help="Max number of tasks waiting for an inference thread, "
+                             "requests are rejected with a 503 once this is reached")
     parser.add_argument('--debug', default=None, choices=["random_model", "dummy_qa"])
 
     args = parser.parse_args()
@@ -189,6 +214,8 @@ def main():
         loader = LoadFromPath(args.vec_dir)
     else:
         loader = ResourceLoader()
+    if args.shared_vectors_dir is not None:
+        loader = SharedWordVectorLoader(loader, args.shared_vectors_dir)
 
     # Update Sanic's logging to register our class's loggers
     log_config = LOGGING
@@ -247,11 +274,23 @@ def main():
                 n_dl_threads=args.n_dl_threads,
                 blacklist_trivia_sites=args.blacklist_trivia_sites,
                 download_timeout=args.download_timeout,
+                text_extractor=args.text_extractor,
+                n_extraction_processes=args.n_extraction_processes,
                 span_bound=span_bound,
                 tagme_threshold=None if (tagme_api_key is None) else args.tagme_thresh,
                 n_web_docs=args.n_web,
+                wiki_cache_size_mb=args.wiki_cache_size_mb,
+                wiki_timeout=args.wiki_timeout,
+                web_timeout=args.web_timeout,
+                max_batch_size=args.max_batch_size,
+                max_batch_wait_ms=args.max_batch_wait_ms,
+                n_inference_threads=args.n_inference_threads,
+                max_inference_queue=args.max_inference_queue,
+                loop=loop
             )
         app.qa = qa
+        log.info("Worker setup done, memory (kB): %s",
+                 ", ".join("%s=%d" % (k, v) for k, v in sorted(get_memory_usage().items())))
 
     @app.listener('after_server_stop')
     async def setup_qa(app, loop):
@@ -269,6 +308,9 @@ def main():
             best_span = max(answers[0].answers, key=lambda x: x.conf)
             log.info("Answered \"%s\" (with web search): \"%s\"", question, answers[0].original_text[best_span.start:best_span.end])
             return json([x.to_json() for x in answers])
+        except InferenceQueueFull as e:
+            log.info("Overloaded: " + str(e))
+            return response.json({'message': 'Server is overloaded, try again later'}, status=503)
         except Exception as e:
             log.info("Error: " + str(e))
             raise ServerError(e, status_code=500)
@@ -285,16 +327,30 @@ def main():
             doc = args["document"]
             if len(doc) > 500000:
                 raise ServerError("Document too large", status_code=400)
-            spans, paras = app.qa.answer_with_doc(question, doc)
+            spans, paras = await app.qa.answer_with_doc(question, doc)
             answers = select_answers(paras, spans, span_bound, 10)
             answers = answers[:n_to_return]
             best_span = max(answers[0].answers, key=lambda x: x.conf)
             log.info("Answered \"%s\" (with user doc): \"%s\"", question, answers[0].original_text[best_span.start:best_span.end])
             return json([x.to_json() for x in answers])
+        except InferenceQueueFull as e:
+            log.info("Overloaded: " + str(e))
+            return response.json({'message': 'Server is overloaded, try again later'}, status=503)
         except Exception as e:
             log.info("Error: " + str(e))
             raise ServerError(e, status_code=500)
 
+    @app.route("/inference-stats")
+    async def inference_stats(request):
+        executor = getattr(app.qa, "executor", None)
+        if executor is None:
+            return json({})
+        return json(executor.get_metrics())
+
+    @app.route("/memory-stats")
+    async def memory_stats(request):
+        return json(get_memory_usage())
+
     app.static('/', './docqa//server/static/index.html')
     app.static('/about.html', './docqa/server/static/about.html')
     app.run(host="0.0.0.0", port=8000, workers=args.workers, debug=False, log_config=LOGGING)
@@ -0,0 +1,114 @@
+import fcntl
+import hashlib
+from glob import glob
+from os import makedirs, rename, getpid
+from os.path import join, exists
+from shutil import rmtree
+from typing import Dict, Callable, Iterable, Optional
+
+from docqa.data_processing.compact_vocab import CompactVocab
+from docqa.data_processing.word_vectors import save_word_vector_store, load_word_vector_store
+from docqa.utils import ResourceLoader
+
+"""
+Share word vectors between server workers. Each worker builds its own `QaSystem`, so without this
+every worker loads (and parses) the word vectors separately and keeps its own copy of them.
+"""
+
+
+class SharedWordVectorLoader(ResourceLoader):
+    """
+    Wraps a `ResourceLoader` so the pruned word vectors are written once to `directory` as a memory-mapped
+    store, which workers then load read-only. The pages of the vector matrix are then shared by all
+    workers through the page cache, using a tmpfs directory such as /dev/shm keeps them in memory.
+    The vectors are marked as `shared`, so `FixedWordEmbedder` reads rows from the mapping instead of
+    copying the matrix into the graph, and it gets its `CompactVocab` from `load_vocab` so the
+    word -> id table is shared as well.
+
+    Files are keyed by the vector name and vocabulary, so they can also be re-used across restarts.
+    """
+
+    def __init__(self, loader: ResourceLoader, directory: str):
+        super().__init__()
+        self.loader = loader
+        self.directory = directory
+        if not exists(directory):
+            makedirs(directory)
+
+    def _prefix(self, vec_name, voc):
+        key = hashlib.sha1(vec_name.encode("utf-8"))
+        if voc is not None:
+            key.update("\n".join(sorted(voc)).encode("utf-8"))
+        return join(self.directory, "word-vecs-" + key.hexdigest())
+
+    def _build_once(self, prefix: str, is_built: Callable[[], bool], build: Callable[[], None]):
+        # Hold a lock while building, so concurrently starting workers wait for the first one
+        # rather than all building the files themselves. `prefix` is the prefix of the lock file
+        with open(prefix + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not is_built():
+                    build()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def load_word_vec(self, vec_name, voc=None):
+        prefix = self._prefix(vec_name, voc)
+
+        def build():
+            tmp = "%s.%d.tmp" % (prefix, getpid())
+            save_word_vector_store(self.loader.load_word_vec(vec_name, voc), tmp)
+            # Move the matrix last, since we use it to check if the store is complete
+            rename(tmp + ".words.txt", prefix + ".words.txt")
+            rename(tmp + ".npy", prefix + ".npy")
+
+        self._build_once(prefix, lambda: exists(prefix + ".npy"), build)
+        return load_word_vector_store(prefix, voc, shared=True)
+
+    def load_vocab(self, vec_name, voc: Optional[Iterable[str]], key: str,
+                   build_word_to_ix: Callable[[], Dict[str, int]]) -> CompactVocab:
+        """
+        Returns a memory-mapped `CompactVocab` of `build_word_to_ix()`, which is only called by the
+        first worker. `key` should identify anything other than the vectors and `voc` the table depends on.
+        """
+        # The table is keyed by the hash seed, so workers from different parents build their own
+        vec_prefix = self._prefix(vec_name, voc)
+        hash_key = CompactVocab.hash_key()
+        prefix = "%s-vocab-%s" % (vec_prefix, hashlib.sha1(("%d\n%s" % (hash_key, key)).encode("utf-8")).hexdigest())
+
+        def build():
+            # The hash seed changes when the server restarts, so tables from previous runs will never
+            # be used again. Remove them so they don't accumulate in the (possibly in-memory) directory
+            for old in glob(vec_prefix + "-vocab-*"):
+                if not old.endswith(".tmp") and CompactVocab.saved_hash_key(old) != hash_key:
+                    rmtree(old)
+            tmp = "%s.%d.tmp" % (prefix, getpid())
+            CompactVocab(build_word_to_ix()).save(tmp)
+            rename(tmp, prefix)  # Directory renames are atomic, so `prefix` is either complete or missing
+
+        # Lock on the vectors' lock file, which does not depend on the hash seed, so the clean up
+        # can't race with workers from another run building their tables
+        self._build_once(vec_prefix, lambda: exists(prefix), build)
+        return CompactVocab.load(prefix)
+
+
+def get_memory_usage() -> Dict[str, int]:
+    """
+    Memory use of this process in kB. "rss" counts shared pages in full, "pss" divides shared pages
+    between the processes sharing them, so summing "pss" over workers gives their total memory use
+    """
+    out = {}
+    for filename, fields in [("/proc/self/status", {"VmRSS": "rss", "VmHWM": "peak_rss"}),
+                             ("/proc/self/smaps_rollup", {"Pss": "pss", "Shared_Clean": "shared_clean",
+                                                          "Shared_Dirty": "shared_dirty",
+                                                          "Private_Clean": "private_clean",
+                                                          "Private_Dirty": "private_dirty"})]:
+        try:
+            with open(filename, "r") as f:
+                for line in f:
+                    name, value = line.split(":", 1)
+                    if name in fields:
+                        out[fields[name]] = int(value.split()[0])
+        except (IOError, ValueError):
+            pass  # Not on linux, or an older kernel without smaps_rollup
+    return out
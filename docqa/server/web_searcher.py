@@ -1,3 +1,4 @@
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict, Optional
 
 import logging
@@ -5,6 +6,7 @@ import logging
 import ujson
 import asyncio
 from aiohttp import ClientSession
+from bs4 import BeautifulSoup
 from os.path import exists
 
 BING_API = "https://api.cognitive.microsoft.com/bing/"
@@ -91,3 +93,96 @@ class AsyncBoilerpipeCliExtractor(object):
         if len(errors) > 0:
             self.log.info("%d extraction errors: %s" % (len(errors), str(list(errors.items()))))
         return [ExtractedWebDoc(url, ex[url]) for url in urls if url in ex]
+
+
+# Elements that break text into separate blocks
+_BLOCK_TAGS = ["p", "div", "li", "td", "blockquote", "pre", "article", "section",
+               "h1", "h2", "h3", "h4", "h5", "h6"]
+# Elements that are almost never part of the main text
+_BOILERPLATE_TAGS = ["script", "style", "noscript", "nav", "header", "footer", "aside", "form", "iframe"]
+
+
+def extract_main_text(html: str, min_words: int=8, max_link_density: float=0.33) -> str:
+    """
+    Python approximation of boilerpipe's extraction, split the document into leaf-level text blocks
+    and drop blocks that are short or mostly links (menus, link lists, footers, ect.). Returns
+    the remaining blocks separated by newlines.
+    """
+    soup = BeautifulSoup(html, "lxml")
+    for element in soup(_BOILERPLATE_TAGS):
+        element.decompose()
+
+    blocks = []
+    for element in soup.find_all(_BLOCK_TAGS):
+        if element.find(_BLOCK_TAGS) is not None:
+            continue  # text in this element will be part of its child blocks
+        words = element.get_text(" ").split()
+        if len(words) == 0:
+            continue
+        n_link_words = sum(len(a.get_text(" ").split()) for a in element.find_all("a"))
+        if n_link_words / len(words) > max_link_density:
+            continue
+        if len(words) < min_words and element.name[0] != "h":
+            continue
+        blocks.append(" ".join(words))
+    return "\n".join(blocks)
+
+
+class AiohttpFetcher(object):
+    """ Downloads the html for urls """
+
+    def __init__(self, max_concurrent: int=10, loop=None):
+        self.cl_sess = ClientSession(loop=loop)
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def fetch(self, url: str) -> str:
+        async with self._semaphore:
+            async with self.cl_sess.get(url) as resp:
+                if resp.status != 200:
+                    raise ValueError("Status %d" % resp.status)
+                return await resp.text()
+
+    def close(self):
+        self.cl_sess.close()
+
+
+class AsyncPooledExtractor(object):
+    """
+    Downloads documents from URLs and returns the extracted text, in-process alternative to
+    `AsyncBoilerpipeCliExtractor` that avoids starting a JVM for each question. Pages are downloaded
+    by `fetcher`, and text extraction is run by `extract_main_text` on a persistent process pool that
+    is shared by all concurrent questions.
+    """
+
+    def __init__(self, fetcher=None, n_processes: int=2, timeout: Optional[float]=None,
+                 min_words: int=8, max_link_density: float=0.33, loop=None):
+        """
+        :param fetcher: Object with an async `fetch(url) -> str` method, defaults to an `AiohttpFetcher`
+        :param n_processes: Number of processes to run text extraction with
+        :param timeout: Time to wait while downloading urls, if the time limit is reached
+                        downloads that are still hanging will be returned as errors
+        """
+        self.log = logging.getLogger('downloader')
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.fetcher = AiohttpFetcher(loop=loop) if fetcher is None else fetcher
+        self.timeout = timeout
+        self.min_words = min_words
+        self.max_link_density = max_link_density
+        self._pool = ProcessPoolExecutor(n_processes)
+
+    async def _get_text(self, url: str) -> str:
+        html = await asyncio.wait_for(self.fetcher.fetch(url), self.timeout)
+        return await self.loop.run_in_executor(self._pool, extract_main_text, html,
+                                               self.min_words, self.max_link_density)
+
+    async def get_text(self, urls: List[str]) -> List[ExtractedWebDoc]:
+        results = await asyncio.gather(*[self._get_text(url) for url in urls], return_exceptions=True)
+        errors = [(url, r) for url, r in zip(urls, results) if isinstance(r, Exception)]
+        if len(errors) > 0:
+            self.log.info("%d extraction errors: %s" % (len(errors), str(errors)))
+        return [ExtractedWebDoc(url, r) for url, r in zip(urls, results) if not isinstance(r, Exception)]
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+        if isinstance(self.fetcher, AiohttpFetcher):
+            self.fetcher.close()
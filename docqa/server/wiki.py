@@ -1,6 +1,10 @@
 import logging
+import sqlite3
+import struct
+import time
 import ujson
 import unicodedata
+from collections import OrderedDict
 from os import mkdir
 from os.path import exists, join
 from typing import Optional, List
@@ -90,6 +94,194 @@ class WikiArticle(object):
         return "https://en.wikipedia.org/?curid=" + str(self.page_id)
 
 
+def _normalize_title(title: str):
+    return unicodedata.normalize('NFKC', title).lower()
+
+
+# paragraph_num, kind bytes, n sentences, n tokens, has spans, original text bytes (-1 if None), token bytes
+_PARAGRAPH_HEADER = struct.Struct("<iiiiiii")
+
+# Stored by `WikiArticleCache` in the sqlite file, so articles encoded in an older format are not decoded
+_FORMAT_VERSION = 2
+
+
+def encode_article(article: WikiArticle) -> bytes:
+    """
+    Compact binary form of the article's paragraphs, each paragraph is a fixed size header followed by the
+    sentence lengths, token spans (if present), the paragraph kind, the original text and the
+    null-separated tokens. Decoding is then mostly `np.frombuffer` and a single `str.split` per paragraph.
+    """
+    out = [struct.pack("<i", len(article.paragraphs))]
+    for para in article.paragraphs:
+        kind = para.kind.encode("utf-8")
+        tokens = "\0".join(w for sent in para.text for w in sent).encode("utf-8")
+        n_tokens = sum(len(s) for s in para.text)
+        if para.original_text is None:
+            original_text = b""
+            original_len = -1
+        else:
+            original_text = para.original_text.encode("utf-8")
+            original_len = len(original_text)
+        has_spans = para.spans is not None
+        out.append(_PARAGRAPH_HEADER.pack(para.paragraph_num, len(kind), len(para.text),
+                                          n_tokens, int(has_spans), original_len, len(tokens)))
+        out.append(np.array([len(s) for s in para.text], dtype=np.int32).tobytes())
+        if has_spans:
+            out.append(np.asarray(para.spans, dtype=np.int32).tobytes())
+        out += [kind, original_text, tokens]
+    return b"".join(out)
+
+
+def decode_article(title: str, page_id: int, data: bytes) -> WikiArticle:
+    n_paragraphs = struct.unpack_from("<i", data)[0]
+    on = 4
+    paragraphs = []
+    for _ in range(n_paragraphs):
+        para_num, kind_len, n_sents, n_tokens, has_spans, original_len, tokens_len = \
+            _PARAGRAPH_HEADER.unpack_from(data, on)
+        on += _PARAGRAPH_HEADER.size
+        sent_lens = np.frombuffer(data, np.int32, n_sents, on)
+        on += n_sents * 4
+        if has_spans:
+            spans = np.frombuffer(data, np.int32, n_tokens * 2, on).reshape((n_tokens, 2)).copy()
+            on += n_tokens * 8
+        else:
+            spans = None
+        kind = data[on:on+kind_len].decode("utf-8")
+        on += kind_len
+        if original_len >= 0:
+            original_text = data[on:on+original_len].decode("utf-8")
+            on += original_len
+        else:
+            original_text = None
+        tokens = data[on:on+tokens_len].decode("utf-8").split("\0") if n_tokens > 0 else []
+        on += tokens_len
+
+        text = []
+        start = 0
+        for n in sent_lens.tolist():
+            text.append(tokens[start:start+n])
+            start += n
+        paragraphs.append(WikiParagraph(para_num, kind, text, original_text, spans))
+    return WikiArticle(title, page_id, paragraphs)
+
+
+class WikiArticleCache(object):
+    """
+    On-disk store of tokenized wiki articles, kept in a single sqlite file in the binary format
+    of `encode_article`. The least recently used articles are evicted once the store grows larger
+    than `max_size_mb`, and the `n_hot` most recently used articles are also kept in memory.
+    """
+
+    def __init__(self, filename: str, max_size_mb: Optional[float]=None, n_hot: int=64):
+        self.filename = filename
+        self.max_size = None if max_size_mb is None else int(max_size_mb * 1024 * 1024)
+        self.n_hot = n_hot
+        self._hot = OrderedDict()  # key -> WikiArticle, least recently used first
+
+        # A cache, so we can skip syncing to disk
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] != _FORMAT_VERSION:
+            # Written with an older version of `encode_article`
+            self._conn.execute("DROP TABLE IF EXISTS articles")
+            self._conn.execute("PRAGMA user_version=%d" % _FORMAT_VERSION)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS articles (key TEXT PRIMARY KEY, title TEXT, "
+                           "page_id INTEGER, data BLOB, last_used REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS last_used_ix ON articles (last_used)")
+        # Total size of the articles, kept up-to-date by `put` so it is shared by all processes using the file
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY, size INTEGER)")
+        self._conn.commit()
+
+        # Recount the size in case a process stopped mid-write
+        self._conn.execute("BEGIN IMMEDIATE")
+        self.size = self._conn.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM articles").fetchone()[0]
+        self._conn.execute("INSERT OR REPLACE INTO cache_size VALUES (0, ?)", (self.size, ))
+        self._conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM articles").fetchone()[0]
+
+    def __contains__(self, title: str):
+        key = _normalize_title(title)
+        return key in self._hot or self._conn.execute(
+            "SELECT 1 FROM articles WHERE key=?", (key, )).fetchone() is not None
+
+    def _add_hot(self, key, article):
+        if self.n_hot <= 0:
+            return
+        self._hot[key] = article
+        self._hot.move_to_end(key)
+        if len(self._hot) > self.n_hot:
+            self._hot.popitem(last=False)
+
+    def get(self, title: str) -> Optional[WikiArticle]:
+        key = _normalize_title(title)
+        article = self._hot.get(key)
+        if article is not None:
+            self._hot.move_to_end(key)
+            self.hits += 1
+            return article
+
+        row = self._conn.execute("SELECT title, page_id, data FROM articles WHERE key=?", (key, )).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._conn.execute("UPDATE articles SET last_used=? WHERE key=?", (time.time(), key))
+        self._conn.commit()
+        article = decode_article(*row)
+        self._add_hot(key, article)
+        return article
+
+    def put(self, title: str, article: WikiArticle):
+        key = _normalize_title(title)
+        data = encode_article(article)
+        # Take the write lock up front, so the size we read includes writes from other processes
+        # sharing the file and can't change before we evict
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            old = self._conn.execute("SELECT LENGTH(data) FROM articles WHERE key=?", (key, )).fetchone()
+            self._conn.execute("INSERT OR REPLACE INTO articles VALUES (?, ?, ?, ?, ?)",
+                               (key, article.title, article.page_id, data, time.time()))
+            size = self._conn.execute("SELECT size FROM cache_size WHERE id=0").fetchone()[0]
+            self.size = size + len(data) - (0 if old is None else old[0])
+            if self.max_size is not None and self.size > self.max_size:
+                self._evict(key)
+            self._conn.execute("UPDATE cache_size SET size=? WHERE id=0", (self.size, ))
+            self._conn.commit()
+        except BaseException:
+            self._conn.rollback()
+            raise
+        self._add_hot(key, article)
+
+    def _evict(self, keep_key, batch_size=64):
+        n_removed = 0
+        while self.size > self.max_size:
+            # Uses the `last_used` index, so we only read as many of the oldest rows as we need
+            rows = self._conn.execute("SELECT key, LENGTH(data) FROM articles WHERE key != ? "
+                                      "ORDER BY last_used LIMIT ?", (keep_key, batch_size)).fetchall()
+            if len(rows) == 0:
+                break
+            to_remove = []
+            for key, size in rows:
+                if self.size <= self.max_size:
+                    break
+                to_remove.append((key, ))
+                self.size -= size
+                self._hot.pop(key, None)
+            self._conn.executemany("DELETE FROM articles WHERE key=?", to_remove)
+            n_removed += len(to_remove)
+        log.info("Evicting %d articles from the wiki cache", n_removed)
+
+    def close(self):
+        self._conn.close()
+
+
 class WikiCorpus(object):
     """
     Class the can download wiki-articles and return them as tokenized text
@@ -98,6 +290,7 @@ class WikiCorpus(object):
     def __init__(self, cache_dir=None, follow_redirects: bool=True,
                  keep_inverse_mapping: bool=False,
                  extract_lists: bool=False, tokenizer=NltkAndPunctTokenizer(),
+                 cache_size_mb: Optional[float]=None, n_hot_articles: int=64,
                  loop=None):
         """
         :param cache_dir: Optional, directory to cache the documents we download
@@ -106,6 +299,8 @@ class WikiCorpus(object):
                                      be "untokenized" accurately
         :param extract_lists: Include lists in the extracted articles
         :param tokenizer: Tokenizer to use to tokenize the documents
+        :param cache_size_mb: Optional, evict the least recently used articles once the cache is larger than this
+        :param n_hot_articles: Number of recently used articles to also keep in memory
         """
         self.cl_sess = ClientSession(loop=loop)
         self.tokenizer = tokenizer
@@ -114,11 +309,16 @@ class WikiCorpus(object):
         self.cache_dir = cache_dir
         self.keep_inverse_mapping = keep_inverse_mapping
 
-        if cache_dir is not None and not exists(self.cache_dir):
-            mkdir(self.cache_dir)
+        if cache_dir is not None:
+            if not exists(self.cache_dir):
+                mkdir(self.cache_dir)
+            self.cache = WikiArticleCache(join(self.cache_dir, "articles.sqlite"), cache_size_mb, n_hot_articles)
+        else:
+            self.cache = None
 
     def _get_tokenized_filename(self, title):
-        title = unicodedata.normalize('NFKC', title).lower()
+        # Articles used to be cached as individual json files, we still read those if they exist
+        title = _normalize_title(title)
         return join(self.cache_dir, title.replace(" ", "_")
                     .replace("/", "-") + ".json")
 
@@ -142,14 +342,20 @@ class WikiCorpus(object):
 
     async def get_wiki_article(self, wiki_title: str) -> WikiArticle:
         # Note client is responsible for rate limiting as needed
-        if self.cache_dir is not None:
+        if self.cache is not None:
+            article = self.cache.get(wiki_title)
+            if article is not None:
+                log.info("Load wiki article for \"%s\" from cache", wiki_title)
+                return article
             tokenized_file = self._get_tokenized_filename(wiki_title)
             if exists(tokenized_file):
-                log.info("Load wiki article for \"%s\" from cache", wiki_title)
+                log.info("Load wiki article for \"%s\" from json cache", wiki_title)
                 with open(tokenized_file, "r") as f:
                     data = ujson.load(f)
-                    return WikiArticle(data["title"], data["url"], [WikiParagraph.from_json(x) for
-                                                                    x in data["paragraphs"]])
+                article = WikiArticle(data["title"], int(data["url"].split("curid=")[-1]),
+                                      [WikiParagraph.from_json(x) for x in data["paragraphs"]])
+                self.cache.put(wiki_title, article)
+                return article
 
         log.info("Load wiki article for \"%s\"", wiki_title)
 
@@ -207,12 +413,11 @@ class WikiCorpus(object):
 
         article = WikiArticle(wiki_title, raw_data["pageid"], paragraphs)
 
-        if self.cache_dir is not None:
-            # save to cache
-            with open(tokenized_file, "w") as f:
-                ujson.dump(dict(title=article.title, url=article.url,
-                                paragraphs=[x.to_json() for x in article.paragraphs]), f)
+        if self.cache is not None:
+            self.cache.put(wiki_title, article)
         return article
 
     def close(self):
         self.cl_sess.close()
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,27 @@
+import unittest
+
+import numpy as np
+
+from docqa.triviaqa.answer_detection import FastNormalizedAnswerDetector, MultiPatternAnswerDetector
+
+
+class TestMultiPatternAnswerDetector(unittest.TestCase):
+
+    def test_skip_articles(self):
+        detector = MultiPatternAnswerDetector()
+        detector.set_question([["red", "fish"], ["the", "fish"], ["fish"]])
+        para = [["The", "red", "the", "fish", "."], ["an", "Fish", "the"]]
+        self.assertEqual(detector.any_found(para), [(1, 4), (2, 4), (3, 4), (6, 7)])
+
+    def test_same_as_fast_detector(self):
+        rng = np.random.RandomState(0)
+        voc = ["a", "an", "the", "The", "x", "y", "z", ",", "x.", "''"]
+        alias_voc = ["a", "the", "x", "y", "z", ""]
+        fast = FastNormalizedAnswerDetector()
+        detector = MultiPatternAnswerDetector()
+        for _ in range(2000):
+            aliases = [list(rng.choice(alias_voc, rng.randint(1, 5))) for _ in range(rng.randint(1, 6))]
+            para = [list(rng.choice(voc, rng.randint(0, 12))) for _ in range(rng.randint(1, 4))]
+            fast.set_question(aliases)
+            detector.set_question(aliases)
+            self.assertEqual(sorted(fast.any_found(para)), detector.any_found(para))
@@ -0,0 +1,28 @@
+import time
+import unittest
+
+import numpy as np
+
+from docqa.evaluator import encode_in_order
+
+
+class SlowModel(object):
+    def __init__(self):
+        self.rng = np.random.RandomState(0)
+
+    def encode(self, batch, is_train):
+        time.sleep(self.rng.uniform(0, 0.005))
+        return {"batch": batch, "is_train": is_train}
+
+
+class TestAsyncEncoding(unittest.TestCase):
+
+    def test_in_order(self):
+        for n_workers in [1, 2, 5]:
+            stats = dict(encode_wait=0)
+            out = list(encode_in_order(SlowModel(), iter(range(40)), True, n_workers, n_workers - 1, stats))
+            self.assertEqual([batch for batch, _ in out], list(range(40)))
+            out = [x for _, x in out]
+            self.assertEqual([x["batch"] for x in out], list(range(40)))
+            self.assertTrue(all(x["is_train"] for x in out))
+            self.assertGreater(stats["encode_wait"], 0)
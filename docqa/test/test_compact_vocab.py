@@ -0,0 +1,41 @@
+import pickle
+import string
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+
+from docqa.data_processing.compact_vocab import CompactVocab
+
+
+class TestCompactVocab(unittest.TestCase):
+
+    def test_words_to_ix(self):
+        rng = np.random.RandomState(0)
+        chars = list(string.ascii_letters) + ["ü", "ß", "İ", "\U0001F600"]
+        voc = list(set("".join(rng.choice(chars, rng.randint(1, 12))) for _ in range(5000)))
+        word_to_ix = {w: i + 2 for i, w in enumerate(voc[::2])}
+        word_to_ix[""] = 0
+        words = voc + [w.upper() for w in voc[:500]] + [w.lower() for w in voc[:500]] + ["", "unseen"]
+
+        get = word_to_ix.get
+        expected = [get(w, 1) if get(w, 1) != 1 else get(w.lower(), 1) for w in words]
+        vocab = CompactVocab(word_to_ix)
+        self.assertEqual(len(vocab), len(word_to_ix))
+        for table in [vocab, pickle.loads(pickle.dumps(vocab))]:
+            self.assertEqual(list(table.words_to_ix(words)), expected)
+            self.assertEqual(list(table.words_to_ix([])), [])
+            self.assertEqual([table.get(w) for w in words[:100]], [get(w) for w in words[:100]])
+
+    def test_save_load(self):
+        word_to_ix = {w: i + 2 for i, w in enumerate(["the", "fish", "Fish", "ü", ""])}
+        vocab = CompactVocab(word_to_ix)
+        with tempfile.TemporaryDirectory() as tmp:
+            vocab.save(join(tmp, "vocab"))
+            loaded = CompactVocab.load(join(tmp, "vocab"))
+            self.assertEqual(len(loaded), len(vocab))
+            words = list(word_to_ix) + ["FISH", "THE", "unseen"]
+            self.assertEqual(list(loaded.words_to_ix(words)), list(vocab.words_to_ix(words)))
+            self.assertEqual(list(pickle.loads(pickle.dumps(loaded)).words_to_ix(words)),
+                             list(vocab.words_to_ix(words)))
@@ -0,0 +1,116 @@
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from docqa.data_processing.qa_training_data import ParagraphAndQuestion, ParagraphAndQuestionSpec
+from docqa.data_processing.token_ids import WordTable, add_token_ids
+from docqa.encoder import DocumentAndQuestionEncoder, SingleSpanAnswerEncoder, WordCharIdCache
+from docqa.nn.embedder import WordEmbedder, LearnedCharEmbedder
+
+
+class MockWordEmbedder(WordEmbedder):
+    def __init__(self, voc, query_once=False):
+        self.word_to_ix = {w: i + 2 for i, w in enumerate(voc)}
+        self._query_once = query_once
+        self.n_queries = 0
+
+    def query_once(self):
+        return self._query_once
+
+    def context_word_to_ix(self, word, is_train):
+        self.n_queries += 1
+        if self._query_once:
+            # Behave like a placeholder embedder, ids depend on the order we were queried in
+            return self.word_to_ix.get(word, 1000 + self.n_queries)
+        return self.word_to_ix.get(word, 1)
+
+
+def random_batch(rng, n, voc, max_len):
+    batch = []
+    for i in range(n):
+        question = list(rng.choice(voc, rng.randint(1, 10)))
+        context = list(rng.choice(voc, rng.randint(1, max_len)))
+        batch.append(ParagraphAndQuestion(context, question, None, str(i)))
+    return batch
+
+
+class TestEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.voc = ["the", "The", "fish", "aVeryLongWordIndeed", "", "x", "red", "ünïcode", "?", "thirteen"]
+
+    def build(self, vectorize, word_emb, batch_size=None, max_context=None, max_question=None, len_op=True,
+              char_cache_size=None):
+        chars = LearnedCharEmbedder(6, 1, 5)
+        chars._char_to_ix = {c: i + 2 for i, c in enumerate("abcdefghijklmnopqrstuvwxyz")}
+        enc = DocumentAndQuestionEncoder(SingleSpanAnswerEncoder(), vectorize=vectorize,
+                                         char_cache_size=char_cache_size)
+        spec = ParagraphAndQuestionSpec(batch_size, max_question, max_context, None)
+        enc.init(spec, len_op, word_emb, chars)
+        return enc
+
+    def assert_same_encoding(self, batches, query_once, **kwargs):
+        with tf.Graph().as_default():
+            loop = self.build(False, MockWordEmbedder(self.voc[::2], query_once), **kwargs)
+            vec = self.build(True, MockWordEmbedder(self.voc[::2], query_once), **kwargs)
+            for batch in batches:
+                expected = loop.encode(batch, False)
+                actual = vec.encode(batch, False)
+                for pl_loop, pl_vec in zip(loop.get_placeholders(), vec.get_placeholders()):
+                    self.assertEqual(expected[pl_loop].dtype, actual[pl_vec].dtype)
+                    self.assertTrue(np.array_equal(expected[pl_loop], actual[pl_vec]), pl_vec.name)
+            return vec
+
+    def test_dynamic_size(self):
+        self.assert_same_encoding([random_batch(self.rng, 8, self.voc, 30) for _ in range(5)], False)
+
+    def test_query_once(self):
+        self.assert_same_encoding([random_batch(self.rng, 8, self.voc, 30) for _ in range(5)], True)
+
+    def test_padded_batch(self):
+        batch = random_batch(self.rng, 5, self.voc, 30)
+        self.assert_same_encoding([batch], False, batch_size=8, max_context=30, max_question=10, len_op=False)
+
+    def test_token_ids(self):
+        batches = [random_batch(self.rng, 8, self.voc, 30) for _ in range(6)]
+        table = WordTable()
+        for batch in batches[:4]:
+            add_token_ids(batch, table)
+        # Have a batch that mixes in plain lists, and a batch that adds words to the table
+        batches[3][0].context = list(batches[3][0].context)
+        add_token_ids(batches[5], table)
+        for query_once in [False, True]:
+            self.assert_same_encoding(batches, query_once, char_cache_size=4)
+
+    def test_char_cache(self):
+        batches = [random_batch(self.rng, 8, self.voc, 30) for _ in range(5)]
+        # Smaller then the vocab, so we will be evicting words
+        enc = self.assert_same_encoding(batches, False, char_cache_size=4)
+        self.assertEqual(len(enc.char_cache), 4)
+        self.assertGreater(enc.char_cache.misses, 0)
+
+        enc = self.assert_same_encoding(batches, False, char_cache_size=100)
+        self.assertEqual(enc.char_cache.misses, len(set(self.voc)))
+        self.assertGreater(enc.char_cache.hits, 0)
+
+    def test_char_cache_lru(self):
+        cache = WordCharIdCache(2, 3, lambda c: ord(c) - ord("a") + 2)
+        char_ids, lens = cache.lookup(["ab", "cdef", "ab"])
+        self.assertEqual(char_ids.tolist(), [[2, 3, 0], [4, 5, 6], [2, 3, 0]])
+        self.assertEqual(lens.tolist(), [2, 3, 2])
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+
+        cache.lookup(["ab"])  # "cdef" is now the least recently used
+        char_ids, lens = cache.lookup(["g", "ab"])
+        self.assertEqual(char_ids.tolist(), [[8, 0, 0], [2, 3, 0]])
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+        cache.lookup(["cdef"])
+        self.assertEqual((cache.hits, cache.misses), (2, 5))
+
+        cache = WordCharIdCache(2, 3, lambda c: ord(c) - ord("a") + 2)
+        cache.lookup(["ab", "ab", "c"])
+        char_ids, lens = cache.lookup(["ab", "c"])
+        self.assertEqual(char_ids.tolist(), [[2, 3, 0], [4, 0, 0]])
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
@@ -2,7 +2,7 @@ import unittest
 import numpy as np
 
 from docqa.data_processing.span_data import get_best_span_bounded, get_best_span_from_sent_predictions, get_best_span, \
-    get_best_in_sentence_span
+    get_best_in_sentence_span, get_best_span_batch
 
 
 class TestEvaluator(unittest.TestCase):
@@ -83,3 +83,28 @@ class TestEvaluator(unittest.TestCase):
 
         self.assertEqual(list(get_best_span_bounded(p1, p2, 2)[0]), [0, 0])
         self.assertEqual(list(get_best_span_bounded(p1, p2, 12)[0]), [0, 3])
+
+    def test_best_span_batch(self):
+        rng = np.random.RandomState(0)
+        for test_num in range(100):
+            batch_size, n_tokens = rng.randint(1, 6), rng.randint(1, 30)
+            p1 = rng.uniform(0, 1, (batch_size, n_tokens)).astype(np.float32)
+            p2 = rng.uniform(0, 1, (batch_size, n_tokens)).astype(np.float32)
+            if test_num % 2 == 0:
+                # Make ties common
+                p1, p2 = np.round(p1, 1), np.round(p2, 1) + 0.05
+            lens = rng.randint(0, n_tokens + 1, batch_size)
+            mask = np.arange(n_tokens)[None, :] < lens[:, None]
+            for bound in [None, 1, 2, 3, 5, 17, 40]:
+                spans, scores = get_best_span_batch(p1, p2, bound, mask)
+                for i, n in enumerate(lens):
+                    if n == 0:
+                        self.assertEqual(list(spans[i]), [-1, -1])
+                        self.assertEqual(scores[i], -1)
+                        continue
+                    if bound is None:
+                        span, score = get_best_span(p1[i, :n], p2[i, :n])
+                    else:
+                        span, score = get_best_span_bounded(p1[i, :n], p2[i, :n], bound)
+                    self.assertEqual(tuple(span), tuple(spans[i]))
+                    self.assertEqual(score, scores[i])
@@ -0,0 +1,106 @@
+import time
+import unittest
+
+import numpy as np
+
+from docqa.evaluator import EvaluatorRunner, Evaluator, Evaluation, SpanEvaluator
+
+
+class SquareModel(object):
+    def encode(self, batch, is_train):
+        time.sleep(0.001)
+        return {"x": np.array(batch)}
+
+
+class SquareSession(object):
+    def run(self, fetches, feed_dict):
+        return [feed_dict["x"] ** 2 if x == "square" else float(len(feed_dict["x"])) for x in fetches]
+
+
+class SpanPrediction(object):
+    def get_best_span(self, bound):
+        return "span", "score"
+
+
+class SpanModel(object):
+    def encode(self, batch, is_train):
+        return {"x": np.array([len(x.answer.answer_spans) for x in batch])}
+
+
+class SpanSession(object):
+    def run(self, fetches, feed_dict):
+        x = feed_dict["x"]
+        return [np.stack([x % 3, x % 3 + x % 2], axis=1) for _ in fetches]
+
+
+class Answer(object):
+    def __init__(self, answer_spans):
+        self.answer_spans = answer_spans
+
+
+class Point(object):
+    def __init__(self, answer_spans):
+        self.answer = Answer(answer_spans)
+
+
+class ListDataset(object):
+    def __init__(self, batches):
+        self.batches = batches
+
+    def get_epoch(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def percent_filtered(self):
+        return None
+
+
+class SumEvaluator(Evaluator):
+    def tensors_needed(self, prediction):
+        return dict(square="square", size="size")
+
+    def process_batch(self, data, square, size):
+        time.sleep(0.001)
+        return dict(total=square + np.array(data), size=size)
+
+    def evaluate(self, data, true_len, total, size):
+        return Evaluation(dict(total=total.sum(), size=size.sum(), n=true_len), dict(total=total))
+
+
+class TestEvaluatorRunner(unittest.TestCase):
+
+    def test_parallel_same_result(self):
+        rng = np.random.RandomState(0)
+        dataset = ListDataset([list(rng.randint(0, 100, rng.randint(1, 8))) for _ in range(30)])
+        expected = None
+        for n_encoding_workers, prefetch, n_postprocess_workers in [(1, 0, 0), (1, 2, 0), (3, 3, 0), (4, 2, 3)]:
+            runner = EvaluatorRunner([SumEvaluator()], SquareModel(), n_encoding_workers, prefetch,
+                                     n_postprocess_workers)
+            runner.set_input(None)
+            evaluation = runner.run_evaluators(SquareSession(), dataset, "test")
+            if expected is None:
+                expected = evaluation
+                data = np.concatenate(dataset.batches)
+                self.assertEqual(evaluation.scalars["total"], (data ** 2 + data).sum())
+                self.assertEqual(evaluation.scalars["size"], len(data))
+            else:
+                self.assertEqual(expected.scalars, evaluation.scalars)
+                self.assertTrue(np.all(expected.per_sample["total"] == evaluation.per_sample["total"]))
+
+    def test_streaming_span_evaluator(self):
+        rng = np.random.RandomState(0)
+        batches = [[Point([(rng.randint(0, 3), rng.randint(2, 4)) for _ in range(rng.randint(1, 3))])
+                    for _ in range(rng.randint(1, 8))] for _ in range(20)]
+        evaluator = SpanEvaluator([3])
+        runner = EvaluatorRunner([evaluator], SpanModel(), 2, 2, 2)
+        runner.set_input(SpanPrediction())
+        evaluation = runner.run_evaluators(SpanSession(), ListDataset(batches), "test")
+
+        data = [x for b in batches for x in b]
+        spans = np.concatenate([SpanSession().run(["span"], SpanModel().encode(b, False))[0] for b in batches])
+        expected = evaluator.evaluate(data, len(data), **evaluator.process_batch(data, **{"3": spans}))
+        self.assertEqual(set(expected.scalars), set(evaluation.scalars))
+        for k, v in expected.scalars.items():
+            self.assertAlmostEqual(v, evaluation.scalars[k])
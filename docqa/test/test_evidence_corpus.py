@@ -0,0 +1,47 @@
+import tempfile
+import unittest
+from os import makedirs
+from os.path import join
+
+import numpy as np
+
+from docqa.triviaqa.build_packed_evidence import build_packed_corpus
+from docqa.triviaqa.evidence_corpus import TriviaQaEvidenceCorpusTxt, TriviaQaEvidenceCorpusPacked
+
+
+class TestPackedEvidenceCorpus(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        voc = ["the", "fish", "ünïcode", ".", "x", "thirteen", "Red"]
+        txt_dir = join(self.tmp.name, "txt")
+        makedirs(join(txt_dir, "web"))
+        makedirs(join(txt_dir, "wikipedia"))
+        self.txt = TriviaQaEvidenceCorpusTxt()
+        self.txt.directory = txt_dir
+        for i in range(12):
+            paragraphs = [[list(rng.choice(voc, rng.randint(1, 8))) for _ in range(rng.randint(1, 4))]
+                          for _ in range(rng.randint(1, 5))]
+            with open(join(txt_dir, "web" if i % 2 == 0 else "wikipedia", "doc%d.txt" % i), "w") as f:
+                f.write("\n\n".join("\n".join(" ".join(sent) for sent in para) for para in paragraphs))
+        build_packed_corpus(self.txt, join(self.tmp.name, "packed"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_documents(self):
+        packed = TriviaQaEvidenceCorpusPacked(directory=join(self.tmp.name, "packed"))
+        self.assertEqual(set(packed.list_documents()), set(self.txt.list_documents()))
+        self.assertIsNone(packed.get_document("web/missing"))
+        for doc_id in self.txt.list_documents():
+            for n_tokens in [None, 1, 3, 7, 20, 1000]:
+                for flat in [True, False]:
+                    self.assertEqual(self.txt.get_document(doc_id, n_tokens, flat),
+                                     packed.get_document(doc_id, n_tokens, flat))
+
+    def test_file_id_map(self):
+        packed = TriviaQaEvidenceCorpusPacked({"a": "web/doc0", "b": "wikipedia/doc1"},
+                                              join(self.tmp.name, "packed"))
+        self.assertEqual(set(packed.list_documents()), {"a", "b"})
+        self.assertEqual(packed.get_document("b"), self.txt.get_document("wikipedia/doc1"))
@@ -0,0 +1,43 @@
+import asyncio
+import threading
+import unittest
+
+from docqa.server.inference_executor import InferenceExecutor, InferenceQueueFull
+
+
+class TestInferenceExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_run(self):
+        executor = InferenceExecutor(2, 4, loop=self.loop)
+        main_thread = threading.get_ident()
+        result = self.loop.run_until_complete(executor.run(lambda x: (x + 1, threading.get_ident()), 1))
+        self.assertEqual(result[0], 2)
+        self.assertNotEqual(result[1], main_thread)
+        metrics = executor.get_metrics()
+        self.assertEqual(metrics["completed"], 1)
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertIn("wait_ms_p99", metrics)
+        executor.close()
+
+    def test_queue_full(self):
+        executor = InferenceExecutor(1, 2, loop=self.loop)
+        release = threading.Event()
+
+        async def submit_all():
+            return await asyncio.gather(*[executor.run(release.wait) for _ in range(5)],
+                                        return_exceptions=True)
+        task = asyncio.ensure_future(submit_all(), loop=self.loop)
+        self.loop.call_later(0.05, release.set)
+        results = self.loop.run_until_complete(task)
+
+        # One task running, two waiting, the rest are rejected
+        self.assertEqual(sum(isinstance(x, InferenceQueueFull) for x in results), 2)
+        self.assertEqual(sum(x is True for x in results), 3)
+        self.assertEqual(executor.get_metrics()["rejected"], 2)
+        executor.close()
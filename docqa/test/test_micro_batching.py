@@ -0,0 +1,59 @@
+import asyncio
+import unittest
+
+import numpy as np
+
+from docqa.data_processing.qa_training_data import ParagraphAndQuestion
+from docqa.server.micro_batching import SpanScoreScheduler
+
+
+def span_scores(batch):
+    """ Fake model, the score only depends on the paragraph and question """
+    n_tokens = max(x.n_context_words for x in batch)
+    out = np.zeros((len(batch), n_tokens, n_tokens), dtype=np.float32)
+    for i, pair in enumerate(batch):
+        n = pair.n_context_words
+        out[i, :n, :n] = np.outer(np.arange(n) + len(pair.question), np.arange(n) + 1)
+    return out
+
+
+class TestSpanScoreScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.runs = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def run_fn(self, batch):
+        self.runs.append(len(batch))
+        return span_scores(batch)
+
+    def random_request(self, rng):
+        question = ["q"] * rng.randint(1, 5)
+        return [ParagraphAndQuestion(["w"] * rng.randint(1, 30), question, None, "")
+                for _ in range(rng.randint(1, 6))]
+
+    def test_scatter(self):
+        rng = np.random.RandomState(0)
+        scheduler = SpanScoreScheduler(self.run_fn, 8, 50, self.loop)
+        requests = [self.random_request(rng) for _ in range(10)]
+
+        async def answer_all():
+            return await asyncio.gather(*[scheduler.get_span_scores(r) for r in requests])
+        results = self.loop.run_until_complete(answer_all())
+
+        for request, result in zip(requests, results):
+            self.assertTrue(np.array_equal(span_scores(request), result))
+        self.assertEqual(sum(self.runs), sum(len(r) for r in requests))
+        self.assertTrue(all(x <= 8 for x in self.runs))
+        self.assertLess(len(self.runs), len(requests))
+
+    def test_error(self):
+        async def fail(batch):
+            raise ValueError()
+        scheduler = SpanScoreScheduler(fail, 8, 1, self.loop)
+        request = self.random_request(np.random.RandomState(0))
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(scheduler.get_span_scores(request))
@@ -0,0 +1,61 @@
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+
+from docqa.data_processing.document_splitter import TopTfIdf, ExtractedParagraph
+from docqa.data_processing.tfidf_index import TfIdfIndex
+
+
+class StopWords(object):
+    def __init__(self, words):
+        self.words = words
+
+
+class TestTopTfIdf(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.voc = ["fish", "Red", "blue", "the", "of", "sea", "über", "a", "x", "whale", "boats", "?"]
+        self.stop = StopWords(["the", "of", "a"])
+
+    def random_doc(self, n_paragraphs):
+        doc = []
+        for i in range(n_paragraphs):
+            doc.append(ExtractedParagraph([list(self.rng.choice(self.voc, self.rng.randint(1, 6)))
+                                           for _ in range(self.rng.randint(1, 4))], i*20, (i+1)*20))
+        return doc
+
+    def random_pairs(self):
+        docs = [self.random_doc(self.rng.randint(1, 8)) for _ in range(6)]
+        docs.append([ExtractedParagraph([["the", "of"]], 0, 2)])  # No valid words
+        questions, paragraphs, doc_ids = [], [], []
+        for _ in range(40):
+            doc_ix = self.rng.randint(0, len(docs))
+            questions.append(list(self.rng.choice(self.voc, self.rng.randint(1, 6))))
+            # Copy the paragraphs, since callers use separately split (but identical) paragraphs
+            paragraphs.append([ExtractedParagraph(x.text, x.start, x.end) for x in docs[doc_ix]])
+            doc_ids.append(doc_ix)
+        return questions, paragraphs, doc_ids
+
+    def assert_same_as_prune(self, para_filter):
+        questions, paragraphs, doc_ids = self.random_pairs()
+        expected = [para_filter.prune(q, p) for q, p in zip(questions, paragraphs)]
+        for actual in [para_filter.prune_many(questions, paragraphs, doc_ids),
+                       para_filter.prune_many(questions, paragraphs)]:
+            self.assertEqual(len(expected), len(actual))
+            for e, a in zip(expected, actual):
+                self.assertEqual([id(x) for x in e], [id(x) for x in a])
+
+    def test_prune_many(self):
+        for n_to_select in [1, 3]:
+            for filter_dist_one in [True, False]:
+                self.assert_same_as_prune(TopTfIdf(self.stop, n_to_select, filter_dist_one))
+
+    def test_prune_many_indexed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            index = TfIdfIndex.build([" ".join(self.rng.choice(self.voc[:8], 10)) for _ in range(30)],
+                                     self.stop.words)
+            index.save(join(tmp, "index.pkl"))
+            self.assert_same_as_prune(TopTfIdf(self.stop, 3, index=join(tmp, "index.pkl")))
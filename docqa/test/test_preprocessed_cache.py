@@ -0,0 +1,166 @@
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+
+from docqa.data_processing.multi_paragraph_qa import MultiParagraphQuestion, DocumentParagraph
+from docqa.data_processing.preprocessed_cache import write_preprocessed_cache, PreprocessedCache
+from docqa.data_processing.preprocessed_corpus import FilteredData, PreprocessedData, Preprocessor, \
+    preprocess_par, preprocess_par_iter
+from docqa.data_processing.span_data import TokenSpans
+from docqa.data_processing.token_ids import TokenIds
+from docqa.triviaqa.training_data import DocumentParagraphQuestion, ExtractMultiParagraphs
+
+
+def random_multi_paragraph_questions(rng, n):
+    words = ["w%d" % i for i in range(50)] + ["Cased", "été", "a b"]
+
+    def text(n_words):
+        return [words[i] for i in rng.randint(0, len(words), n_words)]
+
+    questions = []
+    for i in range(n):
+        paras = []
+        for j in range(rng.randint(0, 4)):
+            spans = rng.randint(0, 10, (rng.randint(0, 3), 2)).astype(np.int32)
+            paras.append(DocumentParagraph("doc%d" % rng.randint(0, 5), j * 10, j * 10 + 7, j,
+                                           spans, text(rng.randint(0, 20))))
+        questions.append(MultiParagraphQuestion("q%d" % i, text(rng.randint(1, 8)),
+                                                None if i % 3 == 0 else ["ans", str(i)], paras))
+    return questions
+
+
+class ToyPreprocessor(Preprocessor):
+    """ Builds a question for each odd integer """
+
+    def preprocess(self, questions, evidence):
+        out = [MultiParagraphQuestion("q%d" % i, ["q", str(i)], [evidence],
+                                      [DocumentParagraph("d%d" % i, 0, 2, 0, np.array([[0, 1]]), ["p", str(i)])])
+               for i in questions if i % 2 == 1]
+        return FilteredData(out, len(questions))
+
+    def finalize_chunk(self, x):
+        for q in x.data:
+            q.question_id = q.question_id.upper()
+
+
+class ToyCorpus(object):
+    evidence = "ev"
+
+    def get_train(self):
+        return list(range(25))
+
+    def get_dev(self):
+        return list(range(100, 110))
+
+
+class TestPreprocessedCache(unittest.TestCase):
+
+    def assert_multi_equal(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for e, a in zip(expected, actual):
+            self.assertEqual(e.question_id, a.question_id)
+            self.assertEqual(list(e.question), list(a.question))
+            self.assertEqual(e.answer_text, a.answer_text)
+            self.assertEqual(len(e.paragraphs), len(a.paragraphs))
+            for ep, ap in zip(e.paragraphs, a.paragraphs):
+                self.assertEqual((ep.doc_id, ep.start, ep.end, ep.rank), (ap.doc_id, ap.start, ap.end, ap.rank))
+                self.assertEqual(list(ep.text), list(ap.text))
+                self.assertTrue(np.array_equal(ep.answer_spans.reshape(-1, 2), ap.answer_spans))
+
+    def test_multi_paragraph(self):
+        rng = np.random.RandomState(0)
+        train, dev = random_multi_paragraph_questions(rng, 57), random_multi_paragraph_questions(rng, 11)
+        with tempfile.TemporaryDirectory() as tmp:
+            write_preprocessed_cache(tmp, "preprocessor", dict(train=FilteredData(train, 60),
+                                                               dev=FilteredData(dev, 11), verified=None),
+                                     chunk_size=10)
+            cache = PreprocessedCache(tmp)
+            self.assertEqual(set(cache.split_names), {"train", "dev"})
+            self.assertIsNone(cache.get_split("verified"))
+            self.assertEqual(cache.get_preprocessor(), "preprocessor")
+
+            loaded = cache.load_split("train")
+            self.assertEqual(loaded.true_len, 60)
+            self.assert_multi_equal(train, loaded.data)
+
+            split = cache.get_split("dev")
+            split.chunk_size = 3
+            self.assert_multi_equal(dev, list(split))
+            self.assert_multi_equal([dev[4], dev[-1]], [split[4], split[-1]])
+            self.assert_multi_equal(dev[2:9:3], split[2:9:3])
+            self.assert_multi_equal(dev[::-1], split[::-1])
+
+            cache = PreprocessedCache(tmp, token_ids=True)
+            loaded = cache.load_split("train").data
+            self.assert_multi_equal(train, loaded)
+            for tokens in [loaded[1].question, loaded[1].paragraphs[0].text]:
+                self.assertIsInstance(tokens, TokenIds)
+                self.assertIs(tokens.table, cache.table)
+                self.assertEqual([cache.words[i] for i in tokens.ids], list(tokens))
+
+    def test_document_paragraph(self):
+        data = [DocumentParagraphQuestion("q1", "d1", (3, 8), ("what", "is"), ["a", "b", "c"],
+                                          TokenSpans(["b"], np.array([[1, 1]])), 1),
+                DocumentParagraphQuestion("q1", "d2", (0, 2), ("what", "is"), ["c"],
+                                          TokenSpans(["b"], np.zeros((0, 2), dtype=np.int32)), None)]
+        with tempfile.TemporaryDirectory() as tmp:
+            write_preprocessed_cache(tmp, None, dict(train=FilteredData(data, 5)))
+            loaded = PreprocessedCache(tmp).load_split("train").data
+        self.assertEqual(len(loaded), 2)
+        for e, a in zip(data, loaded):
+            self.assertIsInstance(a, DocumentParagraphQuestion)
+            self.assertEqual((e.question_id, e.doc_id, tuple(e.para_range), list(e.question), e.context, e.rank),
+                             (a.question_id, a.doc_id, tuple(a.para_range), list(a.question), a.context, a.rank))
+            self.assertEqual(e.answer.answer_text, a.answer.answer_text)
+            self.assertTrue(np.array_equal(e.answer.answer_spans.reshape(-1, 2), a.answer.answer_spans))
+
+    def test_partial_load(self):
+        rng = np.random.RandomState(1)
+        preprocessor = ExtractMultiParagraphs(None, None, None)
+        data = PreprocessedData(None, preprocessor, None, None)
+        data._train = FilteredData(random_multi_paragraph_questions(rng, 20), 20)
+        data._dev = FilteredData(random_multi_paragraph_questions(rng, 5), 5)
+        with tempfile.TemporaryDirectory() as tmp:
+            for filename, columnar in [(join(tmp, "columnar"), True), (join(tmp, "data.pkl.gz"), False),
+                                       (join(tmp, "data"), False)]:
+                data.cache_preprocess(filename, columnar)
+                loaded = PreprocessedData(None, preprocessor, None, None)
+                loaded.load_preprocess(filename, splits=["dev"])
+                self.assertIsNone(loaded._train)
+                self.assertIsNone(loaded._verified_dev)
+                self.assert_multi_equal(data._dev.data, loaded._dev.data)
+
+            other = PreprocessedData(None, ExtractMultiParagraphs(None, None, None, intern=True), None, None)
+            self.assertRaises(ValueError, other.load_preprocess, join(tmp, "columnar"))
+
+    def test_preprocess_par_iter(self):
+        questions = list(range(37))
+        expected = ["Q%d" % i for i in questions if i % 2 == 1]
+        for n_processes in [1, 2]:
+            chunks = list(preprocess_par_iter(questions, "ev", ToyPreprocessor(), n_processes, 5))
+            self.assertTrue(all(len(x.data) <= 3 for x in chunks))
+            self.assertEqual(sum(x.true_len for x in chunks), 37)
+            self.assertEqual([q.question_id for x in chunks for q in x.data], expected)
+
+            data = preprocess_par(questions, "ev", ToyPreprocessor(), n_processes, 5)
+            self.assertEqual(data.true_len, 37)
+            self.assertEqual([q.question_id for q in data.data], expected)
+
+        chunks = preprocess_par_iter(questions, "ev", ToyPreprocessor(), 2, 5, ordered=False)
+        self.assertEqual(sorted(q.question_id for x in chunks for q in x.data), sorted(expected))
+
+    def test_preprocess_to_cache(self):
+        preprocessor = ToyPreprocessor()
+        data = PreprocessedData(ToyCorpus(), preprocessor, None, None, eval_on_verified=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            data.preprocess_to_cache(tmp, 2, 4)
+            loaded = PreprocessedData(ToyCorpus(), preprocessor, None, None)
+            loaded.load_preprocess(tmp)
+
+        data.preprocess(2, 4)
+        self.assertIsNone(loaded._verified_dev)
+        for expected, actual in [(data._train, loaded._train), (data._dev, loaded._dev)]:
+            self.assertEqual(expected.true_len, actual.true_len)
+            self.assert_multi_equal(expected.data, actual.data)
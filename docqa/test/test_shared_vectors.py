@@ -0,0 +1,75 @@
+import tempfile
+import unittest
+from glob import glob
+from os.path import join
+from unittest import mock
+
+import numpy as np
+
+from docqa.data_processing.compact_vocab import CompactVocab
+from docqa.server.shared_vectors import SharedWordVectorLoader, get_memory_usage
+
+
+class CountingLoader(object):
+    def __init__(self, word_to_vec):
+        self.word_to_vec = word_to_vec
+        self.n_loads = 0
+
+    def load_word_vec(self, vec_name, voc=None):
+        self.n_loads += 1
+        if voc is None:
+            return self.word_to_vec
+        voc = set(x.lower() for x in voc)
+        return {k: v for k, v in self.word_to_vec.items() if k.lower() in voc}
+
+
+class TestSharedWordVectorLoader(unittest.TestCase):
+
+    def test_load_once(self):
+        rng = np.random.RandomState(0)
+        word_to_vec = {w: rng.uniform(-1, 1, 4).astype(np.float32) for w in ["the", "The", "fish", "red"]}
+        inner = CountingLoader(word_to_vec)
+        with tempfile.TemporaryDirectory() as tmp:
+            for voc in [None, ["the", "fish"], None, ["fish", "the"]]:
+                expected = CountingLoader(word_to_vec).load_word_vec("vecs", voc)
+                # Each worker would have its own loader
+                vecs = SharedWordVectorLoader(inner, tmp).load_word_vec("vecs", voc)
+                self.assertEqual(set(vecs), set(expected))
+                for word, vec in vecs.items():
+                    self.assertTrue(np.array_equal(expected[word], vec))
+            self.assertEqual(inner.n_loads, 2)
+
+    def test_memory_usage(self):
+        usage = get_memory_usage()
+        self.assertTrue(all(v >= 0 for v in usage.values()))
+
+    def test_load_vocab(self):
+        word_to_vec = {w: np.full(2, i, dtype=np.float32) for i, w in enumerate(["the", "fish", "red"])}
+        n_builds = []
+
+        def build():
+            n_builds.append(1)
+            return {"the": 2, "fish": 3}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for _ in range(2):
+                loader = SharedWordVectorLoader(CountingLoader(word_to_vec), tmp)
+                vecs = loader.load_word_vec("vecs", ["the", "fish"])
+                self.assertTrue(vecs.shared)
+                vocab = loader.load_vocab("vecs", ["the", "fish"], "", build)
+                self.assertEqual(list(vocab.words_to_ix(["fish", "The", "red"])), [3, 2, 1])
+            self.assertEqual(len(n_builds), 1)
+
+    def test_remove_stale_vocab(self):
+        word_to_vec = {w: np.full(2, i, dtype=np.float32) for i, w in enumerate(["the", "fish"])}
+        with tempfile.TemporaryDirectory() as tmp:
+            loader = SharedWordVectorLoader(CountingLoader(word_to_vec), tmp)
+            loader.load_vocab("vecs", None, "", lambda: {"the": 2})
+            self.assertEqual(len(glob(join(tmp, "*-vocab-*"))), 1)
+
+            # Simulate a restart, which changes the hash seed
+            with mock.patch.object(CompactVocab, "hash_key", return_value=CompactVocab.hash_key() + 1):
+                vocab = loader.load_vocab("vecs", None, "", lambda: {"fish": 3})
+            self.assertEqual(len(glob(join(tmp, "*-vocab-*"))), 1)
+            self.assertEqual(len(glob(join(tmp, "*.lock"))), 1)
+            self.assertEqual(vocab.get("fish"), 3)
@@ -6,7 +6,8 @@ from docqa.nn.span_prediction import packed_span_f1_mask, to_unpacked_coordinate
 from docqa.nn.span_prediction_ops import best_span_from_bounds
 from docqa.utils import flatten_iterable
 
-from docqa.data_processing.span_data import get_best_span_bounded, span_f1, top_disjoint_spans
+from docqa.data_processing.span_data import get_best_span_bounded, span_f1, top_disjoint_spans, \
+    top_disjoint_spans_batch
 from docqa.nn.ops import segment_logsumexp
 
 
@@ -52,6 +53,47 @@ class TestBestSpan(unittest.TestCase):
         self.assertEqual(list(scores), [5, 2])
         self.assertEqual(spans.tolist(), [[0, 2], [3, 3]])
 
+    def test_top_n_ties(self):
+        # Tied spans are selected latest span first
+        spans, scores = top_disjoint_spans(np.zeros((5, 5)), 2, 3)
+        self.assertEqual(spans.tolist(), [[4, 4], [3, 3], [2, 2]])
+
+        rng = np.random.RandomState(0)
+        for _ in range(50):
+            batch_size, n_tokens = rng.randint(1, 5), rng.randint(1, 40)
+            bound, n_spans = rng.randint(1, 10), rng.randint(1, 6)
+            scores = rng.randint(0, 3, (batch_size, n_tokens, n_tokens)).astype(np.float32)
+            spans, span_scores = top_disjoint_spans_batch(scores, bound, n_spans)
+            for i in range(batch_size):
+                expected_spans, expected_scores = self.top_disjoint_brute_force(scores[i], bound, n_spans)
+                self.assertEqual(spans[i].tolist(), expected_spans)
+
+    @staticmethod
+    def top_disjoint_brute_force(span_scores, bound, n_spans):
+        candidates = [(span_scores[s, e], s, e) for s in range(len(span_scores))
+                      for e in range(s, min(s + bound, len(span_scores)))]
+        candidates.sort(key=lambda x: (-x[0], -x[1], -x[2]))
+        selected = []
+        for score, s, e in candidates:
+            if all(e < s2 or s > e2 for _, s2, e2 in selected):
+                selected.append((score, s, e))
+                if len(selected) == n_spans:
+                    break
+        return [[s, e] for _, s, e in selected], [x[0] for x in selected]
+
+    def test_top_n_batch(self):
+        rng = np.random.RandomState(0)
+        for _ in range(50):
+            batch_size, n_tokens = rng.randint(1, 5), rng.randint(1, 60)
+            bound, n_spans = rng.randint(1, 20), rng.randint(1, 10)
+            scores = rng.normal(size=(batch_size, n_tokens, n_tokens)).astype(np.float32)
+            lens = rng.randint(1, n_tokens + 1, batch_size)
+            spans, span_scores = top_disjoint_spans_batch(scores, bound, n_spans, lens)
+            for i, n in enumerate(lens):
+                expected_spans, expected_scores = self.top_disjoint_brute_force(scores[i, :n, :n], bound, n_spans)
+                self.assertEqual(spans[i].tolist(), expected_spans)
+                self.assertTrue(np.allclose(span_scores[i], expected_scores))
+
     def test_best_span(self):
         bound = 5
         start_pl = tf.placeholder(tf.float32, (None, None))
@@ -0,0 +1,79 @@
+import pickle
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+
+from docqa.data_processing.document_splitter import MergeParagraphs
+from docqa.data_processing.split_cache import CachedSplitter
+
+
+class DictEvidence(object):
+    def __init__(self, docs):
+        self.docs = docs
+        self.n_loads = 0
+
+    def get_document(self, doc_id, n_tokens=None):
+        self.n_loads += 1
+        doc = self.docs.get(doc_id)
+        if doc is None or n_tokens is None:
+            return doc
+        out, n = [], 0
+        for para in doc:
+            out_para = []
+            for sent in para:
+                if n + len(sent) >= n_tokens:
+                    out_para.append(sent[:n_tokens - n])
+                    out.append(out_para)
+                    return out
+                out_para.append(sent)
+                n += len(sent)
+            out.append(out_para)
+        return out
+
+
+class TestSplitCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        voc = ["the", "fish", "red", ".", "x", "blue"]
+        self.evidence = DictEvidence({
+            "doc%d" % i: [[list(rng.choice(voc, rng.randint(1, 9))) for _ in range(rng.randint(1, 4))]
+                          for _ in range(rng.randint(1, 12))] for i in range(10)})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assert_same_split(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for e, a in zip(expected, actual):
+            self.assertEqual((e.start, e.end), (a.start, a.end))
+            self.assertEqual(e.text, a.text)
+            self.assertTrue(np.all(e.answer_spans == a.answer_spans))
+
+    def test_same_splits(self):
+        filename = join(self.tmp.name, "splits.db")
+        for splitter in [MergeParagraphs(7), MergeParagraphs(12, 20)]:
+            cached = CachedSplitter(splitter, filename)
+            # A second splitter sharing the file, like a pool worker would
+            worker = pickle.loads(pickle.dumps(cached))
+            spans = np.array([[0, 1], [3, 5]], dtype=np.int32)
+            for _ in range(2):
+                for doc_id in sorted(self.evidence.docs):
+                    expected = splitter.split_document(self.evidence, doc_id, spans)
+                    self.assert_same_split(expected, cached.split_document(self.evidence, doc_id, spans))
+                    self.assert_same_split(expected, worker.split_document(self.evidence, doc_id, spans))
+            n_docs = len(self.evidence.docs)
+            self.assertEqual((cached.misses, cached.disk_hits, cached.hits), (n_docs, 0, n_docs))
+            self.assertEqual((worker.misses, worker.disk_hits, worker.hits), (0, n_docs, n_docs))
+            self.assertIsNone(cached.split_document(self.evidence, "missing", None))
+
+    def test_memory_only(self):
+        cached = CachedSplitter(MergeParagraphs(7), n_in_memory=2)
+        for doc_id in ["doc0", "doc1", "doc0", "doc2", "doc1"]:
+            cached.split_document(self.evidence, doc_id, None)
+        self.assertEqual(cached.hits, 1)
+        self.assertEqual(cached.misses, 4)
+        self.assertEqual(cached.get_config(), MergeParagraphs(7).get_config())
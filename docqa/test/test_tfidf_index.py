@@ -0,0 +1,40 @@
+import unittest
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics import pairwise_distances
+
+from docqa.data_processing.tfidf_index import TfIdfIndex
+
+
+class TestTfIdfIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        voc = ["fish", "Red", "blue", "the", "of", "sea", "über", "a", "x", "thirteen", "whale", "boats"]
+        self.stop = ["the", "of", "a"]
+        self.paragraphs = [" ".join(rng.choice(voc, rng.randint(1, 40))) for _ in range(20)]
+        self.question = ["Red", "fish", "of", "the", "sea", "?"]
+
+    def test_matches_sklearn(self):
+        # With the index built over the candidates themselves we should match fitting a vectorizer on them
+        index = TfIdfIndex.build(self.paragraphs, self.stop)
+        tfidf = TfidfVectorizer(strip_accents="unicode", stop_words=self.stop)
+        para_features = tfidf.fit_transform(self.paragraphs)
+        q_features = tfidf.transform([" ".join(self.question)])
+        expected = pairwise_distances(q_features, para_features, "cosine").ravel()
+        actual = index.cosine_distances(self.question, self.paragraphs)
+        self.assertTrue(np.allclose(expected, actual))
+
+        # Question words that are not in the index should not change the ranking
+        question = self.question + ["unseen"]
+        self.assertEqual(np.argsort(expected, kind="stable").tolist(),
+                         np.argsort(index.cosine_distances(question, self.paragraphs), kind="stable").tolist())
+
+    def test_unknown_words(self):
+        index = TfIdfIndex.build(self.paragraphs[:5], self.stop)
+        dists = index.cosine_distances(["whale", "boats", "unseen"], ["unseen words", "the", "whale boats"])
+        self.assertEqual(len(dists), 3)
+        self.assertLess(dists[0], 1)
+        self.assertEqual(dists[1], 1)
+        self.assertLess(dists[2], 1)
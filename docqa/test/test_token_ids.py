@@ -0,0 +1,36 @@
+import pickle
+import unittest
+
+from docqa.data_processing.multi_paragraph_qa import MultiParagraphQuestion, DocumentParagraph
+from docqa.data_processing.qa_training_data import ParagraphAndQuestion
+from docqa.data_processing.token_ids import WordTable, add_token_ids, TokenIds
+
+
+class TestTokenIds(unittest.TestCase):
+
+    def test_add_token_ids(self):
+        shared = ["a", "shared", "context"]
+        data = [ParagraphAndQuestion(shared, ["who", "a"], None, "q1"),
+                ParagraphAndQuestion(shared, ["what"], None, "q2"),
+                MultiParagraphQuestion("q3", ["who"], ["ans"], [
+                    DocumentParagraph("d1", 0, 2, 0, None, ["new", "words"]),
+                    DocumentParagraph("d1", 2, 4, 1, None, ["a", "b"])])]
+        table = WordTable()
+        add_token_ids(data, table)
+
+        self.assertIs(data[0].context, data[1].context)
+        token_lists = [data[0].context, data[0].question, data[1].question, data[2].question] + \
+                      [p.text for p in data[2].paragraphs]
+        for tokens in token_lists:
+            self.assertIsInstance(tokens, TokenIds)
+            self.assertEqual([table.words[i] for i in tokens.ids], list(tokens))
+        self.assertEqual(len(table), len(set(table.words)))
+
+        table_len = len(table)
+        add_token_ids(data, table)  # Should be a no-op
+        self.assertEqual(len(table), table_len)
+
+        data, table = pickle.loads(pickle.dumps((data, table)))
+        self.assertIs(data[0].context.table, table)
+        self.assertEqual(list(data[0].context), shared)
+        self.assertEqual(list(table.add(["shared", "unseen"])), [table.words.index("shared"), table_len])
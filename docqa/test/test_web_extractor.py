@@ -0,0 +1,49 @@
+import asyncio
+import unittest
+
+from docqa.server.web_searcher import AsyncPooledExtractor, extract_main_text
+
+PAGE = """
+<html><head><title>Fish</title><script>var x = "not text";</script></head>
+<body>
+<nav><a href="/">Home</a> <a href="/about">About</a></nav>
+<h1>Red Fish</h1>
+<div class="content">
+  <p>The red fish is a fish that is red, it lives in the sea and eats smaller fish.</p>
+  <p>Short line.</p>
+  <p><a href="/a">Some</a> <a href="/b">link</a> <a href="/c">heavy</a> <a href="/d">paragraph</a> with few words</p>
+  <div>It is often confused with the blue fish, which is a different fish entirely.</div>
+</div>
+<footer>Copyright and a lot of other footer text that should not be included</footer>
+</body></html>
+"""
+
+
+class DictFetcher(object):
+    def __init__(self, pages):
+        self.pages = pages
+
+    async def fetch(self, url):
+        await asyncio.sleep(0)
+        return self.pages[url]
+
+
+class TestPooledExtractor(unittest.TestCase):
+
+    def test_extract(self):
+        self.assertEqual(extract_main_text(PAGE).split("\n"), [
+            "Red Fish",
+            "The red fish is a fish that is red, it lives in the sea and eats smaller fish.",
+            "It is often confused with the blue fish, which is a different fish entirely."
+        ])
+
+    def test_get_text(self):
+        loop = asyncio.new_event_loop()
+        extractor = AsyncPooledExtractor(DictFetcher({"a": PAGE, "b": "<p>" + "word " * 10 + "</p>"}),
+                                         n_processes=1, loop=loop)
+        docs = loop.run_until_complete(extractor.get_text(["a", "missing", "b"]))
+        self.assertEqual([x.url for x in docs], ["a", "b"])
+        self.assertEqual(docs[0].text, extract_main_text(PAGE))
+        self.assertEqual(docs[1].text, " ".join(["word"] * 10))
+        extractor.close()
+        loop.close()
@@ -0,0 +1,121 @@
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+
+from docqa.server.wiki import WikiParagraph, WikiArticle, WikiArticleCache, encode_article, decode_article
+
+
+def random_article(rng, title, n_paragraphs=5):
+    words = ["the", "fish", "ünïcode", "?", "x", "thirteen", "Red"]
+    paragraphs = []
+    for i in range(n_paragraphs):
+        text = [list(rng.choice(words, rng.randint(1, 10))) for _ in range(rng.randint(1, 4))]
+        original_text = " ".join(" ".join(s) for s in text)
+        spans = []
+        on = 0
+        for sent in text:
+            for word in sent:
+                spans.append((on, on + len(word)))
+                on += len(word) + 1
+        paragraphs.append(WikiParagraph(i, "paragraph" if i > 0 else "section", text,
+                                        original_text, np.array(spans, dtype=np.int32)))
+    return WikiArticle(title, rng.randint(0, 100000), paragraphs)
+
+
+class TestWikiArticleCache(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assert_same_article(self, expected: WikiArticle, actual: WikiArticle):
+        self.assertEqual(expected.title, actual.title)
+        self.assertEqual(expected.page_id, actual.page_id)
+        self.assertEqual(len(expected.paragraphs), len(actual.paragraphs))
+        for e, a in zip(expected.paragraphs, actual.paragraphs):
+            self.assertEqual(e.paragraph_num, a.paragraph_num)
+            self.assertEqual(e.kind, a.kind)
+            self.assertEqual(e.text, a.text)
+            self.assertEqual(e.original_text, a.original_text)
+            self.assertTrue(np.array_equal(e.spans, a.spans))
+
+    def test_encode(self):
+        article = random_article(self.rng, "Test")
+        self.assert_same_article(article, decode_article(article.title, article.page_id,
+                                                         encode_article(article)))
+
+    def test_encode_optional_fields(self):
+        article = random_article(self.rng, "Test", 3)
+        article.paragraphs[1].spans = None
+        article.paragraphs[2].spans = None
+        article.paragraphs[2].original_text = None
+        decoded = decode_article(article.title, article.page_id, encode_article(article))
+        self.assert_same_article(article, decoded)
+        self.assertEqual([p.spans is None for p in decoded.paragraphs], [False, True, True])
+
+    def test_get(self):
+        filename = join(self.tmp.name, "wiki.sqlite")
+        cache = WikiArticleCache(filename, n_hot=1)
+        articles = [random_article(self.rng, "Article %d" % i) for i in range(3)]
+        for article in articles:
+            cache.put(article.title, article)
+        self.assertIsNone(cache.get("Not an article"))
+        for article in articles:
+            self.assert_same_article(article, cache.get(article.title.upper()))
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(cache.misses, 1)
+        cache.close()
+
+        # Reload from disk
+        cache = WikiArticleCache(filename)
+        self.assertEqual(len(cache), 3)
+        self.assert_same_article(articles[1], cache.get(articles[1].title))
+        cache.close()
+
+    def test_evict(self):
+        articles = [random_article(self.rng, "Article %d" % i) for i in range(4)]
+        # Room for everything except articles[1]
+        size = sum(len(encode_article(articles[i])) for i in [0, 2, 3])
+        cache = WikiArticleCache(join(self.tmp.name, "wiki.sqlite"), size / (1024 * 1024), n_hot=0)
+        for article in articles[:3]:
+            cache.put(article.title, article)
+        cache.get(articles[0].title)  # articles[1] is now the least recently used
+        cache.put(articles[3].title, articles[3])
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get(articles[1].title))
+        self.assertIn(articles[0].title, cache)
+        self.assertIn(articles[3].title, cache)
+        self.assertLessEqual(cache.size, cache.max_size)
+        cache.close()
+
+    def test_evict_shared_file(self):
+        articles = [random_article(self.rng, "Article %d" % i) for i in range(6)]
+        size = sum(len(encode_article(x)) for x in articles[3:])
+        filename = join(self.tmp.name, "wiki.sqlite")
+        # Two caches on the same file, like two server workers
+        caches = [WikiArticleCache(filename, size / (1024 * 1024), n_hot=0) for _ in range(2)]
+        for i, article in enumerate(articles):
+            caches[i % 2].put(article.title, article)
+        for cache in caches:
+            self.assertLessEqual(cache.size, cache.max_size)
+        self.assertEqual(caches[1].size, size)  # The last writer sees the size of the shared file
+        self.assertEqual(len(caches[0]), 3)
+        for article in articles[3:]:
+            self.assertIn(article.title, caches[1])
+        for cache in caches:
+            cache.close()
+
+    def test_size_after_replace(self):
+        filename = join(self.tmp.name, "wiki.sqlite")
+        cache = WikiArticleCache(filename)
+        first, second = random_article(self.rng, "A", 2), random_article(self.rng, "A", 6)
+        cache.put("A", first)
+        cache.put("A", second)
+        self.assertEqual(cache.size, len(encode_article(second)))
+        cache.close()
+        self.assertEqual(WikiArticleCache(filename).size, len(encode_article(second)))
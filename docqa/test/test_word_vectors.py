@@ -0,0 +1,70 @@
+import gzip
+import pickle
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+
+from docqa.data_processing.word_vectors import load_word_vector_file, convert_word_vectors, \
+    load_word_vectors, StoredWordVectors, stack_word_vectors, _parse_lines
+
+
+class TestWordVectorStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        self.words = ["the", "The", "fish", "ünïcode", ".", "Red", "red", "the"]
+        self.vec_path = join(self.tmp.name, "vecs")
+        with open(self.vec_path + ".txt", "w", encoding="utf-8") as f:
+            for word in self.words:
+                f.write(word + " " + " ".join("%.5f" % x for x in rng.uniform(-1, 1, 5)) + "\n")
+        convert_word_vectors(self.vec_path + ".txt", self.vec_path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assert_same(self, expected, actual):
+        self.assertEqual(set(expected), set(actual))
+        for word, vec in expected.items():
+            self.assertTrue(np.array_equal(vec, actual[word]))
+
+    def test_load(self):
+        for voc in [None, [], ["THE", "red", "missing"]]:
+            expected = load_word_vector_file(self.vec_path + ".txt", voc)
+            actual = load_word_vectors(self.vec_path, voc, True)
+            self.assertIsInstance(actual, StoredWordVectors)
+            self.assert_same(expected, actual)
+
+    def test_matrix_and_pickle(self):
+        actual = load_word_vectors(self.vec_path, None, True)
+        words = ["Red", "the", "Red"]
+        self.assertTrue(np.array_equal(stack_word_vectors(actual, words),
+                                       np.vstack([actual[w] for w in words])))
+        self.assert_same(actual, pickle.loads(pickle.dumps(actual)))
+
+    def test_parallel_parse(self):
+        with open(self.vec_path + ".txt", "rb") as f:
+            data = f.read()
+        with gzip.open(self.vec_path + ".txt.gz", "wb") as f:
+            f.write(data)
+        for voc in [None, ["THE", "red", "missing"]]:
+            expected = load_word_vector_file(self.vec_path + ".txt", voc)
+            for ext in [".txt", ".txt.gz"]:
+                for n_processes in [2, 3]:
+                    actual = load_word_vector_file(self.vec_path + ext, voc, n_processes)
+                    self.assertEqual(list(expected.keys()), list(actual.keys()))
+                    self.assert_same(expected, actual)
+
+    def test_parse_mismatched_lines(self):
+        # The total number of values divides evenly, but one line is too long and a later one too short
+        lines = ["a 1 2 3", "b 4 5 6 7", "c 8 9 10", "d 11 12", "e 13 14 15 "]
+        words, vectors = _parse_lines(lines, None)
+        self.assertEqual(words, ["a", "b", "c", "d", "e"])
+        self.assertEqual([list(x) for x in vectors],
+                         [[1, 2, 3], [4, 5, 6, 7], [8, 9, 10], [11, 12], [13, 14, 15]])
+
+        words, vectors = _parse_lines(["a 1 2", "b 3 4 "], None)
+        self.assertIsInstance(vectors, np.ndarray)
+        self.assertEqual(vectors.tolist(), [[1, 2], [3, 4]])
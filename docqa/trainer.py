@@ -16,7 +16,7 @@ from docqa import configurable
 from docqa.configurable import Configurable
 from docqa.data_processing.preprocessed_corpus import PreprocessedData
 from docqa.dataset import TrainingData, Dataset
-from docqa.evaluator import Evaluator, Evaluation, AysncEvaluatorRunner, EvaluatorRunner
+from docqa.evaluator import Evaluator, Evaluation, AysncEvaluatorRunner, EvaluatorRunner, encode_in_order
 from docqa.model import Model
 from docqa.model_dir import ModelDir
 
@@ -88,6 +88,7 @@ class TrainParams(Configurable):
                  eval_samples: Dict[str, Optional[int]],
                  regularization_weight: Optional[float] = None,
                  async_encoding: Optional[int] = None,
+                 async_encoding_workers: int = 1,
                  max_checkpoints_to_keep: int = 5,
                  loss_ema: Optional[float] = .999,
                  eval_at_zero: bool = False,
@@ -104,6 +105,8 @@ class TrainParams(Configurable):
         :param eval_samples: How many samples to draw during evaluation, None of a full epoch
         :param regularization_weight: How highly to weight regulraization, defaults to 1
         :param async_encoding: Encoding batches in a seperate thread, and store in a queue of this size
+        :param async_encoding_workers: Number of threads to encode batches with if using `async_encoding`,
+                                       batches are still enqueued in the order the dataset yields them
         :param max_checkpoints_to_keep: Max number of checkpoints to keep during training
         :param loss_ema: EMA weights for monitoring the loss during training
         :param eval_at_zero: Run an evaluation cycle before any training
@@ -112,6 +115,7 @@ class TrainParams(Configurable):
         :param best_weights: Store the weights with the highest scores on the given eval dataset/metric
         """
         self.async_encoding = async_encoding
+        self.async_encoding_workers = async_encoding_workers
         self.regularization_weight = regularization_weight
         self.max_checkpoints_to_keep = max_checkpoints_to_keep
         self.opt = opt
@@ -126,6 +130,12 @@ class TrainParams(Configurable):
         self.eval_samples = eval_samples
         self.best_weights = best_weights
 
+    def __setstate__(self, state):
+        params = state["state"] if "state" in state else state
+        if "async_encoding_workers" not in params:
+            params["async_encoding_workers"] = 1
+        super().__setstate__(state)
+
 
 def save_train_start(out,
                      data: TrainingData,
@@ -480,9 +490,11 @@ def _train_async(model: Model,
     placeholders = model.get_placeholders()
 
     train_queue = tf.FIFOQueue(train_params.async_encoding, [x.dtype for x in placeholders], name="train_queue")
-    evaluator_runner = AysncEvaluatorRunner(evaluators, model, train_params.async_encoding)
+    evaluator_runner = AysncEvaluatorRunner(evaluators, model, train_params.async_encoding,
+                                            train_params.async_encoding_workers)
     train_enqeue = train_queue.enqueue(placeholders)
     train_close = train_queue.close(True)
+    train_queue_size = train_queue.size()
 
     is_train = tf.placeholder(tf.bool, ())
     input_tensors = tf.cond(is_train, lambda: train_queue.dequeue(),
@@ -552,13 +564,21 @@ def _train_async(model: Model,
         # summary_writer.add_graph(sess.graph, global_step=on_step)
         save_train_start(out.dir, data, sess.run(global_step), evaluators, train_params, notes)
 
+    # Seconds the enqueue thread spent waiting on the encoders, and waiting on a full queue, since the last log
+    enqueue_stats = dict(encode_wait=0, enqueue_wait=0)
+
     def enqueue_train():
         try:
-            # feed data from the dataset iterator -> encoder -> queue
+            # feed data from the dataset iterator -> encoder(s) -> queue
             for epoch in range(train_params.num_epochs):
-                for batch in train.get_epoch():
-                    feed_dict = model.encode(batch, True)
+                n_workers = train_params.async_encoding_workers
+                # With one worker we still encode in the enqueue thread, otherwise keep each worker busy
+                encoded = encode_in_order(model, train.get_epoch(), True, n_workers,
+                                          0 if n_workers <= 1 else n_workers, enqueue_stats)
+                for _, feed_dict in encoded:
+                    t0 = time.perf_counter()
                     sess.run(train_enqeue, feed_dict)
+                    enqueue_stats["enqueue_wait"] += time.perf_counter() - t0
         except tf.errors.CancelledError:
             # The queue_close operator has been called, exit gracefully
             return
@@ -586,7 +606,8 @@ def _train_async(model: Model,
                 get_summary = on_step % train_params.log_period == 0
 
                 if get_summary:
-                    summary, _, batch_loss = sess.run([summary_tensor, train_opt, loss], feed_dict=train_dict)
+                    summary, _, batch_loss, queue_size = sess.run([summary_tensor, train_opt, loss, train_queue_size],
+                                                                  feed_dict=train_dict)
                 else:
                     summary = None
                     _, batch_loss = sess.run([train_opt, loss], feed_dict=train_dict)
@@ -598,10 +619,16 @@ def _train_async(model: Model,
                 if summary is not None:
                     print("on epoch=%d batch=%d step=%d, time=%.3f" %
                           (epoch, batch_ix + 1, on_step, batch_time))
-                    summary_writer.add_summary(
-                        tf.Summary(value=[tf.Summary.Value(tag="time", simple_value=batch_time)]), on_step)
+                    summary_writer.add_summary(tf.Summary(value=[
+                        tf.Summary.Value(tag="time", simple_value=batch_time),
+                        tf.Summary.Value(tag="train-queue/size", simple_value=queue_size),
+                        tf.Summary.Value(tag="train-queue/encode-wait", simple_value=enqueue_stats["encode_wait"]),
+                        tf.Summary.Value(tag="train-queue/enqueue-wait", simple_value=enqueue_stats["enqueue_wait"]),
+                    ]), on_step)
                     summary_writer.add_summary(summary, on_step)
                     batch_time = 0
+                    enqueue_stats["encode_wait"] = 0
+                    enqueue_stats["enqueue_wait"] = 0
 
                 # occasional saving
                 if on_step % train_params.save_period == 0:
@@ -639,15 +666,18 @@ def _train_async(model: Model,
 
 
 def test(model: Model, evaluators, datasets: Dict[str, Dataset], loader, checkpoint,
-         ema=True, aysnc_encoding=None, sample=None) -> Dict[str, Evaluation]:
+         ema=True, aysnc_encoding=None, sample=None,
+         n_encoding_workers: int=1, n_postprocess_workers: int=0) -> Dict[str, Evaluation]:
     print("Setting up model")
     model.set_inputs(list(datasets.values()), loader)
 
     if aysnc_encoding:
-        evaluator_runner = AysncEvaluatorRunner(evaluators, model, aysnc_encoding)
+        evaluator_runner = AysncEvaluatorRunner(evaluators, model, aysnc_encoding,
+                                                n_encoding_workers, n_postprocess_workers)
         inputs = evaluator_runner.dequeue_op
     else:
-        evaluator_runner = EvaluatorRunner(evaluators, model)
+        prefetch = 0 if n_encoding_workers <= 1 else n_encoding_workers
+        evaluator_runner = EvaluatorRunner(evaluators, model, n_encoding_workers, prefetch, n_postprocess_workers)
         inputs = model.get_placeholders()
     input_dict = {p: x for p, x in zip(model.get_placeholders(), inputs)}
 
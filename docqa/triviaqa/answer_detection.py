@@ -114,6 +114,65 @@ class FastNormalizedAnswerDetector(object):
         return list(set(occurances))
 
 
+class MultiPatternAnswerDetector(object):
+    """
+    Finds the same spans as `FastNormalizedAnswerDetector`, but builds a token-level trie over all the aliases
+    once per question and then matches every alias in a single pass over each paragraph
+    """
+
+    def __init__(self):
+        # These come from the TrivaQA official evaluation script
+        self.skip = {"a", "an", "the", ""}
+        self.strip = string.punctuation + "".join([u"‘", u"’", u"´", u"`", "_"])
+
+        # Nested dictionaries of token -> child, `None` marks the nodes where an alias ends
+        self.trie = None
+
+    def set_question(self, normalized_aliases):
+        trie = {}
+        for answer in normalized_aliases:
+            if len(answer) == 0:
+                continue
+            node = trie
+            for token in answer:
+                node = node.setdefault(token, {})
+            node[None] = True
+        self.trie = trie
+
+    def any_found(self, para):
+        words = [w.lower().strip(self.strip) for w in flatten_iterable(para)]
+        skip = self.skip
+        trie = self.trie
+        occurances = set()
+
+        # Partial matches as (trie node, start word, tokens we skipped over instead of following from that node).
+        # Articles can be skipped between answer tokens, but only for aliases whose next token is not that word,
+        # so skipping over a word excludes the aliases that continue with it from the match
+        partial = []
+        for i, word in enumerate(words):
+            next_partial = []
+            for node, start, excluded in partial:
+                child = node.get(word)
+                if child is not None and word not in excluded:
+                    if None in child:
+                        occurances.add((start, i + 1))
+                    if len(child) > (None in child):
+                        next_partial.append((child, start, ()))
+                    if word in skip:
+                        next_partial.append((node, start, excluded + (word,)))
+                elif word in skip:
+                    next_partial.append((node, start, excluded))
+
+            child = trie.get(word)
+            if child is not None:
+                if None in child:
+                    occurances.add((i, i + 1))
+                if len(child) > (None in child):
+                    next_partial.append((child, i, ()))
+            partial = next_partial
+        return sorted(occurances)
+
+
 class CarefulAnswerDetector(object):
     """
     There are some common false negatives in the above answer detection, in particular plurals of answers are
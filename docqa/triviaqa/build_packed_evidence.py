@@ -0,0 +1,72 @@
+import argparse
+import json
+from os import makedirs
+from os.path import join, exists
+from typing import List, Optional
+
+import numpy as np
+from tqdm import tqdm
+
+from docqa.config import CORPUS_DIR
+from docqa.triviaqa.evidence_corpus import TriviaQaEvidenceCorpusTxt
+
+"""
+Convert the tokenized evidence corpus into the binary format used by `TriviaQaEvidenceCorpusPacked`
+"""
+
+
+def build_packed_corpus(corpus: TriviaQaEvidenceCorpusTxt, output_dir: str, file_ids: Optional[List[str]]=None):
+    if file_ids is None:
+        file_ids = corpus.list_documents()
+    if not exists(output_dir):
+        makedirs(output_dir)
+
+    vocab = {}
+    n_tokens, n_sentences, n_paragraphs = 0, 0, 0
+    names = ["tokens", "sentences", "paragraphs", "documents"]
+    files = {name: open(join(output_dir, name + ".bin"), "wb") for name in names}
+    try:
+        for file_id in tqdm(file_ids, ncols=80):
+            doc = corpus.get_document(file_id)
+            if doc is None:
+                raise ValueError("Could not load document: " + file_id)
+            np.array([n_paragraphs], dtype=np.int64).tofile(files["documents"])
+            paragraphs, sentences, tokens = [], [], []
+            for para in doc:
+                paragraphs.append(n_sentences)
+                for sent in para:
+                    sentences.append(n_tokens)
+                    tokens += [vocab.setdefault(w, len(vocab)) for w in sent]
+                    n_tokens += len(sent)
+                    n_sentences += 1
+                n_paragraphs += 1
+            np.array(tokens, dtype=np.int32).tofile(files["tokens"])
+            np.array(sentences, dtype=np.int64).tofile(files["sentences"])
+            np.array(paragraphs, dtype=np.int64).tofile(files["paragraphs"])
+
+        # End offsets, so the i-th element always spans [start[i], start[i+1])
+        np.array([n_tokens], dtype=np.int64).tofile(files["sentences"])
+        np.array([n_sentences], dtype=np.int64).tofile(files["paragraphs"])
+        np.array([n_paragraphs], dtype=np.int64).tofile(files["documents"])
+    finally:
+        for f in files.values():
+            f.close()
+
+    with open(join(output_dir, "vocab.txt"), "w", encoding="utf-8", newline="") as f:
+        f.write("\n".join(vocab))
+    with open(join(output_dir, "documents.json"), "w") as f:
+        json.dump(file_ids, f)
+    with open(join(output_dir, "metadata.json"), "w") as f:
+        json.dump(dict(n_tokens=n_tokens, n_sentences=n_sentences + 1,
+                       n_paragraphs=n_paragraphs + 1, n_documents=len(file_ids) + 1), f)
+
+
+def main():
+    parser = argparse.ArgumentParser("Convert the tokenized TriviaQA evidence corpus to a packed binary format")
+    parser.add_argument("-o", "--output_dir", type=str, default=join(CORPUS_DIR, "triviaqa", "evidence-packed"))
+    args = parser.parse_args()
+    build_packed_corpus(TriviaQaEvidenceCorpusTxt(), args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,8 +10,8 @@ from typing import List, Optional, Dict
 from docqa.config import CORPUS_DIR, TRIVIA_QA, TRIVIA_QA_UNFILTERED
 from docqa.configurable import Configurable
 from docqa.data_processing.text_utils import NltkAndPunctTokenizer
-from docqa.triviaqa.answer_detection import compute_answer_spans_par, FastNormalizedAnswerDetector
-from docqa.triviaqa.evidence_corpus import TriviaQaEvidenceCorpusTxt
+from docqa.triviaqa.answer_detection import compute_answer_spans_par, MultiPatternAnswerDetector
+from docqa.triviaqa.evidence_corpus import TriviaQaEvidenceCorpusTxt, TriviaQaEvidenceCorpusPacked
 from docqa.triviaqa.read_data import iter_trivia_question, TriviaQaQuestion
 from docqa.utils import ResourceLoader
 
@@ -80,7 +80,12 @@ class TriviaQaSpanCorpus(Configurable):
             file_map = json.load(f)
         for k, v in file_map.items():
             file_map[k] = unicodedata.normalize("NFD", v)
-        self.evidence = TriviaQaEvidenceCorpusTxt(file_map)
+        packed_dir = join(CORPUS_DIR, "triviaqa", "evidence-packed")
+        if exists(join(packed_dir, "metadata.json")):
+            # Built by `build_packed_evidence.py`, returns the same documents but loads them faster
+            self.evidence = TriviaQaEvidenceCorpusPacked(file_map, packed_dir)
+        else:
+            self.evidence = TriviaQaEvidenceCorpusTxt(file_map)
 
     def get_train(self) -> List[TriviaQaQuestion]:
         with open(join(self.dir, "train.pkl"), "rb") as f:
@@ -137,7 +142,7 @@ def build_wiki_corpus(n_processes):
                       train=join(TRIVIA_QA, "qa", "wikipedia-train.json"),
                       test=join(TRIVIA_QA, "qa", "wikipedia-test-without-answers.json")
                   ),
-                  FastNormalizedAnswerDetector(), n_processes)
+                  MultiPatternAnswerDetector(), n_processes)
 
 
 def build_web_corpus(n_processes):
@@ -148,7 +153,7 @@ def build_web_corpus(n_processes):
                       train=join(TRIVIA_QA, "qa", "web-train.json"),
                       test=join(TRIVIA_QA, "qa", "web-test-without-answers.json")
                   ),
-                  FastNormalizedAnswerDetector(), n_processes)
+                  MultiPatternAnswerDetector(), n_processes)
 
 
 def build_sample_corpus(n_processes):
@@ -157,7 +162,7 @@ def build_sample_corpus(n_processes):
                       dev=join(TRIVIA_QA, "qa", "web-dev.json"),
                       train=join(TRIVIA_QA, "qa", "web-train.json"),
                   ),
-                  FastNormalizedAnswerDetector(), n_processes, sample=1000)
+                  MultiPatternAnswerDetector(), n_processes, sample=1000)
 
 
 def build_unfiltered_corpus(n_processes):
@@ -167,7 +172,7 @@ def build_unfiltered_corpus(n_processes):
                       train=join(TRIVIA_QA_UNFILTERED, "unfiltered-web-train.json"),
                       test=join(TRIVIA_QA_UNFILTERED, "unfiltered-web-test-without-answers.json")
                   ),
-                  answer_detector=FastNormalizedAnswerDetector(),
+                  answer_detector=MultiPatternAnswerDetector(),
                   n_process=n_processes)
 
 
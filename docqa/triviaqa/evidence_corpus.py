@@ -1,11 +1,13 @@
 import argparse
+import json
 import pickle
 import re
 from collections import Counter
 from os import walk, mkdir, makedirs
 from os.path import relpath, join, exists
-from typing import Set
+from typing import Set, Tuple, Optional
 
+import numpy as np
 from tqdm import tqdm
 
 from docqa import config
@@ -231,6 +233,94 @@ class TriviaQaEvidenceCorpusTxt(object):
                     return paragraphs
 
 
+class TriviaQaEvidenceCorpusPacked(object):
+    """
+    Binary version of `TriviaQaEvidenceCorpusTxt` built by `build_packed_evidence.py`. All the documents are stored as
+    one memory-mapped array of token ids, with arrays of sentence start offsets (into the tokens), paragraph start
+    offsets (into the sentences), and document start offsets (into the paragraphs). `get_document_ids` returns
+    zero-copy views of these arrays, `get_document` returns the same output as `TriviaQaEvidenceCorpusTxt`
+    """
+
+    def __init__(self, file_id_map=None, directory=None):
+        self.directory = join(CORPUS_DIR, "triviaqa/evidence-packed") if directory is None else directory
+        self.file_id_map = file_id_map
+        self._arrays = None
+
+    def _load(self):
+        if self._arrays is None:
+            with open(join(self.directory, "metadata.json"), "r") as f:
+                meta = json.load(f)
+            arrays = {}
+            for name, dtype in [("tokens", np.int32), ("sentences", np.int64),
+                                ("paragraphs", np.int64), ("documents", np.int64)]:
+                if meta["n_" + name] == 0:
+                    arrays[name] = np.zeros(0, dtype=dtype)
+                else:
+                    # Use plain ndarray views, slicing `np.memmap` objects is much slower
+                    arrays[name] = np.memmap(join(self.directory, name + ".bin"), dtype=dtype, mode="r",
+                                             shape=(meta["n_" + name], )).view(np.ndarray)
+            with open(join(self.directory, "vocab.txt"), "r", encoding="utf-8", newline="") as f:
+                arrays["words"] = np.array(f.read().split("\n"), dtype=object)
+            with open(join(self.directory, "documents.json"), "r") as f:
+                arrays["file_ids"] = {x: i for i, x in enumerate(json.load(f))}
+            self._arrays = arrays
+        return self._arrays
+
+    def __getstate__(self):
+        # Don't pickle the memory mapped arrays, so this can be cheaply sent to other processes
+        return dict(directory=self.directory, file_id_map=self.file_id_map)
+
+    def __setstate__(self, state):
+        self.__init__(state["file_id_map"], state["directory"])
+
+    def get_vocab(self):
+        return set(self._load()["words"].tolist())
+
+    def list_documents(self):
+        if self.file_id_map is not None:
+            return list(self.file_id_map.keys())
+        return list(self._load()["file_ids"])
+
+    def get_document_ids(self, doc_id, n_tokens=None) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Returns the token ids for a document, the start offsets of each sentence within those ids, and the
+        start offsets of each paragraph within those sentences. The token ids are a view of the memory-mapped
+        array. If `n_tokens` is given, only the first `n_tokens` tokens are returned.
+        """
+        arrays = self._load()
+        file_id = doc_id if self.file_id_map is None else self.file_id_map.get(doc_id)
+        doc_ix = arrays["file_ids"].get(file_id)
+        if doc_ix is None:
+            return None
+        documents, paragraphs, sentences = arrays["documents"], arrays["paragraphs"], arrays["sentences"]
+        para_start, para_end = documents[doc_ix], documents[doc_ix + 1]
+        sent_start, sent_end = paragraphs[para_start], paragraphs[para_end]
+        token_start, token_end = sentences[sent_start], sentences[sent_end]
+        if n_tokens is not None:
+            token_end = min(token_end, token_start + n_tokens)
+            # Sentences/paragraphs that start before `token_end`
+            sent_end = sent_start + np.searchsorted(sentences[sent_start:sent_end], token_end, "left")
+            para_end = para_start + np.searchsorted(paragraphs[para_start:para_end], sent_end, "left")
+        return (arrays["tokens"][token_start:token_end],
+                sentences[sent_start:sent_end] - token_start,
+                paragraphs[para_start:para_end] - sent_start)
+
+    def get_document(self, doc_id, n_tokens=None, flat=False):
+        ids = self.get_document_ids(doc_id, n_tokens)
+        if ids is None:
+            return None
+        token_ids, sent_starts, para_starts = ids
+        words = self._load()["words"][token_ids].tolist()
+        if flat:
+            if n_tokens is None:
+                return [x for x in words if len(x) > 0]
+            return words
+        sent_ends = np.append(sent_starts[1:], len(words)).tolist()
+        sents = [words[s:e] for s, e in zip(sent_starts.tolist(), sent_ends)]
+        para_ends = np.append(para_starts[1:], len(sents)).tolist()
+        return [sents[s:e] for s, e in zip(para_starts.tolist(), para_ends)]
+
+
 def main():
     parse = argparse.ArgumentParser("Pre-tokenize the TriviaQA evidence corpus")
     parse.add_argument("-o", "--output_dir", type=str, default=join(config.CORPUS_DIR, "triviaqa", "evidence"))
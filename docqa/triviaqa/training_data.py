@@ -1,10 +1,11 @@
 import sys
-from typing import List, Optional
+from collections import OrderedDict
+from typing import List, Optional, Tuple, Iterable
 
 import numpy as np
 
 from docqa.data_processing.document_splitter import DocumentSplitter, ParagraphFilter, \
-    DocParagraphWithAnswers
+    DocParagraphWithAnswers, annotate_paragraphs
 from docqa.data_processing.multi_paragraph_qa import DocumentParagraph, MultiParagraphQuestion
 from docqa.data_processing.preprocessed_corpus import Preprocessor, FilteredData
 from docqa.data_processing.qa_training_data import ParagraphAndQuestion, Answer
@@ -28,6 +29,37 @@ class DocumentParagraphQuestion(ParagraphAndQuestion):
         self.rank = rank
 
 
+def _prune_by_document(splitter: DocumentSplitter, para_filter: Optional[ParagraphFilter], evidence,
+                       pairs: List[Tuple[TriviaQaQuestion, object]]) -> Iterable[Tuple[int, List]]:
+    """
+    Yields (index, pruned paragraphs) for each (question, document) pair in `pairs`. Pairs are
+    grouped by document, so each distinct document is loaded and split once, and pruned for all
+    its questions before the next document is split. This way only one document's paragraphs
+    need to be in memory at a time, while filters can still re-use work across questions.
+    """
+    by_doc = OrderedDict()
+    for i, (_, doc) in enumerate(pairs):
+        by_doc.setdefault(doc.doc_id, []).append(i)
+
+    for doc_id, ixs in by_doc.items():
+        split = splitter.load_split(evidence, doc_id)
+        if split is None:
+            raise ValueError("No evidence text found document: " + doc_id)
+        paragraphs = []
+        for i in ixs:
+            # if `answer_spans` is None (only needed for test cases) the document is split
+            # with no answers, this is kind of a hack to make the rest of the pipeline work
+            spans = pairs[i][1].answer_spans
+            if spans is None:
+                spans = np.zeros((0, 2), dtype=np.int32)
+            paragraphs.append(annotate_paragraphs(split, spans))
+        if para_filter is not None:
+            paragraphs = para_filter.prune_many([pairs[i][0].question for i in ixs], paragraphs,
+                                                [doc_id] * len(ixs))
+        for i, paras in zip(ixs, paragraphs):
+            yield i, paras
+
+
 class ExtractSingleParagraph(Preprocessor):
     """ Grab a single paragraph for each (document, question) pair, builds a list of
      (filtered) `DocumentParagraphQuestion` objects """
@@ -44,34 +76,26 @@ class ExtractSingleParagraph(Preprocessor):
         self.require_answer = require_answer
 
     def preprocess(self, questions: List[TriviaQaQuestion], evidence) -> FilteredData:
-        splitter = self.splitter
-        paragraph_filter = self.para_filter
-        output = []
-        read_only = splitter.reads_first_n
-        for q in questions:
-            for doc in q.all_docs:
-                text = evidence.get_document(doc.doc_id, n_tokens=read_only)
-                if text is None:
-                    raise ValueError(doc.doc_id, doc.doc_id)
-
-                paragraphs = splitter.split_annotated(text, doc.answer_spans)
-                if paragraph_filter is not None:
-                    paragraphs = paragraph_filter.prune(q.question, paragraphs)
-                if self.require_answer:
-                    paragraphs = [x for x in paragraphs if len(x.answer_spans) > 0]
-                if len(paragraphs) == 0:
-                    continue
-                paragraph = paragraphs[0]
-                if self.text_preprocess is not None:
-                    ex = self.text_preprocess.encode_extracted_paragraph(q.question, paragraph)
-                    if not self.require_answer or len(ex.answer_spans) > 0:
-                        output.append(DocumentParagraphQuestion(q.question_id, doc.doc_id, (paragraph.start, paragraph.end),
-                                                                q.question, ex.text,
-                                                                TokenSpans(q.answer.all_answers, ex.answer_spans), 1))
-                else:
-                    output.append(DocumentParagraphQuestion(q.question_id, doc.doc_id, (paragraph.start, paragraph.end),
-                                                            q.question, flatten_iterable(paragraph.text),
-                                                            TokenSpans(q.answer.all_answers, paragraph.answer_spans), 1))
+        pairs = [(q, doc) for q in questions for doc in q.all_docs]
+        output = [None] * len(pairs)
+        for i, paragraphs in _prune_by_document(self.splitter, self.para_filter, evidence, pairs):
+            q, doc = pairs[i]
+            if self.require_answer:
+                paragraphs = [x for x in paragraphs if len(x.answer_spans) > 0]
+            if len(paragraphs) == 0:
+                continue
+            paragraph = paragraphs[0]
+            if self.text_preprocess is not None:
+                ex = self.text_preprocess.encode_extracted_paragraph(q.question, paragraph)
+                if not self.require_answer or len(ex.answer_spans) > 0:
+                    output[i] = DocumentParagraphQuestion(q.question_id, doc.doc_id, (paragraph.start, paragraph.end),
+                                                          q.question, ex.text,
+                                                          TokenSpans(q.answer.all_answers, ex.answer_spans), 1)
+            else:
+                output[i] = DocumentParagraphQuestion(q.question_id, doc.doc_id, (paragraph.start, paragraph.end),
+                                                      q.question, flatten_iterable(paragraph.text),
+                                                      TokenSpans(q.answer.all_answers, paragraph.answer_spans), 1)
+        output = [x for x in output if x is not None]
         return FilteredData(output, sum(len(x.all_docs) for x in questions))
 
     def finalize_chunk(self, x: FilteredData):
@@ -117,50 +141,40 @@ class ExtractMultiParagraphs(Preprocessor):
 
     def preprocess(self, questions: List[TriviaQaQuestion], evidence):
         true_len = 0
-        splitter = self.splitter
-        para_filter = self.ranker
-
-        with_paragraphs = []
+        pairs = []
         for q in questions:
             true_len += len(q.all_docs)
             for doc in q.all_docs:
                 if self.require_an_answer and len(doc.answer_spans) == 0:
                     continue
-                text = evidence.get_document(doc.doc_id, splitter.reads_first_n)
-                if text is None:
-                    raise ValueError("No evidence text found document: " + doc.doc_id)
-                if doc.answer_spans is not None:
-                    paras = splitter.split_annotated(text, doc.answer_spans)
-                else:
-                    # this is kind of a hack to make the rest of the pipeline work, only
-                    # needed for test cases
-                    paras = splitter.split_annotated(text, np.zeros((0, 2), dtype=np.int32))
-
-                if para_filter is not None:
-                    paras = para_filter.prune(q.question, paras)
+                pairs.append((q, doc))
 
-                if len(paras) == 0:
+        with_paragraphs = [None] * len(pairs)
+        for i, paras in _prune_by_document(self.splitter, self.ranker, evidence, pairs):
+            q, doc = pairs[i]
+            if len(paras) == 0:
+                continue
+            if self.require_an_answer:
+                if all(len(x.answer_spans) == 0 for x in paras):
                     continue
+            if self.text_process is not None:
+                prepped = [self.text_process.encode_extracted_paragraph(q.question, p) for p in paras]
                 if self.require_an_answer:
-                    if all(len(x.answer_spans) == 0 for x in paras):
+                    if all(len(x.answer_spans) == 0 for x in prepped):
                         continue
-                if self.text_process is not None:
-                    prepped = [self.text_process.encode_extracted_paragraph(q.question, p) for p in paras]
-                    if self.require_an_answer:
-                        if all(len(x.answer_spans) == 0 for x in prepped):
-                            continue
-                    doc_paras = []
-                    for i, (preprocessed, para) in enumerate(zip(prepped, paras)):
-                        doc_paras.append(DocumentParagraph(doc.doc_id, para.start, para.end,
-                                                           i, preprocessed.answer_spans, preprocessed.text))
+                doc_paras = []
+                for j, (preprocessed, para) in enumerate(zip(prepped, paras)):
+                    doc_paras.append(DocumentParagraph(doc.doc_id, para.start, para.end,
+                                                       j, preprocessed.answer_spans, preprocessed.text))
 
-                else:
-                    doc_paras = [DocumentParagraph(doc.doc_id, x.start, x.end,
-                                                   i, x.answer_spans, flatten_iterable(x.text))
-                                 for i, x in enumerate(paras)]
-                with_paragraphs.append(MultiParagraphQuestion(q.question_id, q.question,
-                                                              None if q.answer is None else q.answer.all_answers,
-                                                              doc_paras))
+            else:
+                doc_paras = [DocumentParagraph(doc.doc_id, x.start, x.end,
+                                               j, x.answer_spans, flatten_iterable(x.text))
+                             for j, x in enumerate(paras)]
+            with_paragraphs[i] = MultiParagraphQuestion(q.question_id, q.question,
+                                                        None if q.answer is None else q.answer.all_answers,
+                                                        doc_paras)
+        with_paragraphs = [x for x in with_paragraphs if x is not None]
 
         return FilteredData(with_paragraphs, true_len)
 
@@ -194,13 +208,11 @@ class ExtractMultiParagraphsPerQuestion(Preprocessor):
             for doc in q.all_docs:
                 if self.require_an_answer and len(doc.answer_spans) == 0:
                     continue
-                text = evidence.get_document(doc.doc_id, splitter.reads_first_n)
-                if doc.answer_spans is not None:
-                    split = splitter.split_annotated(text, doc.answer_spans)
-                else:
-                    # this is kind of a hack to make the rest of the pipeline work, only
-                    # needed for test cases
-                    split = splitter.split_annotated(text, np.zeros((0, 2), dtype=np.int32))
+                # if `doc.answer_spans` is None (only needed for test cases) the document is split
+                # with no answers, this is kind of a hack to make the rest of the pipeline work
+                split = splitter.split_document(evidence, doc.doc_id, doc.answer_spans)
+                if split is None:
+                    raise ValueError("No evidence text found document: " + doc.doc_id)
                 paras.extend([DocParagraphWithAnswers(x.text, x.start, x.end, x.answer_spans, doc.doc_id)
                               for x in split])
 